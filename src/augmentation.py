@@ -9,31 +9,170 @@ https://opensource.org/licenses/MIT
 Written by Juan Carlos Cedeño Noblecilla.
 """
 
+import copy
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import albumentations as A
 import cv2
+import numpy as np
+
+from src.data.factory import convert_channels
+
+# Seeded calls on albumentations versions without per-pipeline generators reseed the global ones
+_global_random_lock = threading.Lock()
+
+# Shift of the nearest neighbour warp of masks, in source pixels, that absorbs the fixed-point rounding of cv2.warpAffine
+_NEAREST_MARGIN = 1 / 256
 
 
 class Augmentation:
-    def __init__(self):
+    """Pipeline of albumentations transforms applied to an image and its mask.
+
+    The pipeline is compiled once per thread and recompiled only after `add`, and calls keep no state on the instance,
+    so one Augmentation can be shared by several threads. Besides albumentations transforms, a GeometricWarp can be
+    added to run all the geometric transforms in a single pass.
+    """
+
+    def __init__(self, channel_mode=None):
+        """
+        Arguments
+        ---------
+        channel_mode: layout of the output images (see src.data.factory.CHANNEL_MODES). By default, images keep the
+            layout of the input, so single-channel images are augmented and returned with a single channel.
+        """
+        self.channel_mode = channel_mode
         self.augmenters = []
-        self.mask_shape = None
-        self.image_shape = None
+        self._version = 0
+        self._local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
 
-    def __call__(self, image, mask):
-        self.mask_shape = mask.shape  # [height, width]
-        self.image_shape = image.shape  # [height, width, 3]
-        return self._transform(image, mask)
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
 
-    def _transform(self, image, mask):
-        transformation = A.Compose(transforms=self.augmenters)
-        transformed = transformation(image=image, mask=mask)
+    def __call__(self, image, mask, seed=None):
+        """Augment an image and its mask. With a seed, the result is reproducible."""
+        return self._transform(image, mask, seed)
+
+    def _get_transformation(self):
+        # Each thread owns a copy, the random generators of a pipeline are not thread-safe. Consecutive albumentations
+        # transforms are composed into a single stage, a GeometricWarp is a stage on its own.
+        local = self._local
+        if getattr(local, "version", None) != self._version:
+            stages = []
+            for augmenter in copy.deepcopy(self.augmenters):
+                if isinstance(augmenter, GeometricWarp):
+                    stages.append(augmenter)
+                elif stages and isinstance(stages[-1], list):
+                    stages[-1].append(augmenter)
+                else:
+                    stages.append([augmenter])
+            local.transformation = [
+                stage if isinstance(stage, GeometricWarp) else A.Compose(stage)
+                for stage in stages
+            ]
+            local.rng = np.random.default_rng()
+            local.version = self._version
+        return local.transformation
+
+    def _transform(self, image, mask, seed=None):
+        image_transformed, mask_transformed = image, mask
+        for k, stage in enumerate(self._get_transformation()):
+            if isinstance(stage, GeometricWarp):
+                rng = (
+                    self._local.rng
+                    if seed is None
+                    else np.random.default_rng([seed, k])
+                )
+                image_transformed, mask_transformed = stage(
+                    image_transformed, mask_transformed, rng
+                )
+                continue
+            if seed is None:
+                transformed = stage(image=image_transformed, mask=mask_transformed)
+            elif hasattr(stage, "set_random_seed"):
+                stage.set_random_seed(seed)
+                transformed = stage(image=image_transformed, mask=mask_transformed)
+            else:
+                # Older versions draw from the global generators, so seeded calls run one at a time
+                with _global_random_lock:
+                    random.seed(seed)
+                    np.random.seed(seed)
+                    transformed = stage(image=image_transformed, mask=mask_transformed)
+            image_transformed, mask_transformed = (
+                transformed["image"],
+                transformed["mask"],
+            )
         # Reshape the image for consistency
-        image_transformed = transformed["image"].reshape(self.image_shape)
+        image_transformed = image_transformed.reshape(image.shape)
         # This output mask have an extra dimension (h, w, 1), then, is needed to reshape the mask to the original shape
         # before output it.
-        mask_transformed = transformed["mask"].reshape(self.mask_shape)
+        mask_transformed = mask_transformed.reshape(mask.shape)
+        if self.channel_mode is not None:
+            image_transformed = convert_channels(image_transformed, self.channel_mode)
         return image_transformed, mask_transformed
 
+    def augment_batch(self, images, masks, workers=4, seed=None):
+        """Augment a batch of images and masks in parallel.
+
+        Each sample gets its own seed derived from seed, so the result does not depend on the number of workers.
+
+        Args:
+            images: A [N,H,W,C] array or a list of images.
+            masks: A [N,H,W] or [N,H,W,1] array or a list of masks.
+            workers (int): Number of threads. OpenCV releases the GIL, so threads run the transforms in parallel.
+            seed (int): Seed of the batch. Default: None, the batch is not reproducible.
+
+        Returns:
+            The augmented images and masks, stacked into arrays if the inputs were arrays.
+        """
+        if len(images) != len(masks):
+            raise ValueError("The batch must have as many images as masks.")
+        if seed is None:
+            seeds = [None] * len(images)
+        else:
+            seeds = [
+                int(child.generate_state(1)[0])
+                for child in np.random.SeedSequence(seed).spawn(len(images))
+            ]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            samples = list(executor.map(self._transform, images, masks, seeds))
+        images_transformed = [image for image, _ in samples]
+        masks_transformed = [mask for _, mask in samples]
+        if isinstance(images, np.ndarray) and isinstance(masks, np.ndarray):
+            return np.stack(images_transformed), np.stack(masks_transformed)
+        return images_transformed, masks_transformed
+
+    @staticmethod
+    def fused_geometry(
+        height=650,
+        width=1250,
+        height_max=663,
+        width_max=1275,
+        p_jitter=0.7,
+        p_horizontal_flip=0.5,
+        p_vertical_flip=0.25,
+        limit_min=-45,
+        limit_max=45,
+        p_rotation=0.5,
+    ):
+        """Random jitter, horizontal and vertical flips and rotation, in this order, fused into a single warp. Takes
+        the arguments of those augmenters, see GeometricWarp."""
+        return GeometricWarp(
+            jitter_scale=(height_max / height, width_max / width),
+            p_jitter=p_jitter,
+            p_horizontal_flip=p_horizontal_flip,
+            p_vertical_flip=p_vertical_flip,
+            rotation_limit=(limit_min, limit_max),
+            p_rotation=p_rotation,
+        )
+
     @staticmethod
     def random_jitter(height=650, width=1250, height_max=663, width_max=1275, p=0.7):
         """Resize up the input and crops a randomly part of it using its original size."""
@@ -71,3 +210,126 @@ class Augmentation:
 
     def add(self, x):
         self.augmenters.extend([x])
+        self._version += 1
+
+
+class GeometricWarp:
+    """Geometric augmentation that composes random jitter, flips and rotation into one affine matrix per sample.
+
+    The image is warped once with bilinear interpolation and the mask once with nearest neighbour, instead of a full
+    pass per augmenter. The parameters are drawn as random_jitter, horizontal_flip, vertical_flip and rotation draw
+    them: the jitter upscales the frame by jitter_scale and crops a random window of the original size, flips mirror
+    the frame, and the rotation turns it around its center by an angle drawn uniformly from rotation_limit. There are
+    two differences: the jitter interpolates bilinearly instead of by area, which are close for such small scales, and
+    the corners uncovered by a rotation after a jitter take the pixels of the input around the crop before the border
+    is reflected.
+
+    The jitter of the mask samples the pixels that cv2.resize with INTER_NEAREST samples, so a jittered mask is the
+    same as with random_jitter for the default scale. At other scales, pixels whose source coordinate falls exactly on
+    a pixel edge may be taken from the neighbouring pixel, since cv2.resize rounds them in floating point.
+
+    Add it to an Augmentation in place of those augmenters, see Augmentation.fused_geometry.
+    """
+
+    def __init__(
+        self,
+        jitter_scale=(663 / 650, 1275 / 1250),
+        p_jitter=0.7,
+        p_horizontal_flip=0.5,
+        p_vertical_flip=0.25,
+        rotation_limit=(-45, 45),
+        p_rotation=0.5,
+        border_mode=cv2.BORDER_REFLECT_101,
+    ):
+        """
+        Arguments
+        ---------
+        jitter_scale: (vertical, horizontal) upscaling of the jitter before cropping.
+        p_jitter, p_horizontal_flip, p_vertical_flip, p_rotation: probabilities of each transform.
+        rotation_limit: (min, max) angle of the rotation in degrees.
+        border_mode: OpenCV border mode of the rotated areas out of the frame, of both the image and the mask.
+        """
+        self.jitter_scale = jitter_scale
+        self.p_jitter = p_jitter
+        self.p_horizontal_flip = p_horizontal_flip
+        self.p_vertical_flip = p_vertical_flip
+        self.rotation_limit = rotation_limit
+        self.p_rotation = p_rotation
+        self.border_mode = border_mode
+
+    def get_matrices(self, height, width, rng):
+        """Draw the transforms of a sample and return the 3x3 matrices that map input to output pixel coordinates of
+        the image and of the mask, or None if no transform was drawn.
+
+        They only differ in the jitter: the image is resized mapping pixel centers, as bilinear and area resizing do,
+        and the mask mapping pixel corners, as nearest neighbour resizing does.
+        """
+        matrix = np.eye(3)
+        mask_matrix = np.eye(3)
+        drawn = False
+        if rng.random() < self.p_jitter:
+            resized_height = int(round(height * self.jitter_scale[0]))
+            resized_width = int(round(width * self.jitter_scale[1]))
+            y0 = rng.integers(0, resized_height - height + 1)
+            x0 = rng.integers(0, resized_width - width + 1)
+            sy = resized_height / height
+            sx = resized_width / width
+            # Resize maps pixel centers, (x + 0.5) * scale - 0.5, then the crop shifts the window to the origin
+            matrix = np.array(
+                [
+                    [sx, 0, 0.5 * sx - 0.5 - x0],
+                    [0, sy, 0.5 * sy - 0.5 - y0],
+                    [0, 0, 1],
+                ]
+            )
+            # cv2.resize with INTER_NEAREST takes the source pixel floor(x / scale). The warp rounds the source
+            # coordinate, so it is moved by half a pixel, minus a margin for the fixed-point arithmetic of the warp.
+            mask_matrix = np.array(
+                [
+                    [sx, 0, (0.5 - _NEAREST_MARGIN) * sx - x0],
+                    [0, sy, (0.5 - _NEAREST_MARGIN) * sy - y0],
+                    [0, 0, 1],
+                ]
+            )
+            drawn = True
+        transforms = []
+        if rng.random() < self.p_horizontal_flip:
+            transforms.append(np.array([[-1, 0, width - 1], [0, 1, 0], [0, 0, 1]]))
+        if rng.random() < self.p_vertical_flip:
+            transforms.append(np.array([[1, 0, 0], [0, -1, height - 1], [0, 0, 1]]))
+        if rng.random() < self.p_rotation:
+            angle = rng.uniform(*self.rotation_limit)
+            rotation = cv2.getRotationMatrix2D(
+                (width / 2 - 0.5, height / 2 - 0.5), angle, 1.0
+            )
+            transforms.append(np.vstack([rotation, [0, 0, 1]]))
+        for transform in transforms:
+            matrix = transform @ matrix
+            mask_matrix = transform @ mask_matrix
+        if not drawn and not transforms:
+            return None
+        return matrix, mask_matrix
+
+    def __call__(self, image, mask, rng=None):
+        """Warp an image and its mask with transforms drawn from rng, a NumPy Generator."""
+        rng = np.random.default_rng() if rng is None else rng
+        height, width = image.shape[:2]
+        matrices = self.get_matrices(height, width, rng)
+        if matrices is None:
+            return image, mask
+        matrix, mask_matrix = matrices
+        image_warped = cv2.warpAffine(
+            image,
+            matrix[:2],
+            (width, height),
+            flags=cv2.INTER_LINEAR,
+            borderMode=self.border_mode,
+        ).reshape(image.shape)
+        mask_warped = cv2.warpAffine(
+            mask,
+            mask_matrix[:2],
+            (width, height),
+            flags=cv2.INTER_NEAREST,
+            borderMode=self.border_mode,
+        ).reshape(mask.shape)
+        return image_warped, mask_warped
@@ -0,0 +1,271 @@
+"""
+Index
+Compiled, columnar index of a COCO annotation file that is saved next to it and loaded without parsing the JSON.
+
+Copyright (c) 2022 Juan Carlos Cedeño Noblecilla
+
+This software is released under the MIT License.
+https://opensource.org/licenses/MIT
+Written by Juan Carlos Cedeño Noblecilla.
+"""
+
+import json
+import os
+from collections.abc import Sequence
+
+import numpy as np
+
+from src.coco.streaming import iter_coco_records
+from src.utils.miscellaneous import hash_file
+
+# Kinds of segmentation stored in the index
+RLE_SEGMENTATION = 0  # Compressed RLE, the counts string is stored
+JSON_SEGMENTATION = 1  # Polygons or uncompressed RLE, the JSON text is stored
+
+
+def get_index_filepath(annotations_filepath):
+    """Return the path of the index of an annotation file, e.g. annotations.index.npz for annotations.json."""
+    return os.path.splitext(annotations_filepath)[0] + ".index.npz"
+
+
+class AnnotationList(Sequence):
+    """Read-only list of the annotations of an image. Each annotation dictionary is built when it is accessed."""
+
+    def __init__(self, index, rows):
+        self.index = index
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return AnnotationList(self.index, self.rows[k])
+        return self.index.get_annotation(self.rows[k])
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class COCOIndex:
+    """Columnar index of a COCO annotation file.
+
+    Annotations are sorted by image, so the annotations of an image are a slice of the arrays. The index also keeps
+    the images of each category and the metadata of every image. It is saved as an .npz file next to the annotation
+    file together with its size, modification time and SHA-1 hash, and it is rebuilt when the file changes.
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.categories = json.loads(str(arrays["categories"]))
+        self.image_ids = arrays["image_ids"]
+        self.file_names = arrays["file_names"]
+        self.widths = arrays["widths"]
+        self.heights = arrays["heights"]
+        self.annotation_offsets = arrays["annotation_offsets"]
+        self.annotation_ids = arrays["annotation_ids"]
+        self.category_ids = arrays["category_ids"]
+        self.iscrowd = arrays["iscrowd"]
+        self.areas = arrays["areas"]
+        self.bboxes = arrays["bboxes"]
+        self.segmentation_kinds = arrays["segmentation_kinds"]
+        self.segmentation_sizes = arrays["segmentation_sizes"]
+        self.segmentation_offsets = arrays["segmentation_offsets"]
+        self.segmentation_blob = arrays["segmentation_blob"].tobytes()
+        self.category_image_offsets = arrays["category_image_offsets"]
+        self.category_images = arrays["category_images"]
+
+    @classmethod
+    def build(cls, annotations_filepath):
+        """Compile the index of an annotation file."""
+        categories = []
+        images = []
+        annotations = []
+        for key, record in iter_coco_records(annotations_filepath):
+            if key == "categories":
+                categories = record
+            elif key == "images":
+                images.append(record)
+            elif key == "annotations":
+                annotations.append(record)
+        image_index = {image["id"]: i for i, image in enumerate(images)}
+        # Sort annotations by image, keeping the order of the file inside each image
+        annotations.sort(key=lambda annotation: image_index[annotation["image_id"]])
+        counts = np.bincount(
+            [image_index[annotation["image_id"]] for annotation in annotations],
+            minlength=len(images),
+        )
+        segmentations = []
+        kinds = []
+        sizes = []
+        for annotation in annotations:
+            segmentation = annotation["segmentation"]
+            if isinstance(segmentation, dict) and not isinstance(
+                segmentation["counts"], list
+            ):
+                kinds.append(RLE_SEGMENTATION)
+                sizes.append(segmentation["size"])
+                counts_string = segmentation["counts"]
+                if isinstance(counts_string, bytes):
+                    counts_string = counts_string.decode("ascii")
+                segmentations.append(counts_string.encode("ascii"))
+            else:
+                kinds.append(JSON_SEGMENTATION)
+                sizes.append([0, 0])
+                segmentations.append(json.dumps(segmentation).encode("utf-8"))
+        # Images of each category, as sorted image positions
+        category_ids = [annotation["category_id"] for annotation in annotations]
+        annotation_images = np.repeat(np.arange(len(images)), counts)
+        category_images = []
+        category_image_offsets = [0]
+        for category in categories:
+            rows = np.asarray(category_ids) == category["id"]
+            category_images.append(np.unique(annotation_images[rows]))
+            category_image_offsets.append(
+                category_image_offsets[-1] + len(category_images[-1])
+            )
+        areas = [annotation["area"] for annotation in annotations]
+        bboxes = [annotation["bbox"] for annotation in annotations]
+        arrays = {
+            "categories": np.array(json.dumps(categories)),
+            "image_ids": np.array([image["id"] for image in images], dtype=np.int64),
+            "file_names": np.array([image["file_name"] for image in images]),
+            "widths": np.array([image["width"] for image in images], dtype=np.int64),
+            "heights": np.array([image["height"] for image in images], dtype=np.int64),
+            "annotation_offsets": np.concatenate([[0], np.cumsum(counts)]).astype(
+                np.int64
+            ),
+            "annotation_ids": np.array(
+                [annotation["id"] for annotation in annotations], dtype=np.int64
+            ),
+            "category_ids": np.array(category_ids, dtype=np.int64),
+            "iscrowd": np.array(
+                [annotation.get("iscrowd", 0) for annotation in annotations],
+                dtype=np.int64,
+            ),
+            # Keep integer areas and boxes as integers
+            "areas": np.array(areas) if areas else np.zeros(0, dtype=np.int64),
+            "bboxes": np.array(bboxes).reshape(-1, 4),
+            "segmentation_kinds": np.array(kinds, dtype=np.uint8),
+            "segmentation_sizes": np.array(sizes, dtype=np.int64).reshape(-1, 2),
+            "segmentation_offsets": np.concatenate(
+                [[0], np.cumsum([len(s) for s in segmentations])]
+            ).astype(np.int64),
+            "segmentation_blob": np.frombuffer(b"".join(segmentations), dtype=np.uint8),
+            "category_image_offsets": np.array(category_image_offsets, dtype=np.int64),
+            "category_images": (
+                np.concatenate(category_images).astype(np.int64)
+                if category_images
+                else np.zeros(0, dtype=np.int64)
+            ),
+        }
+        return cls(arrays)
+
+    def save(self, index_filepath, fingerprint):
+        """Save the index with the fingerprint of its annotation file."""
+        tmp_filepath = index_filepath + ".tmp.npz"
+        np.savez(
+            tmp_filepath, fingerprint=np.array(json.dumps(fingerprint)), **self.arrays
+        )
+        os.replace(tmp_filepath, index_filepath)
+
+    def try_save(self, index_filepath, fingerprint):
+        """Save the index like save, but keep it only in memory if the directory is not writable."""
+        try:
+            self.save(index_filepath, fingerprint)
+        except OSError as error:
+            print(
+                "The index could not be saved, it is kept in memory: {}".format(error)
+            )
+            try:
+                os.remove(index_filepath + ".tmp.npz")
+            except OSError:
+                pass
+
+    @classmethod
+    def load(cls, annotations_filepath):
+        """Load the index of an annotation file, compiling and saving it first if it is missing or out of date.
+
+        On a read-only dataset directory, the compiled index is only kept in memory.
+        """
+        index_filepath = get_index_filepath(annotations_filepath)
+        stat = os.stat(annotations_filepath)
+        fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        if os.path.exists(index_filepath):
+            with np.load(index_filepath) as npz:
+                arrays = dict(npz)
+            saved = json.loads(str(arrays.pop("fingerprint")))
+            if saved["size"] == fingerprint["size"]:
+                if saved["mtime_ns"] == fingerprint["mtime_ns"]:
+                    return cls(arrays)
+                # Touched or copied, but maybe with the same content
+                fingerprint["sha1"] = hash_file(annotations_filepath)
+                if saved["sha1"] == fingerprint["sha1"]:
+                    index = cls(arrays)
+                    index.try_save(index_filepath, fingerprint)
+                    return index
+        print("Compiling index of: {}".format(annotations_filepath))
+        if "sha1" not in fingerprint:
+            fingerprint["sha1"] = hash_file(annotations_filepath)
+        index = cls.build(annotations_filepath)
+        index.try_save(index_filepath, fingerprint)
+        return index
+
+    def get_cat_ids(self):
+        return [category["id"] for category in self.categories]
+
+    def get_category(self, category_id):
+        for category in self.categories:
+            if category["id"] == category_id:
+                return category
+        raise KeyError(category_id)
+
+    def get_image_positions(self, category_ids=None):
+        """Return the sorted positions of the images with annotations of any of the categories, or of all images."""
+        if category_ids is None:
+            return np.arange(len(self.image_ids))
+        positions = []
+        for c, category in enumerate(self.categories):
+            if category["id"] in category_ids:
+                positions.append(
+                    self.category_images[
+                        self.category_image_offsets[c] : self.category_image_offsets[
+                            c + 1
+                        ]
+                    ]
+                )
+        if not positions:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(positions))
+
+    def get_annotations(self, position, category_ids=None):
+        """Return the annotations of the image at a position, optionally filtered by category."""
+        rows = np.arange(
+            self.annotation_offsets[position], self.annotation_offsets[position + 1]
+        )
+        if category_ids is not None:
+            rows = rows[np.isin(self.category_ids[rows], list(category_ids))]
+        return AnnotationList(self, rows)
+
+    def get_annotation(self, row):
+        """Build the annotation dictionary of a row."""
+        position = np.searchsorted(self.annotation_offsets, row, side="right") - 1
+        start = self.segmentation_offsets[row]
+        end = self.segmentation_offsets[row + 1]
+        text = self.segmentation_blob[start:end].decode("utf-8")
+        if self.segmentation_kinds[row] == RLE_SEGMENTATION:
+            segmentation = {
+                "counts": text,
+                "size": self.segmentation_sizes[row].tolist(),
+            }
+        else:
+            segmentation = json.loads(text)
+        return {
+            "id": int(self.annotation_ids[row]),
+            "image_id": int(self.image_ids[position]),
+            "category_id": int(self.category_ids[row]),
+            "segmentation": segmentation,
+            "area": self.areas[row].item(),
+            "bbox": self.bboxes[row].tolist(),
+            "iscrowd": int(self.iscrowd[row]),
+        }
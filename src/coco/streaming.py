@@ -0,0 +1,357 @@
+"""
+Streaming
+Incremental writers and readers of COCO annotation and results files.
+
+Copyright (c) 2022 Juan Carlos Cedeño Noblecilla
+
+This software is released under the MIT License.
+https://opensource.org/licenses/MIT
+Written by Juan Carlos Cedeño Noblecilla.
+"""
+
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+import six
+
+from src.coco.wrappers import COCOWrapper
+
+# Keys of a COCO dataset that are written before the images and annotations
+HEADER_KEYS = ["info", "licenses", "categories"]
+
+
+class COCOStreamWriter:
+    """Write a COCO annotation file incrementally.
+
+    Images and annotations are written to disk as soon as they are added, so the memory does not grow with the size
+    of the dataset. Annotations are spooled to a temporary file that is appended after the images on close, and the
+    output file is replaced only when the writer is closed without errors.
+
+    With indent=None (default) the file is compact and holds one image or annotation per line. This layout is read
+    record by record with `iter_coco_records`.
+    """
+
+    def __init__(
+        self, filepath, info=None, licenses=None, categories=None, indent=None
+    ):
+        """
+        Arguments
+        ---------
+        filepath: path of the output annotations file.
+        info: a dictionary with the information of the dataset.
+        licenses: a list of license dictionaries.
+        categories: a list of category dictionaries.
+        indent: indentation level of the JSON file. None writes a compact file.
+        """
+        self.filepath = filepath
+        self.indent = indent
+        self.separators = (",", ":") if indent is None else (",", ": ")
+        self.num_images = 0
+        self.num_annotations = 0
+        header = {
+            "info": info or {},
+            "licenses": licenses or [],
+            "categories": categories or [],
+        }
+        self._images_file = open(filepath + ".images.tmp", "w")
+        self._annotations_file = open(filepath + ".annotations.tmp", "w")
+        # Drop the closing brace of the header to continue with the images
+        self._images_file.write(self._dumps(header).rstrip()[:-1].rstrip())
+        self._images_file.write(',"images":[')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _dumps(self, record):
+        return json.dumps(
+            record, indent=self.indent, separators=self.separators, sort_keys=True
+        )
+
+    @staticmethod
+    def _write(file, record, first):
+        file.write("\n" if first else ",\n")
+        file.write(record)
+
+    def add_image(self, image):
+        """Write an image dictionary."""
+        self._write(self._images_file, self._dumps(image), self.num_images == 0)
+        self.num_images += 1
+
+    def add_annotation(self, annotation):
+        """Write an annotation dictionary."""
+        self._write(
+            self._annotations_file, self._dumps(annotation), self.num_annotations == 0
+        )
+        self.num_annotations += 1
+
+    def close(self):
+        """Merge images and annotations into the output file."""
+        self._annotations_file.close()
+        self._images_file.write('\n],"annotations":[')
+        with open(self._annotations_file.name, "r") as file:
+            shutil.copyfileobj(file, self._images_file)
+        self._images_file.write("\n]}\n")
+        self._images_file.close()
+        os.replace(self._images_file.name, self.filepath)
+        os.remove(self._annotations_file.name)
+
+    def abort(self):
+        """Discard everything written so far. The output file is left untouched."""
+        for file in [self._images_file, self._annotations_file]:
+            file.close()
+            if os.path.exists(file.name):
+                os.remove(file.name)
+
+
+def iter_coco_records(filepath, chunk_size=4096):
+    """Yield (key, record) pairs of a COCO annotation file, where key is one of "info", "licenses", "categories",
+    "images" or "annotations". Images and annotations are yielded one by one.
+
+    Files written by `COCOStreamWriter` in compact mode are read in chunks of `chunk_size` lines, so the memory used
+    to parse them does not grow with the size of the file. Any other file is parsed as a whole with `json.load`.
+    """
+    with open(filepath, "r") as file:
+        line = file.readline().rstrip("\n")
+        if not line.endswith(',"images":['):
+            file.seek(0)
+            dataset = json.load(file)
+            for key in HEADER_KEYS:
+                if key in dataset:
+                    yield key, dataset[key]
+            for key in ["images", "annotations"]:
+                for record in dataset.get(key, []):
+                    yield key, record
+            return
+        header = json.loads(line[: -len(',"images":[')] + "}")
+        for key in HEADER_KEYS:
+            yield key, header[key]
+        key = "images"
+        # Parse the records in chunks, a single json.loads per chunk is much faster than one per line
+        chunk = []
+        for line in file:
+            line = line.rstrip("\n")
+            if line in ['],"annotations":[', "]}"]:
+                yield from _parse_chunk(key, chunk)
+                if line == "]}":
+                    break
+                chunk = []
+                key = "annotations"
+            else:
+                chunk.append(line[:-1] if line.endswith(",") else line)
+                if len(chunk) == chunk_size:
+                    yield from _parse_chunk(key, chunk)
+                    chunk = []
+
+
+def _parse_chunk(key, lines):
+    for record in json.loads("[" + ",".join(lines) + "]"):
+        yield key, record
+
+
+def load_coco(filepath, detection_type="segm"):
+    """Load a COCO annotation file into a COCO object.
+
+    Unlike `pycocotools.coco.COCO`, the file is never read into memory as a single string when it was written by
+    `COCOStreamWriter` in compact mode, and the creation of the index is the only message printed.
+
+    Returns:
+        A COCOWrapper object.
+    """
+    dataset = {"images": [], "annotations": []}
+    for key, record in iter_coco_records(filepath):
+        if key in HEADER_KEYS:
+            dataset[key] = record
+        else:
+            dataset[key].append(record)
+    return COCOWrapper(dataset, detection_type=detection_type)
+
+
+def get_results_index_filepath(results_filepath):
+    """Return the path of the index of a results file written by COCOResultsWriter."""
+    return results_filepath + ".index.npz"
+
+
+class COCOResultsWriter:
+    """Write detection results (image_id, category_id, segmentation and/or bbox, score) incrementally.
+
+    Results are buffered until the image changes or chunk_size results are pending, and every chunk is appended to
+    the file as one compact JSON record per line. An index with the image, offset and length of each chunk is saved
+    next to the file on close, so `COCOResultsReader` loads the results of an image without reading the others. The
+    memory holds a chunk of results and four integers per chunk.
+    """
+
+    def __init__(self, filepath, chunk_size=1024):
+        """
+        Arguments
+        ---------
+        filepath: path of the output results file.
+        chunk_size: largest number of results buffered before they are written.
+        """
+        self.filepath = filepath
+        self.chunk_size = chunk_size
+        self.num_results = 0
+        self._file = open(filepath + ".tmp", "w")
+        self._pending = []
+        self._pending_image_id = None
+        self._chunks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add(self, result):
+        """Add a result dictionary."""
+        if self._pending and result["image_id"] != self._pending_image_id:
+            self.flush()
+        self._pending_image_id = result["image_id"]
+        self._pending.append(result)
+        if len(self._pending) >= self.chunk_size:
+            self.flush()
+
+    def add_results(self, results):
+        """Add a list of result dictionaries, e.g. the detections of an image."""
+        for result in results:
+            self.add(result)
+
+    def flush(self):
+        """Write the pending results as a chunk."""
+        if not self._pending:
+            return
+        lines = []
+        for result in self._pending:
+            segmentation = result.get("segmentation")
+            if isinstance(segmentation, dict) and isinstance(
+                segmentation.get("counts"), bytes
+            ):
+                result = dict(
+                    result,
+                    segmentation=dict(
+                        segmentation, counts=six.ensure_str(segmentation["counts"])
+                    ),
+                )
+            lines.append(json.dumps(result, separators=(",", ":"), sort_keys=True))
+        data = "\n".join(lines) + "\n"
+        offset = self._file.tell()
+        self._file.write(data)
+        self._chunks.append(
+            (self._pending_image_id, offset, self._file.tell() - offset, len(lines))
+        )
+        self.num_results += len(lines)
+        self._pending = []
+
+    def close(self):
+        """Write the pending results and the index, and move the file to its path."""
+        self.flush()
+        self._file.close()
+        chunks = np.array(self._chunks, dtype=np.int64).reshape(-1, 4)
+        index_filepath = get_results_index_filepath(self.filepath)
+        with open(index_filepath + ".tmp", "wb") as f:
+            np.savez(
+                f,
+                image_ids=chunks[:, 0],
+                offsets=chunks[:, 1],
+                lengths=chunks[:, 2],
+                counts=chunks[:, 3],
+            )
+        os.replace(self._file.name, self.filepath)
+        os.replace(index_filepath + ".tmp", index_filepath)
+
+    def abort(self):
+        """Discard everything written so far. The output file is left untouched."""
+        self._file.close()
+        if os.path.exists(self._file.name):
+            os.remove(self._file.name)
+
+
+class COCOResultsReader:
+    """Read the results written by COCOResultsWriter, one image at a time.
+
+    The results file stays open until close() is called, or the reader is used as a context manager.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._file = open(filepath, "rb")
+        self._lock = threading.Lock()
+        with np.load(get_results_index_filepath(filepath)) as index:
+            image_ids = index["image_ids"]
+            # Chunks of the same image are contiguous after a stable sort, in the order they were written
+            order = np.argsort(image_ids, kind="stable")
+            self._chunk_image_ids = image_ids[order]
+            self._offsets = index["offsets"][order]
+            self._lengths = index["lengths"][order]
+            self._counts = index["counts"][order]
+        self.image_ids = np.unique(self._chunk_image_ids).tolist()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the results file."""
+        self._file.close()
+
+    def __len__(self):
+        """Number of results."""
+        return int(self._counts.sum())
+
+    def __iter__(self):
+        """Yield (image_id, results) pairs, sorted by image ID."""
+        for image_id in self.image_ids:
+            yield image_id, self.load(image_id)
+
+    def load(self, image_id):
+        """Return the list of results of an image."""
+        start = np.searchsorted(self._chunk_image_ids, image_id, side="left")
+        end = np.searchsorted(self._chunk_image_ids, image_id, side="right")
+        lines = []
+        with self._lock:
+            for offset, length in zip(
+                self._offsets[start:end].tolist(), self._lengths[start:end].tolist()
+            ):
+                self._file.seek(offset)
+                lines.append(self._file.read(length).rstrip(b"\n").replace(b"\n", b","))
+        if not lines:
+            return []
+        return json.loads(b"[" + b",".join(lines) + b"]")
+
+    def load_res(self, coco_gt, image_ids=None):
+        """Load the results of some images (default: all) into a COCO object, as `coco_gt.loadRes` does.
+
+        The metrics of COCOeval over several subsets of images cannot be combined into the metrics of the dataset, so
+        evaluate all the images at once.
+        """
+        image_ids = self.image_ids if image_ids is None else image_ids
+        results = [result for image_id in image_ids for result in self.load(image_id)]
+        if not results:
+            raise ValueError("There are no results for these images.")
+        return coco_gt.loadRes(results)
+
+    def export(self, filepath):
+        """Write all the results as a COCO results file (a JSON list), one image at a time."""
+        with open(filepath + ".tmp", "w") as f:
+            f.write("[")
+            first = True
+            for _, results in self:
+                for result in results:
+                    f.write("\n" if first else ",\n")
+                    f.write(json.dumps(result, separators=(",", ":"), sort_keys=True))
+                    first = False
+            f.write("\n]\n")
+        os.replace(filepath + ".tmp", filepath)
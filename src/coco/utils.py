@@ -20,6 +20,150 @@ def encode_mask(mask, dtype=np.uint8):
     return rle
 
 
+def encode_mask_crop(crop, x, y, height, width):
+    """Encodes a crop of a binary mask using the RLE format of the full mask.
+
+    The result is the same as calling `encode_mask` on a [height, width] mask that is empty outside the crop, but
+    the full-frame mask is never allocated, so the cost depends on the size of the crop only.
+
+    Args:
+        crop (np.ndarray): A binary numpy array of shape [crop_height, crop_width].
+        x (int): Column of the upper-left corner of the crop in the full mask.
+        y (int): Row of the upper-left corner of the crop in the full mask.
+        height (int): Height of the full mask.
+        width (int): Width of the full mask.
+
+    Returns:
+        A dictionary that can be stored in COCO format.
+    """
+    crop_height = crop.shape[0]
+    # Pad every column with zeros, so runs never cross from one column to the next one
+    padded = np.zeros((crop_height + 2, crop.shape[1]), dtype=np.int8)
+    padded[1:-1] = crop != 0
+    # Runs of ones in column-major order (as COCO does), `ends` is exclusive
+    changes = np.diff(padded.ravel(order="F"))
+    starts = np.flatnonzero(changes == 1) + 1
+    ends = np.flatnonzero(changes == -1) + 1
+    # Map the padded indices to indices of the full mask
+    cols, rows = np.divmod(starts, crop_height + 2)
+    starts = (x + cols) * height + y + rows - 1
+    cols, rows = np.divmod(ends, crop_height + 2)
+    ends = (x + cols) * height + y + rows - 1
+    # A run that ends at the last row may continue at the first row of the next column
+    keep = starts[1:] != ends[:-1]
+    starts = np.concatenate([starts[:1], starts[1:][keep]])
+    ends = np.concatenate([ends[:-1][keep], ends[-1:]])
+    return _encode_runs(starts, ends, height, width)
+
+
+def encode_label_image(labels, component_ids=None):
+    """Encodes the mask of every component of a label image using the RLE format, with its area and bounding box.
+
+    The label image is flattened in column-major order (as COCO does) once, and its runs are split by label, so the
+    cost is one pass over the image plus the number of runs. Each RLE is the same as calling `encode_mask` on
+    `labels == component_id`, and area and bounding box are computed from the runs instead of decoding the RLE again.
+
+    Args:
+        labels (np.ndarray): An integer numpy array of shape [height, width], e.g. from cv2.connectedComponents.
+        component_ids (list[int]): Labels to encode. Default: every label but 0, in ascending order.
+
+    Returns:
+        A list with a (encoded_mask, area, bbox) tuple per component, where bbox is a [x_min, y_min, width, height]
+        list, as `area_from_encoded_mask` and `bbox_from_encoded_mask` compute them.
+    """
+    height, width = labels.shape[:2]
+    flat = np.asarray(labels).ravel(order="F")
+    boundaries = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    starts = np.concatenate([[0], boundaries])
+    ends = np.concatenate([boundaries, [flat.size]])
+    run_labels = flat[starts]
+    if component_ids is None:
+        component_ids = np.unique(run_labels)
+        component_ids = component_ids[component_ids != 0]
+    # Group the runs by label, keeping them in column-major order
+    order = np.argsort(run_labels, kind="stable")
+    sorted_labels = run_labels[order]
+    component_ids = np.asarray(component_ids)
+    lefts = np.searchsorted(sorted_labels, component_ids, side="left")
+    rights = np.searchsorted(sorted_labels, component_ids, side="right")
+    results = []
+    for left, right in zip(lefts.tolist(), rights.tolist()):
+        runs = order[left:right]
+        component_starts = starts[runs]
+        component_ends = ends[runs]
+        encoded_mask = _encode_runs(component_starts, component_ends, height, width)
+        area = int((component_ends - component_starts).sum())
+        if area == 0:
+            results.append((encoded_mask, 0, [0, 0, 0, 0]))
+            continue
+        first_cols, first_rows = np.divmod(component_starts, height)
+        last_cols, last_rows = np.divmod(component_ends - 1, height)
+        # A run across columns covers the last row of its first column and the first row of the next one
+        across = last_cols > first_cols
+        x_min = int(first_cols.min())
+        y_min = int(np.where(across, 0, first_rows).min())
+        x_max = int(last_cols.max())
+        y_max = int(np.where(across, height - 1, last_rows).max())
+        results.append(
+            (encoded_mask, area, [x_min, y_min, x_max - x_min + 1, y_max - y_min + 1])
+        )
+    return results
+
+
+def _encode_runs(starts, ends, height, width):
+    """Encodes the runs of ones [start, end) of a column-major [height, width] mask using the RLE format."""
+    runs = np.empty(2 * len(starts) + 2, dtype=np.int64)
+    runs[0] = 0
+    runs[1:-1:2] = starts
+    runs[2:-1:2] = ends
+    runs[-1] = height * width
+    counts = np.diff(runs)
+    # COCO does not store an empty run of zeros at the end
+    if counts[-1] == 0:
+        counts = counts[:-1]
+    rle = mask_utils.frPyObjects(
+        {"counts": counts.tolist(), "size": [height, width]}, height, width
+    )
+    rle["counts"] = six.ensure_str(rle["counts"])
+    return rle
+
+
+def counts_from_encoded_mask(encoded_mask):
+    """Decodes the run lengths of an encoded mask.
+
+    The runs alternate between zeros and ones in column-major order, starting with zeros. Compressed counts are
+    decoded with NumPy, without building the binary mask.
+
+    Args:
+        encoded_mask (dict): A dictionary that can be stored in COCO format.
+
+    Returns:
+        A 1-D int64 array with the length of every run.
+    """
+    counts = encoded_mask["counts"]
+    if isinstance(counts, list):
+        # Uncompressed RLE
+        return np.array(counts, dtype=np.int64)
+    chars = (
+        np.frombuffer(six.ensure_binary(counts), dtype=np.uint8).astype(np.int64) - 48
+    )
+    if len(chars) == 0:
+        return np.zeros(0, dtype=np.int64)
+    # Every count is a group of 5-bit chunks, least significant first; a chunk without the 0x20 bit ends the group
+    last = (chars & 0x20) == 0
+    group = np.concatenate([[0], np.cumsum(last)[:-1]])
+    group_start = np.flatnonzero(np.concatenate([[True], last[:-1]]))
+    shift = 5 * (np.arange(len(chars)) - group_start[group])
+    values = np.bincount(group, weights=(chars & 0x1F) << shift).astype(np.int64)
+    # The 0x10 bit of the last chunk is the sign
+    negative = (chars[last] & 0x10) != 0
+    values[negative] -= np.int64(1) << (shift[last][negative] + 5)
+    # From the fourth count on, counts are stored as differences with the count two positions before
+    values[1::2] = np.cumsum(values[1::2])
+    values[2::2] = np.cumsum(values[2::2])
+    return values
+
+
 def area_from_encoded_mask(encoded_mask):
     """Computes area of an encoded mask.
 
@@ -42,3 +186,84 @@ def bbox_from_encoded_mask(encoded_mask):
         A list of bounding box coordinates in the format [x_min, y_min, width, height].
     """
     return mask_utils.toBbox(encoded_mask)
+
+
+def _paint_runs(encoded_masks, values, height, width, x=0, w=None):
+    """Paint the ones of every encoded mask with its value into a [height, w] band of columns starting at x.
+
+    The runs are accumulated as +value/-value steps and summed up once, so the cost is one pass over the band plus
+    the number of runs. The masks must not overlap.
+    """
+    w = width - x if w is None else w
+    offset, size = x * height, w * height
+    steps = np.zeros(size + 1, dtype=np.int32)
+    for encoded_mask, value in zip(encoded_masks, values):
+        ends = np.cumsum(counts_from_encoded_mask(encoded_mask))
+        stops = ends[1::2]
+        starts = ends[0::2][: len(stops)]
+        np.add.at(steps, np.clip(starts - offset, 0, size), value)
+        np.add.at(steps, np.clip(stops - offset, 0, size), -value)
+    return np.cumsum(steps[:-1], dtype=np.int32).reshape(w, height).T
+
+
+class InstanceMasks:
+    """Instance masks of an image that are decoded only when they are accessed.
+
+    `masks[k]` decodes the k-th mask as a [height, width] bool array, `crop(k)` decodes only its bounding box, and
+    `label_map()` paints all of them into a single class map without decoding them one by one.
+    """
+
+    def __init__(self, encoded_masks, class_ids, height, width):
+        """
+        Arguments
+        ---------
+        encoded_masks: a list of RLE dictionaries in COCO format.
+        class_ids: a 1-D array with the class ID of every instance.
+        height: height of the image.
+        width: width of the image.
+        """
+        self.encoded_masks = encoded_masks
+        self.class_ids = np.asarray(class_ids, dtype=np.int32)
+        self.height = height
+        self.width = width
+
+    def __len__(self):
+        return len(self.encoded_masks)
+
+    def __getitem__(self, k):
+        return mask_utils.decode(self.encoded_masks[k]).astype(bool)
+
+    def bbox(self, k):
+        """Bounding box of the k-th instance as [x_min, y_min, width, height]."""
+        return bbox_from_encoded_mask(self.encoded_masks[k]).astype(int).tolist()
+
+    def crop(self, k):
+        """Decode the k-th instance inside its bounding box.
+
+        Returns:
+            A [bbox height, bbox width] bool array and the bounding box.
+        """
+        x, y, w, h = self.bbox(k)
+        band = _paint_runs([self.encoded_masks[k]], [1], self.height, self.width, x, w)
+        return band[y : y + h].astype(bool), [x, y, w, h]
+
+    def stack(self):
+        """Decode all the instances into a [height, width, instance count] bool array, as load_mask does."""
+        masks = np.zeros([self.height, self.width, len(self)], dtype=bool)
+        for k in range(len(self)):
+            masks[..., k] = self[k]
+        return masks
+
+    def label_map(self, dtype=np.uint8, values=None):
+        """Paint the class ID of every instance into a [height, width] map, 0 is the background.
+
+        Crowd instances, with negative class IDs, are painted with their absolute value. Instances must not overlap,
+        which holds for the connected components of a semantic mask. With values, e.g. the label_values of a Dataset,
+        every class ID k is painted as values[k] instead, and the background as values[0].
+        """
+        label_map = _paint_runs(
+            self.encoded_masks, np.abs(self.class_ids), self.height, self.width
+        )
+        if values is not None:
+            label_map = np.asarray(values)[label_map]
+        return np.ascontiguousarray(label_map, dtype=dtype)
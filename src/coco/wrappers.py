@@ -1,3 +1,9 @@
+import copy
+import time
+from collections import defaultdict
+from multiprocessing import Pool
+
+import numpy as np
 from pycocotools.coco import COCO
 from pycocotools.cocoeval import COCOeval
 
@@ -33,12 +39,186 @@ class COCOWrapper(COCO):
 
 
 class COCOEvalWrapper(COCOeval):
-    def __init__(self, gt=None, dt=None, iou_type="segm"):
+    """COCOeval with a faster per-image evaluation.
+
+    The greedy matching of detections to ground truth is vectorised over the IoU thresholds, and with workers > 1 the
+    images are evaluated by a process pool and merged in the same order, so `accumulate` and `summarize` give the
+    same numbers as pycocotools.
+    """
+
+    def __init__(self, gt=None, dt=None, iou_type="segm", workers=1):
         """Initialize CocoEval using coco APIs for ground truth (gt) and detections (dt).
 
         Arguments
         ---------
         gt: coco object with ground truth annotations
         dt: coco object with detection results
+        iou_type: type of evaluation, "segm" or "bbox".
+        workers: number of processes of evaluate().
         """
         super().__init__(cocoGt=gt, cocoDt=dt, iouType=iou_type)
+        self.workers = workers
+
+    def evaluate(self):
+        """Run per image evaluation on given images and store results (a list of dict) in self.evalImgs."""
+        if self.workers <= 1:
+            return super().evaluate()
+        tic = time.time()
+        print("Running per image evaluation...")
+        p = self.params
+        # add backward compatibility if useSegm is specified in params
+        if p.useSegm is not None:
+            p.iouType = "segm" if p.useSegm == 1 else "bbox"
+            print(
+                "useSegm (deprecated) is not None. Running {} evaluation".format(
+                    p.iouType
+                )
+            )
+        print("Evaluate annotation type *{}*".format(p.iouType))
+        p.imgIds = list(np.unique(p.imgIds))
+        if p.useCats:
+            p.catIds = list(np.unique(p.catIds))
+        p.maxDets = sorted(p.maxDets)
+        self.params = p
+        self._prepare()
+
+        # Split the images into contiguous chunks, several per worker to balance the load
+        chunks = [
+            chunk
+            for chunk in np.array_split(np.array(p.imgIds), self.workers * 4)
+            if len(chunk)
+        ]
+        chunk_of_image = {
+            img_id: c for c, chunk in enumerate(chunks) for img_id in chunk.tolist()
+        }
+        jobs = []
+        for chunk in chunks:
+            params = copy.deepcopy(p)
+            params.imgIds = list(chunk)
+            jobs.append((params, {}, {}))
+        for k, annotations in [(1, self._gts), (2, self._dts)]:
+            for key, value in annotations.items():
+                if key[0] in chunk_of_image:
+                    jobs[chunk_of_image[key[0]]][k][key] = value
+        with Pool(self.workers) as pool:
+            results = pool.map(_evaluate_images, jobs)
+
+        # Merge in the order of COCOeval: ious by image and category, evalImgs by category, area range and image
+        self.ious = {}
+        for ious, _ in results:
+            self.ious.update(ious)
+        num_categories = len(p.catIds) if p.useCats else 1
+        self.evalImgs = []
+        for k in range(num_categories):
+            for a in range(len(p.areaRng)):
+                for chunk, (_, eval_imgs) in zip(chunks, results):
+                    start = (k * len(p.areaRng) + a) * len(chunk)
+                    self.evalImgs.extend(eval_imgs[start : start + len(chunk)])
+        self._paramsEval = copy.deepcopy(self.params)
+        toc = time.time()
+        print("DONE (t={:0.2f}s).".format(toc - tic))
+
+    def evaluateImg(self, imgId, catId, aRng, maxDet):
+        """Perform evaluation for single category and image, as COCOeval.evaluateImg does.
+
+        Returns:
+            A dictionary with the results of the image, or None if it has no ground truth and no detections.
+        """
+        p = self.params
+        if p.useCats:
+            gt = self._gts[imgId, catId]
+            dt = self._dts[imgId, catId]
+        else:
+            gt = [_ for cId in p.catIds for _ in self._gts[imgId, cId]]
+            dt = [_ for cId in p.catIds for _ in self._dts[imgId, cId]]
+        if len(gt) == 0 and len(dt) == 0:
+            return None
+
+        for g in gt:
+            if g["ignore"] or (g["area"] < aRng[0] or g["area"] > aRng[1]):
+                g["_ignore"] = 1
+            else:
+                g["_ignore"] = 0
+
+        # sort dt highest score first, sort gt ignore last
+        gtind = np.argsort([g["_ignore"] for g in gt], kind="mergesort")
+        gt = [gt[i] for i in gtind]
+        dtind = np.argsort([-d["score"] for d in dt], kind="mergesort")
+        dt = [dt[i] for i in dtind[0:maxDet]]
+        iscrowd = np.array([int(o["iscrowd"]) for o in gt], dtype=bool)
+        # load computed ious
+        ious = (
+            self.ious[imgId, catId][:, gtind]
+            if len(self.ious[imgId, catId]) > 0
+            else self.ious[imgId, catId]
+        )
+
+        T = len(p.iouThrs)
+        G = len(gt)
+        D = len(dt)
+        gtm = np.zeros((T, G))
+        dtm = np.zeros((T, D))
+        gtIg = np.array([g["_ignore"] for g in gt])
+        dtIg = np.zeros((T, D))
+        if not len(ious) == 0:
+            gt_ids = np.array([g["id"] for g in gt])
+            thresholds = np.minimum(p.iouThrs, 1 - 1e-10)[:, np.newaxis]
+            # Ground truth that is not ignored comes first, and it is preferred to ignored one
+            groups = [gtIg == 0, gtIg == 1]
+            rows = np.arange(T)
+            for dind, d in enumerate(dt):
+                # A ground truth can be matched if it is not matched yet or it is a crowd
+                candidates = ((gtm <= 0) | iscrowd) & (ious[dind] >= thresholds)
+                m = np.full(T, -1)
+                for group in groups:
+                    in_group = candidates & group
+                    unmatched = (m == -1) & in_group.any(axis=1)
+                    # The best IoU wins, and the last one among equal IoUs, as in the loop of COCOeval
+                    scores = np.where(in_group, ious[dind], -np.inf)[:, ::-1]
+                    m[unmatched] = G - 1 - np.argmax(scores[unmatched], axis=1)
+                matched = m > -1
+                dtIg[matched, dind] = gtIg[m[matched]]
+                dtm[matched, dind] = gt_ids[m[matched]]
+                gtm[rows[matched], m[matched]] = d["id"]
+        # set unmatched detections outside of area range to ignore
+        a = np.array([d["area"] < aRng[0] or d["area"] > aRng[1] for d in dt]).reshape(
+            (1, len(dt))
+        )
+        dtIg = np.logical_or(dtIg, np.logical_and(dtm == 0, np.repeat(a, T, 0)))
+        # store results for given image and category
+        return {
+            "image_id": imgId,
+            "category_id": catId,
+            "aRng": aRng,
+            "maxDet": maxDet,
+            "dtIds": [d["id"] for d in dt],
+            "gtIds": [g["id"] for g in gt],
+            "dtMatches": dtm,
+            "gtMatches": gtm,
+            "dtScores": [d["score"] for d in dt],
+            "gtIgnore": gtIg,
+            "dtIgnore": dtIg,
+        }
+
+
+def _evaluate_images(job):
+    """Compute the IoUs and evaluate a chunk of images, as COCOeval.evaluate does, in a worker process."""
+    params, gts, dts = job
+    evaluator = COCOEvalWrapper.__new__(COCOEvalWrapper)
+    evaluator.params = params
+    evaluator._gts = defaultdict(list, gts)
+    evaluator._dts = defaultdict(list, dts)
+    catIds = params.catIds if params.useCats else [-1]
+    evaluator.ious = {
+        (imgId, catId): evaluator.computeIoU(imgId, catId)
+        for imgId in params.imgIds
+        for catId in catIds
+    }
+    maxDet = params.maxDets[-1]
+    evalImgs = [
+        evaluator.evaluateImg(imgId, catId, areaRng, maxDet)
+        for catId in catIds
+        for areaRng in params.areaRng
+        for imgId in params.imgIds
+    ]
+    return evaluator.ious, evalImgs
@@ -1,7 +1,62 @@
+import functools
 import logging
+import threading
 import cv2
 import numpy as np
 import skimage.color
+from cachetools import LRUCache
+
+from src.data.loader import BatchLoader
+from src.data.registry import ImageRegistry, SourceImageMap
+
+# Layouts of the images returned by a dataset:
+#   rgb: [H,W,3], grayscale images are converted to RGB.
+#   gray: [H,W,1], color images are converted to grayscale.
+#   native: as stored, i.e. [H,W] for grayscale images and [H,W,3] for color ones.
+CHANNEL_MODES = ["rgb", "gray", "native"]
+
+# Loaders whose results are kept by Dataset.enable_cache, in the base class and in every subclass that overrides them
+CACHED_LOADERS = ["load_image", "load_mask"]
+
+
+def cached_loader(load):
+    """Decorate a loader of a Dataset so its results are kept in the cache of the dataset, when it is enabled."""
+
+    @functools.wraps(load)
+    def cached_load(self, image_id, *args, **kwargs):
+        cache = self.__dict__.get("_cache")
+        if cache is None:
+            return load(self, image_id, *args, **kwargs)
+        # The channel mode of the dataset is the default layout of the images, so it is part of the key
+        key = (
+            load.__name__,
+            image_id,
+            args,
+            tuple(sorted(kwargs.items())),
+            self.channel_mode,
+        )
+        read_only = self._cache_read_only
+        with self._cache_lock:
+            value = cache.get(key)
+            if value is not None:
+                self._cache_hits += 1
+                return value if read_only else _copy_arrays(value)
+            self._cache_misses += 1
+        value = load(self, image_id, *args, **kwargs)
+        if read_only:
+            for array in value if isinstance(value, tuple) else [value]:
+                if isinstance(array, np.ndarray):
+                    array.setflags(write=False)
+        with self._cache_lock:
+            try:
+                cache[key] = value
+            except ValueError:
+                # The value is larger than the cache
+                return value
+        return value if read_only else _copy_arrays(value)
+
+    cached_load.is_cached_loader = True
+    return cached_load
 
 
 class Dataset(object):
@@ -20,20 +75,49 @@ class Dataset(object):
     See COCODataset and ShapesDataset as examples.
     """
 
-    def __init__(self, class_map=None):
+    def __init__(self, class_map=None, channel_mode="rgb"):
+        if channel_mode not in CHANNEL_MODES:
+            raise ValueError(
+                "The channel mode must be one of: {}".format(CHANNEL_MODES)
+            )
+        self.channel_mode = channel_mode
         self._image_ids = []
-        self.image_info = []
+        # Columnar list of image_info dictionaries, see src.data.registry.ImageRegistry
+        self.image_info = ImageRegistry()
         # Background is always the first class
         self.class_info = [{"source": "", "id": 0, "name": "BG"}]
+        self._class_keys = {("", 0)}
         self.source_class_ids = {}
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Loaders overridden by a subclass go through the cache too
+        for name in CACHED_LOADERS:
+            load = cls.__dict__.get(name)
+            if callable(load) and not getattr(load, "is_cached_loader", False):
+                setattr(cls, name, cached_loader(load))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if state.get("_cache") is not None:
+            # Every process starts with an empty cache of the same size
+            state["_cache"] = LRUCache(maxsize=self._cache.maxsize, getsizeof=_nbytes)
+            state["_cache_hits"] = state["_cache_misses"] = 0
+            del state["_cache_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if state.get("_cache") is not None:
+            self._cache_lock = threading.Lock()
+
     def add_class(self, source, class_id, class_name):
         assert "." not in source, "Source name cannot contain a dot"
         # Does the class exist already?
-        for info in self.class_info:
-            if info["source"] == source and info["id"] == class_id:
-                # source.class_id combination already available, skip
-                return
+        if (source, class_id) in self._class_keys:
+            # source.class_id combination already available, skip
+            return
+        self._class_keys.add((source, class_id))
         # Add the class
         self.class_info.append(
             {
@@ -44,13 +128,7 @@ class Dataset(object):
         )
 
     def add_image(self, source, image_id, path, **kwargs):
-        image_info = {
-            "id": image_id,
-            "source": source,
-            "path": path,
-        }
-        image_info.update(kwargs)
-        self.image_info.append(image_info)
+        self.image_info.add(source, image_id, path, **kwargs)
 
     def image_reference(self, image_id):
         """Return a link to the image in its source Website or details about
@@ -76,6 +154,14 @@ class Dataset(object):
         self.num_classes = len(self.class_info)
         self.class_ids = np.arange(self.num_classes)
         self.class_names = [clean_name(c["name"]) for c in self.class_info]
+        # Value of every class ID in the label maps, and the name of every value. A value shared by several classes,
+        # e.g. the background and the sea of MKLab, takes the name of the last one.
+        self.label_values = np.asarray(self.get_label_values(), dtype=np.uint8)
+        self.label_names = [
+            str(value) for value in range(int(self.label_values.max()) + 1)
+        ]
+        for value, name in zip(self.label_values.tolist(), self.class_names):
+            self.label_names[value] = name
         self.num_images = len(self.image_info)
         self._image_ids = np.arange(self.num_images)
 
@@ -84,10 +170,9 @@ class Dataset(object):
             "{}.{}".format(info["source"], info["id"]): id
             for info, id in zip(self.class_info, self.class_ids)
         }
-        self.image_from_source_map = {
-            "{}.{}".format(info["source"], info["id"]): id
-            for info, id in zip(self.image_info, self.image_ids)
-        }
+        # Looked up in the columns of the registry, without a key per image
+        self.image_from_source_map = SourceImageMap(self.image_info)
+        self.image_info.build_lookups()
 
         # Map sources to class_ids they support
         self.sources = list(set([i["source"] for i in self.class_info]))
@@ -101,6 +186,14 @@ class Dataset(object):
                 if i == 0 or source == info["source"]:
                     self.source_class_ids[source].append(i)
 
+    def get_label_values(self):
+        """Return the value of every class ID in the label maps of load_label_map.
+
+        By default, the class IDs themselves, so the background is 0. Override this method if the label maps must keep
+        the values of the source dataset.
+        """
+        return np.arange(len(self.class_info))
+
     def map_source_class_id(self, source_class_id):
         """Takes a source class ID and returns the int class ID assigned to it.
 
@@ -109,6 +202,14 @@ class Dataset(object):
         """
         return self.class_from_source_map[source_class_id]
 
+    def map_source_image_id(self, source, image_id):
+        """Takes a source and an image ID in that source and returns the int image ID assigned to it.
+
+        For example:
+        dataset.map_source_image_id("mklab", 12) -> 11
+        """
+        return self.image_info.index_of(source, image_id)
+
     def get_source_class_id(self, class_id, source):
         """Map an internal class ID to the corresponding class ID in the source dataset."""
         info = self.class_info[class_id]
@@ -126,18 +227,94 @@ class Dataset(object):
         """
         return self.image_info[image_id]["path"]
 
-    def load_image(self, image_id):
-        """Load the specified image and return a [H,W,3] Numpy array."""
-        # Load image
-        image = cv2.imread(self.image_info[image_id]["path"], cv2.IMREAD_UNCHANGED)
-        # If grayscale. Convert to RGB for consistency.
-        if image.ndim != 3:
-            image = skimage.color.gray2rgb(image)
-        # If has an alpha channel, remove it for consistency
-        if image.shape[-1] == 4:
-            image = image[..., :3]
-        return image.astype(np.uint8)
+    @cached_loader
+    def load_image(self, image_id, channel_mode=None):
+        """Load the specified image and return a [H,W,3] Numpy array.
+
+        The layout depends on channel_mode, or the channel mode of the dataset if it is None (see CHANNEL_MODES).
+        Grayscale images are expanded to RGB only in "rgb" mode.
+        """
+        channel_mode = channel_mode or self.channel_mode
+        # Load image, JPEG decodes straight to a single channel in gray mode
+        flags = cv2.IMREAD_GRAYSCALE if channel_mode == "gray" else cv2.IMREAD_UNCHANGED
+        image = cv2.imread(self.image_info[image_id]["path"], flags)
+        image = convert_channels(image, channel_mode)
+        return image.astype(np.uint8, copy=False)
 
+    def load_label_map(self, image_id):
+        """Load the semantic label map of the given image.
+
+        By default, the instance masks of load_mask are painted into the map. Override this method if the dataset can
+        build it without decoding every instance.
+
+        Returns:
+            label_map: A uint8 array of shape [height, width] with the label value of the class of each pixel (see
+                get_label_values). Pixels without an instance have the value of the background.
+        """
+        masks, class_ids = self.load_mask(image_id)
+        label_map = np.full(masks.shape[:2], self.label_values[0], dtype=np.uint8)
+        for k, class_id in enumerate(class_ids):
+            # Crowd instances have negative class IDs
+            label_map[masks[..., k]] = self.label_values[abs(class_id)]
+        return label_map
+
+    def iter_batches(
+        self,
+        batch_size,
+        workers=4,
+        prefetch=2,
+        shuffle=False,
+        seed=None,
+        augmentation=None,
+        **kwargs
+    ):
+        """Return an iterable over batches of (images, label maps, image IDs).
+
+        Images are [N,H,W,C] and label maps [N,H,W,1] arrays filled by a pool of workers ahead of the consumer. See
+        src.data.loader.BatchLoader for the rest of the arguments and for the lifetime of the returned arrays.
+        """
+        return BatchLoader(
+            self,
+            batch_size,
+            workers=workers,
+            prefetch=prefetch,
+            shuffle=shuffle,
+            seed=seed,
+            augmentation=augmentation,
+            **kwargs
+        )
+
+    def enable_cache(self, max_bytes=2 * 1024**3, read_only=False):
+        """Keep the decoded images and masks in memory, up to max_bytes.
+
+        The least recently used items are evicted first. Every call returns a copy of the cached arrays, so callers
+        can modify them in place. With read_only, the cached arrays themselves are returned, without copying them,
+        and they are read-only since they are shared by all the callers. The cache is safe to use from several
+        threads, and calling this method again clears it. A pickled dataset, e.g. in the workers of a process-based
+        loader, keeps the size of the cache but not its contents.
+        """
+        self._cache = LRUCache(maxsize=max_bytes, getsizeof=_nbytes)
+        self._cache_read_only = read_only
+        self._cache_lock = threading.Lock()
+        self._cache_hits = 0
+        self._cache_misses = 0
+
+    def cache_info(self):
+        """Return hits, misses and size in bytes of the cache, or None if it is not enabled."""
+        if getattr(self, "_cache", None) is None:
+            return None
+        with self._cache_lock:
+            requests = self._cache_hits + self._cache_misses
+            return {
+                "hits": self._cache_hits,
+                "misses": self._cache_misses,
+                "hit_rate": self._cache_hits / requests if requests else 0.0,
+                "items": len(self._cache),
+                "bytes": self._cache.currsize,
+                "max_bytes": self._cache.maxsize,
+            }
+
+    @cached_loader
     def load_mask(self, image_id):
         """Load instance masks for the given image.
 
@@ -158,3 +335,40 @@ class Dataset(object):
         mask = np.empty([0, 0, 0])
         class_ids = np.empty([0], np.int32)
         return mask, class_ids
+
+
+def _copy_arrays(value):
+    """Copy an array, or the arrays of a tuple."""
+    if isinstance(value, tuple):
+        return tuple(_copy_arrays(v) for v in value)
+    return value.copy() if isinstance(value, np.ndarray) else value
+
+
+def _nbytes(value):
+    """Size in bytes of an array or a tuple of arrays."""
+    if isinstance(value, tuple):
+        return sum(_nbytes(v) for v in value)
+    return getattr(value, "nbytes", 0)
+
+
+def convert_channels(image, channel_mode):
+    """Convert an image to the layout of a channel mode (see CHANNEL_MODES).
+
+    Color images are expected in the BGR order of cv2.imread. An alpha channel is always removed. The image is not
+    copied when it already has the requested layout.
+    """
+    if channel_mode not in CHANNEL_MODES:
+        raise ValueError("The channel mode must be one of: {}".format(CHANNEL_MODES))
+    # If has an alpha channel, remove it for consistency
+    if image.ndim == 3 and image.shape[-1] == 4:
+        image = image[..., :3]
+    grayscale = image.ndim == 2 or image.shape[-1] == 1
+    if channel_mode == "rgb" and grayscale:
+        # If grayscale. Convert to RGB for consistency.
+        image = skimage.color.gray2rgb(image.reshape(image.shape[:2]))
+    elif channel_mode == "gray":
+        if not grayscale:
+            # Same weights as cv2.IMREAD_GRAYSCALE, which load_image uses in this mode
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        image = image.reshape(image.shape[:2] + (1,))
+    return image
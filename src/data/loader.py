@@ -0,0 +1,214 @@
+"""
+Loader
+Batched, prefetching loader of images and label maps over a Dataset.
+
+Copyright (c) 2022 Juan Carlos Cedeño Noblecilla
+
+This software is released under the MIT License.
+https://opensource.org/licenses/MIT
+Written by Juan Carlos Cedeño Noblecilla.
+"""
+
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+# Dataset and augmentation of a worker process, set once by the initializer of the pool
+_worker_dataset = None
+_worker_augmentation = None
+
+
+def load_sample(dataset, image_id, augmentation=None):
+    """Load the image and the label map of an image, and augment them if an augmentation is given."""
+    image = dataset.load_image(image_id)
+    mask = dataset.load_label_map(image_id)
+    if augmentation is not None:
+        image, mask = augmentation(image, mask)
+    return image, mask
+
+
+def _init_worker(dataset, augmentation):
+    global _worker_dataset, _worker_augmentation
+    _worker_dataset = dataset
+    _worker_augmentation = augmentation
+
+
+def _load_sample_in_worker(image_id):
+    return load_sample(_worker_dataset, image_id, _worker_augmentation)
+
+
+class BatchLoader:
+    """Iterate over a dataset in batches of images and label maps.
+
+    Samples are decoded (and augmented) by a pool of threads or processes while the consumer works on the previous
+    batches, and they are written into preallocated [N,H,W,C] image and [N,H,W,1] mask buffers. The buffers are
+    reused: the arrays of a batch are valid until the next batch is requested, copy them to keep them longer. All the
+    images must have the same shape.
+
+    Every iteration is an epoch. With shuffle, each epoch draws a new permutation from a generator seeded once with
+    seed, so the sequence of epochs is reproducible. With a sampler (e.g. a ShardedSampler of src.data.sampler), the
+    images of each epoch are the ones of the sampler instead, and its epoch is set to the number of the iteration.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        batch_size,
+        workers=4,
+        prefetch=2,
+        shuffle=False,
+        seed=None,
+        augmentation=None,
+        drop_remainder=False,
+        use_processes=False,
+        image_ids=None,
+        sampler=None,
+    ):
+        """
+        Arguments
+        ---------
+        dataset: a prepared Dataset.
+        batch_size: number of samples per batch.
+        workers: number of threads (or processes) that decode samples.
+        prefetch: number of batches kept ready ahead of the consumer.
+        shuffle: shuffle the samples every epoch.
+        seed: seed of the shuffling.
+        augmentation: an Augmentation applied to each sample.
+        drop_remainder: skip the last batch if it is smaller than batch_size.
+        use_processes: decode in a process pool instead of a thread pool. The dataset and the augmentation are sent
+            once to each process, so they must be picklable.
+        image_ids: subset of image IDs to iterate over. Default: all the images of the dataset.
+        sampler: an iterable of image IDs with a set_epoch(epoch) method, like ShardedSampler. It replaces image_ids
+            and shuffle.
+        """
+        if batch_size < 1 or workers < 1 or prefetch < 1:
+            raise ValueError("batch_size, workers and prefetch must be greater than 0.")
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.workers = workers
+        self.prefetch = prefetch
+        self.shuffle = shuffle
+        self.augmentation = augmentation
+        self.drop_remainder = drop_remainder
+        self.use_processes = use_processes
+        self.image_ids = np.asarray(
+            dataset.image_ids if image_ids is None else image_ids
+        )
+        self.sampler = sampler
+        self.epoch = 0
+        self._rng = np.random.default_rng(seed)
+        self._buffers = None
+        self.samples = 0
+        self.seconds = 0.0
+
+    def __len__(self):
+        num_samples = len(self.image_ids if self.sampler is None else self.sampler)
+        if self.drop_remainder:
+            return num_samples // self.batch_size
+        return -(-num_samples // self.batch_size)
+
+    @property
+    def samples_per_second(self):
+        """Throughput of the loader, measured from the start of each epoch to its last batch."""
+        return self.samples / self.seconds if self.seconds else 0.0
+
+    def _get_executor(self):
+        if self.use_processes:
+            return ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_worker,
+                initargs=(self.dataset, self.augmentation),
+            )
+        return ThreadPoolExecutor(max_workers=self.workers)
+
+    def _submit(self, executor, image_id):
+        if self.use_processes:
+            return executor.submit(_load_sample_in_worker, image_id)
+        return executor.submit(load_sample, self.dataset, image_id, self.augmentation)
+
+    def _allocate(self, image, mask):
+        # One buffer being filled, one held by the consumer and the ones waiting in the queue
+        image_shape = (
+            (self.batch_size,)
+            + image.shape[:2]
+            + (image.shape[2] if image.ndim == 3 else 1,)
+        )
+        mask_shape = (self.batch_size,) + mask.shape[:2] + (1,)
+        self._buffers = [
+            (np.empty(image_shape, image.dtype), np.empty(mask_shape, mask.dtype))
+            for _ in range(self.prefetch + 2)
+        ]
+
+    def __iter__(self):
+        image_ids = self.image_ids
+        if self.sampler is not None:
+            self.sampler.set_epoch(self.epoch)
+            image_ids = np.fromiter(self.sampler, dtype=np.int64)
+        elif self.shuffle:
+            image_ids = self._rng.permutation(image_ids)
+        self.epoch += 1
+        batches = [
+            image_ids[i * self.batch_size : (i + 1) * self.batch_size]
+            for i in range(len(self))
+        ]
+        batches_queue = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                with self._get_executor() as executor:
+                    # Keep the pool busy with the samples of the next batch while the current one is collected
+                    pending = deque(
+                        [self._submit(executor, i) for i in ids] for ids in batches[:2]
+                    )
+                    for b, ids in enumerate(batches):
+                        futures = pending.popleft()
+                        if b + 2 < len(batches):
+                            pending.append(
+                                [self._submit(executor, i) for i in batches[b + 2]]
+                            )
+                        for k, future in enumerate(futures):
+                            image, mask = future.result()
+                            if self._buffers is None:
+                                self._allocate(image, mask)
+                            images, masks = self._buffers[b % len(self._buffers)]
+                            images[k] = image.reshape(images.shape[1:])
+                            masks[k] = mask.reshape(masks.shape[1:])
+                            if stop.is_set():
+                                return
+                        if not put((images[: len(ids)], masks[: len(ids)], ids)):
+                            return
+                put(None)
+            except BaseException as e:
+                put(e)
+
+        start = time.time()
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = batches_queue.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                self.samples += len(item[2])
+                self.seconds += time.time() - start
+                start = time.time()
+                yield item
+        finally:
+            stop.set()
+            producer.join()
@@ -1,19 +1,32 @@
 from src.data.factory import Dataset
 from src.utils.definitions import UNPROCESSED_DATA_DIR
-from src.utils.miscellaneous import download_url, extract_all_files
-from src.features.connected_components import (
-    get_bitmask,
-    get_connected_component_labels,
+from src.utils.miscellaneous import (
+    download_url,
+    extract_all_files,
+    export_files,
+    hash_file,
+    is_zip,
+    ZipReader,
 )
-from src.coco.utils import encode_mask, bbox_from_encoded_mask, area_from_encoded_mask
+from src.features.connected_components import get_instances
+from src.coco.index import COCOIndex
+from src.coco.streaming import COCOStreamWriter, iter_coco_records
+from src.coco.utils import InstanceMasks
 from dotenv import find_dotenv, load_dotenv
-from pycocotools.coco import COCO
 from pycocotools import mask as mask_utils
+from contextlib import nullcontext
+from functools import partial
+from multiprocessing import Pool
+import hashlib
 import os
 import json
+import time
 import cv2
 import numpy as np
 
+# Content hashes of the source files of a conversion, saved next to annotations.json
+MANIFEST_FILENAME = "manifest.json"
+
 
 class OilSpillDetectionDataset(Dataset):
     LABELS_VALUES = {
@@ -36,40 +49,34 @@ class OilSpillDetectionDataset(Dataset):
         # class name used to labeling [source, class_id, class_name]
         # Assertion of subset
         assert subset in ["train", "test"]
-        # Read COCO annotation
-        dataset = COCO(os.path.join(dataset_dir, subset, "annotations.json"))
+        # Read the compiled index of the COCO annotations, it is compiled the first time and whenever the file changes
+        dataset = COCOIndex.load(os.path.join(dataset_dir, subset, "annotations.json"))
         # Load all classes or a subset
         if not class_names:
-            class_ids = sorted(dataset.getCatIds())
+            class_ids = sorted(dataset.get_cat_ids())
         else:
             class_ids = [self.LABELS_VALUES[class_name] for class_name in class_names]
         # Create the images directory
         images_dir = os.path.join(dataset_dir, subset, "images")
-        # Get images ids
+        # Get images positions in the index
         if class_names:
-            image_ids = []
-            for id in class_ids:
-                image_ids.extend(dataset.getImgIds(catIds=[id]))
-                # Remove duplicates
-                image_ids = list(set(image_ids))
+            positions = dataset.get_image_positions(class_ids)
         else:
-            image_ids = list(dataset.imgs.keys())
+            positions = dataset.get_image_positions()
 
         # Add classes
         for i in class_ids:
-            self.add_class("mklab", i, dataset.loadCats(i)[0]["name"])
+            self.add_class("mklab", i, dataset.get_category(i)["name"])
 
         # Add images
-        for i in image_ids:
+        for position in positions:
             self.add_image(
                 "mklab",
-                image_id=i,
-                path=os.path.join(images_dir, dataset.imgs[i]["file_name"]),
-                width=dataset.imgs[i]["width"],
-                height=dataset.imgs[i]["height"],
-                annotations=dataset.loadAnns(
-                    dataset.getAnnIds(imgIds=[i], catIds=class_ids, iscrowd=None)
-                ),
+                image_id=int(dataset.image_ids[position]),
+                path=os.path.join(images_dir, dataset.file_names[position]),
+                width=int(dataset.widths[position]),
+                height=int(dataset.heights[position]),
+                annotations=dataset.get_annotations(position, class_ids),
             )
 
     def load_mask(self, image_id):
@@ -104,8 +111,8 @@ class OilSpillDetectionDataset(Dataset):
                     class_id *= -1
 
                     if (
-                            mask.shape[0] != image_info["height"]
-                            or mask.shape[1] != image_info["width"]
+                        mask.shape[0] != image_info["height"]
+                        or mask.shape[1] != image_info["width"]
                     ):
                         mask = np.ones(
                             [image_info["height"], image_info["width"]], dtype=bool
@@ -114,11 +121,61 @@ class OilSpillDetectionDataset(Dataset):
                 class_ids.append(class_id)
 
         if class_ids:
-            masks = np.stack(instance_masks, axis=2).astype(np.bool)
+            masks = np.stack(instance_masks, axis=2).astype(bool)
             class_ids = np.array(class_ids, dtype=np.int32)
+        else:
+            # Image without instances
+            masks = np.zeros([image_info["height"], image_info["width"], 0], dtype=bool)
+            class_ids = np.empty([0], dtype=np.int32)
 
         return masks, class_ids
 
+    def load_instances(self, image_id):
+        """Load the instances of the given image id without decoding their masks.
+
+        Returns:
+        instances: An InstanceMasks container with the same instances and class IDs as load_mask. Masks are decoded
+            only when they are accessed.
+        """
+        image_info = self.image_info[image_id]
+        encoded_masks = []
+        class_ids = []
+        for annotation in image_info["annotations"]:
+            class_id = self.map_source_class_id(
+                "mklab.{}".format(annotation["category_id"])
+            )
+            if class_id:
+                rle = self.annToRLE(
+                    annotation, image_info["height"], image_info["width"]
+                )
+                if mask_utils.area(rle) < 1:
+                    continue
+                if annotation["iscrowd"]:
+                    class_id *= -1
+                encoded_masks.append(rle)
+                class_ids.append(class_id)
+        return InstanceMasks(
+            encoded_masks, class_ids, image_info["height"], image_info["width"]
+        )
+
+    def get_label_values(self):
+        """Return the MKLab value of every class ID, so label maps hold the same values as the labels_1D masks.
+
+        The values are the source class IDs. Pixels without an instance are sea, whose value 0 is the one of the
+        background.
+        """
+        return [info["id"] for info in self.class_info]
+
+    def load_label_map(self, image_id):
+        """Load the semantic label map of the given image id.
+
+        Instances are painted straight from their RLE runs, so no full-frame mask is decoded per instance.
+
+        Returns:
+        label_map: A uint8 array of shape [height, width] with the MKLab value of each pixel, as in labels_1D.
+        """
+        return self.load_instances(image_id).label_map(values=self.label_values)
+
     def image_reference(self, image_id):
         """Return the path of the image."""
         info = self.image_info[image_id]
@@ -157,14 +214,157 @@ class OilSpillDetectionDataset(Dataset):
         return m
 
 
-def from_mklab_to_coco_format(input_dir, output_dir, subset="train"):
+def read_image(filepath, reader=None, flags=cv2.IMREAD_UNCHANGED):
+    """Read an image from disk, or from a zipfile if a ZipReader is given (filepath is then relative to it)."""
+    if reader is None:
+        return cv2.imread(filepath, flags)
+    return cv2.imdecode(np.frombuffer(reader.read(filepath), dtype=np.uint8), flags)
+
+
+def get_file_fingerprint(filepath, previous=None, reader=None, content_hash=True):
+    """Return the size, modification time and SHA-1 hash of a file, or of a member of a zipfile if a ZipReader is
+    given.
+
+    The hash is only computed when size or modification time differ from the previous fingerprint, otherwise the
+    previous hash (if any) is reused. Without content_hash only size and modification time are returned.
+    """
+    if reader is None:
+        stat = os.stat(filepath)
+        fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    else:
+        info = reader.getinfo(filepath)
+        mtime = time.mktime(info.date_time + (0, 0, -1))
+        fingerprint = {"size": info.file_size, "mtime_ns": int(mtime) * 10**9}
+    if is_same_stat(fingerprint, previous):
+        if "sha1" in previous:
+            fingerprint["sha1"] = previous["sha1"]
+        return fingerprint
+    if not content_hash:
+        return fingerprint
+    if reader is None:
+        fingerprint["sha1"] = hash_file(filepath)
+    else:
+        fingerprint["sha1"] = hashlib.sha1(reader.read(filepath)).hexdigest()
+    return fingerprint
+
+
+def is_same_stat(fingerprint, previous):
+    """Return whether two fingerprints have the same size and modification time."""
+    return (
+        previous is not None
+        and previous["size"] == fingerprint["size"]
+        and previous["mtime_ns"] == fingerprint["mtime_ns"]
+    )
+
+
+def is_same_file(fingerprint, previous):
+    """Return whether two fingerprints describe the same content, by size and modification time or by hash."""
+    if previous is None:
+        return False
+    if is_same_stat(fingerprint, previous):
+        return True
+    return "sha1" in fingerprint and fingerprint.get("sha1") == previous.get("sha1")
+
+
+def get_mklab_filenames(input_dir, subset="train"):
+    """Return the sorted list of JPEG filenames of a MKLab subset.
+
+    Sorting makes image and annotation IDs independent of the ``os.listdir`` order of the filesystem. The input
+    directory can also be the zipfile of the dataset.
+    """
+    if is_zip(input_dir):
+        with ZipReader(input_dir) as reader:
+            files = reader.listdir(os.path.join(subset, "images"))
+    else:
+        images_dir = os.path.join(input_dir, subset, "images")
+        if not os.path.isdir(images_dir):
+            return []
+        files = os.listdir(images_dir)
+    return sorted(file for file in files if file.endswith(".jpg"))
+
+
+def get_mklab_annotations(filepath, reader=None, return_hash=False):
+    """Extract the instance annotations of a MKLab semantic segmentation mask.
+
+    Each connected component of every class (but the background) is an instance. The annotations do not carry the
+    "id" and "image_id" keys, these are assigned later by the caller, so this function can run in a worker process.
+
+    Args:
+        filepath (str): Path to the label PNG file (labels_1D).
+        reader (ZipReader): Read the file from a zipfile instead of the disk.
+        return_hash (bool): Also return the SHA-1 hash of the file, computed from the bytes that are decoded.
+
+    Returns:
+        A list of annotation dictionaries in COCO format, and the hash of the file if return_hash is True.
+    """
+    if reader is None:
+        with open(filepath, "rb") as f:
+            data = f.read()
+    else:
+        data = reader.read(filepath)
+    mask = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    annotations = [
+        {
+            "category_id": class_id,
+            "segmentation": encoded_mask,
+            "area": area,
+            "bbox": bbox,
+            "iscrowd": 0,
+        }
+        for class_id, encoded_mask, area, bbox in get_instances(mask)
+    ]
+    if return_hash:
+        return annotations, hashlib.sha1(data).hexdigest()
+    return annotations
+
+
+def check_label_maps(dataset_dir, input_dir, subset="train"):
+    """Check that the label maps of a converted subset match the labels_1D masks of the MKLab source.
+
+    Args:
+        dataset_dir (str): Path to the directory of the converted dataset.
+        input_dir (str): Path to the directory containing the MKLab dataset, or to its zipfile.
+        subset (str): The subset to check. Can be 'train' or 'test'.
+
+    Returns:
+        The file names of the images whose label map differs from its source mask.
+    """
+    dataset = OilSpillDetectionDataset()
+    dataset.load_oil_spills(dataset_dir, subset)
+    dataset.prepare()
+    reader = ZipReader(input_dir) if is_zip(input_dir) else None
+    labels_dir = os.path.join(input_dir if reader is None else "", subset, "labels_1D")
+    mismatches = []
+    for image_id in dataset.image_ids:
+        file = os.path.basename(dataset.image_info[image_id]["path"])
+        source = read_image(
+            os.path.join(labels_dir, file.replace(".jpg", ".png")), reader
+        )
+        if not np.array_equal(dataset.load_label_map(image_id), source):
+            mismatches.append(file)
+    if reader is not None:
+        reader.close()
+    return mismatches
+
+
+def from_mklab_to_coco_format(
+    input_dir, output_dir, subset="train", workers=1, indent=None, incremental=False
+):
     """Convert the Oil Spill Detection dataset owned by Multimedia Knowledge and Social Media Analytics Laboratory
     (MKLab) to COCO format.
 
     Args:
-        input_dir (str): Path to the directory containing the MKLab dataset.
+        input_dir (str): Path to the directory containing the MKLab dataset, or to its zipfile. The zipfile is read
+            in place, only the images of the subset are extracted.
         output_dir (str): Path to the directory where the COCO dataset will be saved.
         subset (str): The subset of the dataset to convert. Can be 'train' or 'test'
+        workers (int): Number of processes used to extract the annotations. The image and annotation IDs are the
+            same regardless of the number of workers.
+        indent (int): Indentation level of the annotations file. By default, it is written in compact form.
+        incremental (bool): Reprocess only the images added or changed since the last conversion, according to the
+            manifest saved next to the annotations. Files whose size or modification time changed are compared by
+            content hash. The annotations only depend on the labels, so images whose label is unchanged keep their
+            image and annotation IDs.
     References:
         - Krestenitis, M., Orfanidis, G., Ioannidis, K., Avgerinakis, K., Vrochidis, S., & Kompatsiaris, I. (2019).
         Oil spill identification from satellite images using deep neural networks. Remote Sensing, 11(15), 1762.
@@ -175,12 +375,14 @@ def from_mklab_to_coco_format(input_dir, output_dir, subset="train"):
     supported_subsets = ["train", "test"]
     if subset not in supported_subsets:
         raise ValueError("The subset must be one of: {}".format(supported_subsets))
+    if workers < 1:
+        raise ValueError("The number of workers must be greater than 0.")
     # Create the output directory if it does not exist
     output_dir = os.path.join(output_dir, subset)
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    # Create an empty COCO dataset specification
-    coco_dataset = {
+    # COCO dataset specification, images and annotations are written as they are produced
+    coco_header = {
         "info": {
             "description": "Oil Spill Detection Dataset ({})".format(subset),
             "url": "https://m4d.iti.gr/oil-spill-detection-dataset/",
@@ -197,8 +399,6 @@ def from_mklab_to_coco_format(input_dir, output_dir, subset="train"):
                 "url": "https://mklab.iti.gr/files/oli-spill-detection-terms.pdf",
             }
         ],
-        "images": [],
-        "annotations": [],
         "categories": [
             {"id": 0, "name": "sea", "supercategory": "natural"},
             {"id": 1, "name": "oil_spill", "supercategory": "oil_spill"},
@@ -207,108 +407,155 @@ def from_mklab_to_coco_format(input_dir, output_dir, subset="train"):
             {"id": 4, "name": "land", "supercategory": "natural"},
         ],
     }
-    # Create the images and annotations
-    image_id = 0
-    annotation_id = 0
-    for folder in os.listdir(input_dir):
-        # Skip folder is not subset
-        if folder != subset:
-            continue
-        # Skip the files that are not folders
-        if os.path.isdir(os.path.join(input_dir, folder)):
-            # Walk over images folder
-            for file in os.listdir(os.path.join(input_dir, folder, "images")):
-                if file.endswith(".jpg"):
-                    image_id += 1
-                    # Add the image
-                    image = {
-                        "id": image_id,
-                        "file_name": file,
-                        "width": 1250,
-                        "height": 650,
-                    }
-                    coco_dataset["images"].append(image)
-                    # Add the annotation
-                    ## Annotations section
-                    # Read the segmentation mask
-                    filepath = os.path.join(
-                        input_dir, folder, "labels_1D", file.replace(".jpg", ".png")
-                    )
-                    mask = cv2.imread(filepath, cv2.IMREAD_UNCHANGED)
-                    n_classes = np.max(mask) + 1
-                    if n_classes == 1:
-                        # The image is empty
-                        continue
-                    # Create the segmentation
-                    for c in range(n_classes):
-                        # Skip the background class
-                        if c == 0:
-                            continue
-                        # Get a bitmask of the class-of-interest from segmentation mask
-                        bitmask = get_bitmask(mask, c)
-                        # Get connected components
-                        num_labels, labels = get_connected_component_labels(bitmask)
-                        if num_labels == 1:
-                            # If there is only one connected component, num_labels is equal to 2.
-                            # But, when there is not a connected component, num_labels is equal to 1, so
-                            # is assumed that the segmentation mask is an 2d-array filled with zeros.
-                            # Then, we skip it.
-                            continue
-                        for k in range(1, num_labels):
-                            # The range starts from 1 because k=0 is the background.
-                            # Get the connected component
-                            instance_mask = get_bitmask(labels, k)
-                            # Get the bounding box
-                            encoded_mask = encode_mask(instance_mask)
-                            # Create the annotation
-                            annotation = {
-                                "id": annotation_id,
-                                "image_id": image_id,
-                                "category_id": c,
-                                "segmentation": encoded_mask,
-                                "area": int(
-                                    area_from_encoded_mask(encoded_mask)
-                                ),  # int() is necessary
-                                "bbox": bbox_from_encoded_mask(encoded_mask)
-                                .astype(int)
-                                .tolist(),
-                                # int() is necessary
-                                "iscrowd": 0,
-                            }
-                            coco_dataset["annotations"].append(annotation)
-                            annotation_id += 1
-    # Save the COCO dataset
+    # Walk over images folder
+    files = get_mklab_filenames(input_dir, subset)
+    # Paths of a zipfile are relative to the archive
+    reader = ZipReader(input_dir) if is_zip(input_dir) else None
+    source_dir = input_dir if reader is None else ""
+    images_dir = os.path.join(source_dir, subset, "images")
+    labels_dir = os.path.join(source_dir, subset, "labels_1D")
+    annotations_filepath = os.path.join(output_dir, "annotations.json")
+    manifest_filepath = os.path.join(output_dir, MANIFEST_FILENAME)
+    # Load the manifest of the previous run, only used if its annotations are still there
+    previous_manifest = {"images": {}, "next_image_id": 1, "next_annotation_id": 0}
+    if (
+        incremental
+        and os.path.exists(manifest_filepath)
+        and os.path.exists(annotations_filepath)
+    ):
+        with open(manifest_filepath, "r") as f:
+            previous_manifest = json.load(f)
+    previous_entries = previous_manifest["images"]
+    # Fingerprint the source files. Files are only hashed here in an incremental rebuild and when their size or
+    # modification time have changed, so a full conversion does not read the dataset twice. The labels that are
+    # converted are hashed from the bytes that are decoded, so every label of the manifest has a hash.
+    manifest = {"images": {}}
+    for file in files:
+        previous_entry = previous_entries.get(file, {})
+        manifest["images"][file] = {
+            "image": get_file_fingerprint(
+                os.path.join(images_dir, file),
+                previous_entry.get("image"),
+                reader,
+                content_hash=incremental,
+            ),
+            "label": get_file_fingerprint(
+                os.path.join(labels_dir, file.replace(".jpg", ".png")),
+                previous_entry.get("label"),
+                reader,
+                content_hash=incremental,
+            ),
+        }
+    unchanged_files = set(
+        file
+        for file, entry in manifest["images"].items()
+        if file in previous_entries
+        and is_same_file(entry["label"], previous_entries[file]["label"])
+    )
+    changed_files = [file for file in files if file not in unchanged_files]
+    if previous_entries:
+        print(
+            "Incremental rebuild: {} unchanged, {} changed, {} added, {} removed images".format(
+                len(unchanged_files),
+                len([file for file in changed_files if file in previous_entries]),
+                len([file for file in changed_files if file not in previous_entries]),
+                len(
+                    [
+                        file
+                        for file in previous_entries
+                        if file not in manifest["images"]
+                    ]
+                ),
+            )
+        )
+    # Keep the annotations of the unchanged images as they are
+    unchanged_image_ids = set(
+        previous_entries[file]["image_id"] for file in unchanged_files
+    )
+    previous_annotations = {}
+    if unchanged_image_ids:
+        for key, record in iter_coco_records(annotations_filepath):
+            if key == "annotations" and record["image_id"] in unchanged_image_ids:
+                previous_annotations.setdefault(record["image_id"], []).append(record)
     print("Saving reformated dataset to: {}".format(output_dir))
-    with open(os.path.join(output_dir, "annotations.json"), "w") as f:
-        json.dump(coco_dataset, f, indent=4, sort_keys=True)
+    with Pool(workers) if workers > 1 else nullcontext() as pool, COCOStreamWriter(
+        annotations_filepath, indent=indent, **coco_header
+    ) as writer:
+        # Extract the annotations of every new or changed image, in parallel if requested. Both map and imap keep the
+        # input order.
+        filepaths = [
+            os.path.join(labels_dir, file.replace(".jpg", ".png"))
+            for file in changed_files
+        ]
+        get_annotations = partial(
+            get_mklab_annotations, reader=reader, return_hash=True
+        )
+        if pool is not None:
+            annotations_per_image = pool.imap(get_annotations, filepaths, chunksize=8)
+        else:
+            annotations_per_image = map(get_annotations, filepaths)
+        # Create the images and annotations. Untouched images keep their IDs and new ones continue the sequence.
+        image_id = previous_manifest["next_image_id"]
+        annotation_id = previous_manifest["next_annotation_id"]
+        for file in files:
+            if file in previous_entries:
+                current_image_id = previous_entries[file]["image_id"]
+            else:
+                current_image_id = image_id
+                image_id += 1
+            manifest["images"][file]["image_id"] = current_image_id
+            # Add the image
+            image = {
+                "id": current_image_id,
+                "file_name": file,
+                "width": 1250,
+                "height": 650,
+            }
+            writer.add_image(image)
+            # Add the annotations
+            if file in unchanged_files:
+                for annotation in previous_annotations.get(current_image_id, []):
+                    writer.add_annotation(annotation)
+                continue
+            annotations, label_hash = next(annotations_per_image)
+            manifest["images"][file]["label"]["sha1"] = label_hash
+            for annotation in annotations:
+                annotation["id"] = annotation_id
+                annotation["image_id"] = current_image_id
+                writer.add_annotation(annotation)
+                annotation_id += 1
+    # Save the manifest for the next incremental rebuild
+    manifest["next_image_id"] = image_id
+    manifest["next_annotation_id"] = annotation_id
+    with open(manifest_filepath + ".tmp", "w") as f:
+        json.dump(manifest, f, sort_keys=True)
+    os.replace(manifest_filepath + ".tmp", manifest_filepath)
 
     # Copy the images
     output_images_dir = os.path.join(output_dir, "images")
     print("Copying images to: {}".format(output_images_dir))
-    # Create the output images directory if it does not exist
-    if not os.path.exists(output_images_dir):
-        os.makedirs(output_images_dir)
-    for folder in os.listdir(input_dir):
-        # Skip folder is not subset
-        if folder != subset:
-            continue
-        # Skip the files that are not folders
-        if os.path.isdir(os.path.join(input_dir, folder)):
-            # Walk over images folder
-            input_images_dir = os.path.join(input_dir, folder, "images")
-            for file in os.listdir(input_images_dir):
-                if file.endswith(".jpg"):
-                    os.system(
-                        "cp {} {}".format(
-                            os.path.join(input_images_dir, file),
-                            os.path.join(output_images_dir, file),
-                        )
-                    )
+    image_filepaths = [os.path.join(images_dir, file) for file in files]
+    if reader is None:
+        export_files(image_filepaths, output_images_dir)
+    else:
+        reader.extract(image_filepaths, output_images_dir)
+        reader.close()
+    # Remove the images that are not in the dataset anymore
+    for file in previous_entries:
+        if file not in manifest["images"] and os.path.exists(
+            os.path.join(output_images_dir, file)
+        ):
+            os.remove(os.path.join(output_images_dir, file))
     print("Done!")
 
 
-def download_mklab_dataset():
-    """Download the dataset from the MKLab website and extract it."""
+def download_mklab_dataset(extract=True):
+    """Download the dataset from the MKLab website and extract it.
+
+    Args:
+        extract (bool): Extract the dataset. Otherwise, the zipfile is kept as it is, `from_mklab_to_coco_format`
+            reads it in place.
+    """
     # Find the .env automatically by walking up directories until it's found
     load_dotenv(find_dotenv())
     # Download the dataset
@@ -319,6 +566,9 @@ def download_mklab_dataset():
     filename = download_url(os.getenv("MKLAB_DATASET_URL"), out_dir)
     # Extract the dataset
     filepath = os.path.join(out_dir, filename)
+    if not extract:
+        print("Dataset has been downloaded successfully to: {}".format(filepath))
+        return filepath
     extract_all_files(filepath, out_dir)
     # Delete the zip file
     os.remove(filepath)
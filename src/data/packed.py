@@ -0,0 +1,266 @@
+"""
+Packed dataset
+Pack the images and masks of a prepared dataset into a single on-disk store that is read with memory maps.
+
+Copyright (c) 2022 Juan Carlos Cedeño Noblecilla
+
+This software is released under the MIT License.
+https://opensource.org/licenses/MIT
+Written by Juan Carlos Cedeño Noblecilla.
+"""
+
+import json
+import os
+
+import numpy as np
+from scipy import ndimage
+
+from src.data.factory import Dataset, convert_channels
+
+IMAGES_FILENAME = "images.u8"
+LABELS_FILENAME = "labels.u16"
+INDEX_FILENAME = "index.npz"
+META_FILENAME = "meta.json"
+
+
+def pack_dataset(dataset, store_dir):
+    """Pack a prepared dataset into a store of contiguous arrays.
+
+    The store holds every image as uint8 and every instance mask painted into a uint16 instance map (0 is the
+    background and k is the k-th instance of the image), plus an index with the offsets and shapes of each image and
+    the class IDs of its instances. Grayscale images saved as RGB keep a single channel. Instances of a source
+    dataset must not overlap, otherwise the last one wins.
+
+    Args:
+        dataset (Dataset): A prepared dataset.
+        store_dir (str): Directory of the store. It is created if it does not exist.
+    """
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    num_images = len(dataset.image_ids)
+    image_offsets = np.zeros(num_images, dtype=np.int64)
+    image_shapes = np.zeros((num_images, 3), dtype=np.int64)
+    label_offsets = np.zeros(num_images, dtype=np.int64)
+    instance_offsets = np.zeros(num_images + 1, dtype=np.int64)
+    class_ids = []
+    with open(os.path.join(store_dir, IMAGES_FILENAME), "wb") as images_file, open(
+        os.path.join(store_dir, LABELS_FILENAME), "wb"
+    ) as labels_file:
+        for i, image_id in enumerate(dataset.image_ids):
+            image = np.asarray(dataset.load_image(image_id), dtype=np.uint8)
+            if image.ndim == 2:
+                image = image[..., np.newaxis]
+            elif image.shape[-1] == 3 and (
+                np.array_equal(image[..., 0], image[..., 1])
+                and np.array_equal(image[..., 0], image[..., 2])
+            ):
+                image = image[..., :1]
+            masks, image_class_ids = dataset.load_mask(image_id)
+            if masks.shape[-1] > np.iinfo(np.uint16).max:
+                raise ValueError(
+                    "Image {} has more instances than a uint16 map can hold.".format(
+                        image_id
+                    )
+                )
+            instance_map = np.zeros(image.shape[:2], dtype=np.uint16)
+            for k in range(masks.shape[-1]):
+                instance_map[masks[..., k]] = k + 1
+            image_offsets[i] = images_file.tell()
+            image_shapes[i] = image.shape
+            images_file.write(np.ascontiguousarray(image).tobytes())
+            label_offsets[i] = labels_file.tell()
+            labels_file.write(instance_map.tobytes())
+            class_ids.extend(np.asarray(image_class_ids, dtype=np.int32).tolist())
+            instance_offsets[i + 1] = len(class_ids)
+    np.savez(
+        os.path.join(store_dir, INDEX_FILENAME),
+        image_offsets=image_offsets,
+        image_shapes=image_shapes,
+        label_offsets=label_offsets,
+        instance_offsets=instance_offsets,
+        class_ids=np.array(class_ids, dtype=np.int32),
+    )
+    meta = {
+        "class_info": dataset.class_info,
+        "label_values": dataset.label_values.tolist(),
+        "image_info": [
+            {
+                "id": dataset.image_info[image_id]["id"],
+                "source": dataset.image_info[image_id]["source"],
+                "path": dataset.image_info[image_id]["path"],
+            }
+            for image_id in dataset.image_ids
+        ],
+    }
+    with open(os.path.join(store_dir, META_FILENAME), "w") as f:
+        json.dump(meta, f)
+
+
+class PackedInstanceMasks:
+    """Instance masks of a packed image that are read from its instance map only when they are accessed.
+
+    It has the interface of InstanceMasks: `masks[k]` compares the instance map with k + 1, `crop(k)` reads only the
+    bounding box of the k-th instance, and `label_map()` paints all of them with a single lookup. The bounding boxes
+    of all the instances are found in one pass over the map, the first time one is needed.
+    """
+
+    def __init__(self, instance_map, class_ids):
+        """
+        Arguments
+        ---------
+        instance_map: a [height, width] array where the pixels of the k-th instance hold k + 1 and the background 0.
+        class_ids: a 1-D array with the class ID of every instance.
+        """
+        self.instance_map = instance_map
+        self.class_ids = np.asarray(class_ids, dtype=np.int32)
+        self.height, self.width = instance_map.shape
+        self._slices = None
+
+    def __len__(self):
+        return len(self.class_ids)
+
+    def __getitem__(self, k):
+        return self.instance_map == k + 1
+
+    def bbox(self, k):
+        """Bounding box of the k-th instance as [x_min, y_min, width, height]."""
+        if self._slices is None:
+            self._slices = ndimage.find_objects(self.instance_map, max_label=len(self))
+        box = self._slices[k]
+        if box is None:
+            return [0, 0, 0, 0]
+        rows, cols = box
+        return [cols.start, rows.start, cols.stop - cols.start, rows.stop - rows.start]
+
+    def crop(self, k):
+        """Read the k-th instance inside its bounding box.
+
+        Returns:
+            A [bbox height, bbox width] bool array and the bounding box.
+        """
+        x, y, w, h = self.bbox(k)
+        return self.instance_map[y : y + h, x : x + w] == k + 1, [x, y, w, h]
+
+    def stack(self):
+        """Read all the instances into a [height, width, instance count] bool array, as load_mask does."""
+        return self.instance_map[..., np.newaxis] == np.arange(
+            1, len(self) + 1, dtype=self.instance_map.dtype
+        )
+
+    def label_map(self, dtype=np.uint8, values=None):
+        """Paint the class ID of every instance into a [height, width] map, 0 is the background.
+
+        Crowd instances, with negative class IDs, are painted with their absolute value. With values, e.g. the
+        label_values of a Dataset, every class ID k is painted as values[k] instead, and the background as values[0].
+        """
+        lookup = np.concatenate([[0], np.abs(self.class_ids)])
+        if values is not None:
+            lookup = np.asarray(values)[lookup]
+        return lookup.astype(dtype)[self.instance_map]
+
+
+class PackedDataset(Dataset):
+    """Dataset read from a store written by `pack_dataset`.
+
+    Images and instance maps are views of memory maps, so nothing is decoded when they are loaded, and every process
+    that opens the same store shares a single copy of it in the page cache.
+    """
+
+    def load_packed(self, store_dir):
+        """Open a store and add its classes and images. Call prepare() afterwards."""
+        self.store_dir = store_dir
+        index = np.load(os.path.join(store_dir, INDEX_FILENAME))
+        self._image_offsets = index["image_offsets"]
+        self._image_shapes = index["image_shapes"]
+        self._label_offsets = index["label_offsets"]
+        self._instance_offsets = index["instance_offsets"]
+        self._class_ids = index["class_ids"]
+        self._images = np.memmap(
+            os.path.join(store_dir, IMAGES_FILENAME), dtype=np.uint8, mode="r"
+        )
+        self._labels = np.memmap(
+            os.path.join(store_dir, LABELS_FILENAME), dtype=np.uint16, mode="r"
+        )
+        with open(os.path.join(store_dir, META_FILENAME), "r") as f:
+            meta = json.load(f)
+        self._label_values = meta["label_values"]
+        # The background class is already in class_info, the class IDs of the store keep the same order
+        for info in meta["class_info"][1:]:
+            self.add_class(info["source"], info["id"], info["name"])
+        for i, info in enumerate(meta["image_info"]):
+            height, width, _ = self._image_shapes[i]
+            self.add_image(
+                info["source"],
+                image_id=info["id"],
+                path=info["path"],
+                width=int(width),
+                height=int(height),
+                packed_index=i,
+            )
+
+    def get_label_values(self):
+        """Return the label values of the dataset that was packed."""
+        return self._label_values
+
+    def load_image(self, image_id, channel_mode=None):
+        """Load the specified image and return a read-only [H,W,3] view of the store.
+
+        Grayscale images are broadcast to three channels without copying them in "rgb" mode, and are returned as
+        views in "gray" and "native" modes too (see CHANNEL_MODES).
+        """
+        channel_mode = channel_mode or self.channel_mode
+        i = self.image_info[image_id]["packed_index"]
+        height, width, channels = self._image_shapes[i]
+        start = self._image_offsets[i]
+        image = self._images[start : start + height * width * channels].reshape(
+            height, width, channels
+        )
+        if channels == 1 and channel_mode == "rgb":
+            return np.broadcast_to(image, (height, width, 3))
+        if channels == 1 and channel_mode == "native":
+            return image.reshape(height, width)
+        return convert_channels(image, channel_mode)
+
+    def load_instance_map(self, image_id):
+        """Return a read-only [H,W] view of the instance map and the class IDs of its instances.
+
+        The pixels of the k-th instance hold k + 1, and the background holds 0.
+        """
+        i = self.image_info[image_id]["packed_index"]
+        height, width, _ = self._image_shapes[i]
+        start = self._label_offsets[i] // np.dtype(np.uint16).itemsize
+        instance_map = self._labels[start : start + height * width].reshape(
+            height, width
+        )
+        class_ids = self._class_ids[
+            self._instance_offsets[i] : self._instance_offsets[i + 1]
+        ]
+        return instance_map, class_ids
+
+    def load_instances(self, image_id):
+        """Load the instances of the given image id without materialising their masks.
+
+        Returns:
+        instances: A PackedInstanceMasks container backed by the memory map, with the same instances and class IDs
+            as load_mask.
+        """
+        return PackedInstanceMasks(*self.load_instance_map(image_id))
+
+    def load_label_map(self, image_id):
+        """Load the semantic label map of the given image, a [H,W] uint8 array with the label value of each pixel
+        (see get_label_values)."""
+        return self.load_instances(image_id).label_map(values=self.label_values)
+
+    def load_mask(self, image_id):
+        """Load instance masks for the given image id.
+
+        The masks are materialised from the instance map, as the Dataset interface requires. Use load_instances to
+        read them lazily from the memory map.
+
+        Returns:
+        masks: A bool array of shape [height, width, instance count] with
+            one mask per instance.
+        class_ids: A 1-D array of class IDs of the instance masks.
+        """
+        instances = self.load_instances(image_id)
+        return instances.stack(), instances.class_ids
@@ -0,0 +1,335 @@
+"""
+Ledger
+Persistent ledger of the scenes and subsets of a pre-processing run, to resume it, retry failures and report timings.
+
+Copyright (c) 2022 Juan Carlos Cedeño Noblecilla
+
+This software is released under the MIT License.
+https://opensource.org/licenses/MIT
+Written by Juan Carlos Cedeño Noblecilla.
+"""
+
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from tabulate import tabulate
+
+# States of a scene or a subset
+PENDING = "pending"
+EXTRACTING = "extracting"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+STATES = [PENDING, EXTRACTING, RUNNING, DONE, FAILED]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scenes (
+    scene TEXT PRIMARY KEY,
+    zip_path TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL DEFAULT 0,
+    started REAL,
+    finished REAL,
+    extract_seconds REAL,
+    process_seconds REAL,
+    error TEXT,
+    plan TEXT
+);
+CREATE INDEX IF NOT EXISTS scenes_state ON scenes (state, next_attempt);
+CREATE TABLE IF NOT EXISTS subsets (
+    scene TEXT NOT NULL,
+    subset TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    seconds REAL,
+    output_path TEXT,
+    error TEXT,
+    PRIMARY KEY (scene, subset)
+);
+"""
+
+
+def get_scene_id(zip_filepath):
+    """Return the scene ID of a zip file, its name without extension."""
+    return os.path.basename(zip_filepath).replace(".zip", "")
+
+
+def get_subset_key(subset):
+    """Return the key of a subset (x, y, width, height), as in the names of the output files."""
+    return "{}_{}_{}_{}".format(*subset)
+
+
+class JobLedger:
+    """SQLite ledger of the state, attempts, timings and outputs of every scene and subset of a pre-processing run.
+
+    Every change is committed at once, so the ledger survives a crash. The plan of subsets of a scene is saved on its
+    first attempt, so later attempts split it the same way and skip the subsets that are done. Scenes that were
+    extracting or running when the previous run stopped are failed when the ledger is opened, and retried at once if
+    they have attempts left, and their running subsets are pending again. A failed scene is retried after a backoff
+    that doubles with every attempt, up to max_attempts. The ledger is shared by the threads of a run.
+
+    The run that opens the ledger holds a lock file next to it until it is closed, so only one run at a time updates
+    it. A read-only ledger, e.g. to show the status of a live run, neither takes the lock nor recovers the scenes.
+    """
+
+    def __init__(self, filepath, max_attempts=3, backoff=60.0, read_only=False):
+        """
+        Arguments
+        ---------
+        filepath: path of the SQLite database, created if it does not exist.
+        max_attempts: largest number of attempts of a scene.
+        backoff: seconds to wait before the second attempt of a failed scene, doubled for every next attempt.
+        read_only: open an existing ledger without changing it, while another run may be using it.
+        """
+        self.filepath = filepath
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.read_only = read_only
+        self._lock = threading.Lock()
+        self._lock_file = None
+        if read_only:
+            if not os.path.exists(filepath):
+                raise FileNotFoundError("No ledger at {}.".format(filepath))
+            self._connection = sqlite3.connect(
+                "file:{}?mode=ro".format(filepath), uri=True, check_same_thread=False
+            )
+            return
+        self._lock_file = open(filepath + ".lock", "a+")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.seek(0)
+            pid = self._lock_file.read().strip() or "?"
+            self._lock_file.close()
+            raise RuntimeError(
+                "The ledger {} is used by another run (PID {}).".format(filepath, pid)
+            )
+        self._lock_file.seek(0)
+        self._lock_file.truncate()
+        self._lock_file.write(str(os.getpid()))
+        self._lock_file.flush()
+        self._connection = sqlite3.connect(filepath, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        with self._connection:
+            self._connection.executescript(SCHEMA)
+        # No other run holds the ledger, so the scenes it left extracting or running were interrupted
+        self.recover()
+
+    def close(self):
+        self._connection.close()
+        if self._lock_file is not None:
+            # Closing the file releases the lock
+            self._lock_file.close()
+            self._lock_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _execute(self, query, parameters=()):
+        with self._lock, self._connection:
+            return self._connection.execute(query, parameters).fetchall()
+
+    def recover(self):
+        """Fail the scenes left extracting or running by a crashed run, and set their running subsets as pending.
+
+        The interrupted attempt counts, so a scene that keeps crashing the run is not retried forever.
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE scenes SET state = ?, finished = ?, next_attempt = ?, error = ? WHERE state IN (?, ?)",
+                (
+                    FAILED,
+                    now,
+                    now,
+                    "Interrupted: the run stopped during this attempt",
+                    EXTRACTING,
+                    RUNNING,
+                ),
+            )
+            self._connection.execute(
+                "UPDATE subsets SET state = ? WHERE state = ?", (PENDING, RUNNING)
+            )
+
+    def add_scenes(self, zip_filepaths, done=()):
+        """Register the scenes of zip files that are not in the ledger yet, as done if their ID is in done.
+
+        Returns:
+            The number of scenes added.
+        """
+        done = set(done)
+        rows = [
+            (
+                get_scene_id(zip_filepath),
+                zip_filepath,
+                DONE if get_scene_id(zip_filepath) in done else PENDING,
+            )
+            for zip_filepath in zip_filepaths
+        ]
+        with self._lock, self._connection:
+            before = self._connection.total_changes
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO scenes (scene, zip_path, state) VALUES (?, ?, ?)",
+                rows,
+            )
+            return self._connection.total_changes - before
+
+    def get_scene_ids(self):
+        """Return the IDs of all the scenes in the ledger."""
+        return [row[0] for row in self._execute("SELECT scene FROM scenes")]
+
+    def get_runnable(self, now=None, limit=None):
+        """Return the zip files of the scenes that are pending, or failed and due for a new attempt."""
+        now = time.time() if now is None else now
+        query = (
+            "SELECT zip_path FROM scenes WHERE state IN (?, ?) AND attempts < ? AND next_attempt IS NOT NULL "
+            "AND next_attempt <= ? ORDER BY next_attempt, scene"
+        )
+        parameters = (PENDING, FAILED, self.max_attempts, now)
+        if limit is not None:
+            query += " LIMIT ?"
+            parameters += (limit,)
+        return [row[0] for row in self._execute(query, parameters)]
+
+    def get_next_retry(self):
+        """Return the time of the next attempt of a failed scene, or None if no scene will be retried."""
+        rows = self._execute(
+            "SELECT MIN(next_attempt) FROM scenes WHERE state = ? AND attempts < ? AND next_attempt IS NOT NULL",
+            (FAILED, self.max_attempts),
+        )
+        return rows[0][0]
+
+    def start_extracting(self, scene):
+        """Start a new attempt of a scene."""
+        self._execute(
+            "UPDATE scenes SET state = ?, attempts = attempts + 1, started = ?, finished = NULL, error = NULL "
+            "WHERE scene = ?",
+            (EXTRACTING, time.time(), scene),
+        )
+
+    def start_running(self, scene, extract_seconds):
+        self._execute(
+            "UPDATE scenes SET state = ?, extract_seconds = ? WHERE scene = ?",
+            (RUNNING, extract_seconds, scene),
+        )
+
+    def finish(self, scene, process_seconds):
+        self._execute(
+            "UPDATE scenes SET state = ?, finished = ?, process_seconds = ? WHERE scene = ?",
+            (DONE, time.time(), process_seconds, scene),
+        )
+
+    def fail(self, scene, error, retry=True):
+        """Record the failure of a scene. It is retried after the backoff of its attempt, unless retry is False."""
+        with self._lock, self._connection:
+            attempts = self._connection.execute(
+                "SELECT attempts FROM scenes WHERE scene = ?", (scene,)
+            ).fetchone()[0]
+            now = time.time()
+            next_attempt = (
+                now + self.backoff * 2 ** max(attempts - 1, 0) if retry else None
+            )
+            self._connection.execute(
+                "UPDATE scenes SET state = ?, finished = ?, next_attempt = ?, error = ? WHERE scene = ?",
+                (FAILED, now, next_attempt, repr(error), scene),
+            )
+
+    def get_plan(self, scene):
+        """Return the plan of subsets of a scene saved by set_plan, as a dictionary, or None."""
+        rows = self._execute("SELECT plan FROM scenes WHERE scene = ?", (scene,))
+        if not rows or rows[0][0] is None:
+            return None
+        return json.loads(rows[0][0])
+
+    def set_plan(self, scene, plan):
+        """Save the plan of subsets of a scene, a JSON-serialisable dictionary, for its next attempts."""
+        self._execute(
+            "UPDATE scenes SET plan = ? WHERE scene = ?", (json.dumps(plan), scene)
+        )
+
+    def get_done_subsets(self, scene):
+        """Return the keys of the subsets of a scene that are done."""
+        return set(
+            row[0]
+            for row in self._execute(
+                "SELECT subset FROM subsets WHERE scene = ? AND state = ?",
+                (scene, DONE),
+            )
+        )
+
+    def set_subset(
+        self, scene, subset, state, seconds=None, output_path=None, error=None
+    ):
+        """Record the state of a subset (x, y, width, height) of a scene. Starting to run counts as an attempt."""
+        key = get_subset_key(subset)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO subsets (scene, subset, state) VALUES (?, ?, ?)",
+                (scene, key, PENDING),
+            )
+            self._connection.execute(
+                "UPDATE subsets SET state = ?, attempts = attempts + ?, seconds = COALESCE(?, seconds), "
+                "output_path = COALESCE(?, output_path), error = ? WHERE scene = ? AND subset = ?",
+                (
+                    state,
+                    int(state == RUNNING),
+                    seconds,
+                    output_path,
+                    None if error is None else repr(error),
+                    scene,
+                    key,
+                ),
+            )
+
+    def summary(self):
+        """Return the number of scenes, attempts and mean timings of every state as a dictionary."""
+        rows = self._execute(
+            "SELECT state, COUNT(*), SUM(attempts), AVG(extract_seconds), AVG(process_seconds) FROM scenes "
+            "GROUP BY state"
+        )
+        summary = {state: {"scenes": 0, "attempts": 0} for state in STATES}
+        for state, scenes, attempts, extract_seconds, process_seconds in rows:
+            summary[state] = {
+                "scenes": scenes,
+                "attempts": attempts or 0,
+                "mean_extract_seconds": extract_seconds,
+                "mean_process_seconds": process_seconds,
+            }
+        return summary
+
+    def report(self, failures=10):
+        """Return a table with the scenes of every state, and the last failures."""
+        rows = [
+            [
+                state,
+                values["scenes"],
+                values["attempts"],
+                values.get("mean_extract_seconds"),
+                values.get("mean_process_seconds"),
+            ]
+            for state, values in self.summary().items()
+        ]
+        table = tabulate(
+            rows,
+            headers=["State", "Scenes", "Attempts", "Extract (s)", "Process (s)"],
+            floatfmt=".1f",
+            missingval="-",
+        )
+        last_failures = self._execute(
+            "SELECT scene, attempts, error FROM scenes WHERE state = ? ORDER BY finished DESC LIMIT ?",
+            (FAILED, failures),
+        )
+        if last_failures:
+            table += "\n\n" + tabulate(
+                last_failures, headers=["Failed scene", "Attempts", "Error"]
+            )
+        return table
@@ -0,0 +1,242 @@
+"""
+Scheduler
+Pipelined extraction, processing and cleanup of the scenes of a pre-processing run.
+
+Copyright (c) 2022 Juan Carlos Cedeño Noblecilla
+
+This software is released under the MIT License.
+https://opensource.org/licenses/MIT
+Written by Juan Carlos Cedeño Noblecilla.
+"""
+
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class ByteBudget:
+    """Bytes reserved out of a budget, e.g. of scratch disk by the extracted scenes or of RAM by the JVM heaps.
+
+    A reservation waits until it fits in the budget. A reservation larger than the budget is let through when nothing
+    else is reserved, so it can always go ahead.
+    """
+
+    def __init__(self, budget=None):
+        """
+        Arguments
+        ---------
+        budget: number of bytes that may be reserved at a time. None means no limit.
+        """
+        self.budget = budget
+        self.used = 0
+        self._condition = threading.Condition()
+
+    def fits(self, size):
+        return self.budget is None or self.used == 0 or self.used + size <= self.budget
+
+    def reserve(self, size):
+        """Wait until size bytes fit in the budget and reserve them."""
+        with self._condition:
+            while not self.fits(size):
+                self._condition.wait()
+            self.used += size
+
+    def release(self, size):
+        with self._condition:
+            self.used -= size
+            self._condition.notify_all()
+
+
+class ScenePipeline:
+    """Overlap the extraction of the next scenes and the cleanup of the previous ones with the processing of a scene.
+
+    A background thread extracts up to lookahead scenes ahead of the one being processed, as long as their extracted
+    size fits in the scratch quota, and the cleanup of a processed scene runs in another thread. Scenes are processed
+    in the calling thread and in their order, so the processing can use its own process pool.
+    """
+
+    def __init__(
+        self,
+        extract,
+        process,
+        cleanup,
+        get_size=None,
+        scratch_quota=None,
+        lookahead=1,
+        extract_workers=1,
+    ):
+        """
+        Arguments
+        ---------
+        extract: function that extracts a scene to the scratch disk.
+        process: function that processes an extracted scene and returns its result.
+        cleanup: function that removes the extracted files of a scene. It is called even if a step failed.
+        get_size: function that returns the extracted size of a scene in bytes, required with a scratch quota.
+        scratch_quota: largest number of bytes of extracted scenes on the scratch disk at a time. None means no limit.
+        lookahead: largest number of scenes extracted (or being extracted) ahead of the one being processed.
+        extract_workers: number of scenes extracted at a time.
+        """
+        if lookahead < 1:
+            raise ValueError("lookahead must be at least 1, got {}.".format(lookahead))
+        if scratch_quota is not None and get_size is None:
+            raise ValueError("A scratch quota requires the get_size function.")
+        self.extract = extract
+        self.process = process
+        self.cleanup = cleanup
+        self.get_size = get_size
+        self.quota = ByteBudget(scratch_quota)
+        self.lookahead = lookahead
+        self.extract_workers = extract_workers
+
+    def run(self, scenes):
+        """Extract, process and remove every scene.
+
+        Yields:
+            (scene, result, error) tuples in the order of the scenes, where error is the exception raised by getting
+            the size, the extraction or the processing of the scene, or None.
+        """
+        condition = self.quota._condition
+        queue = deque()
+        state = {"stop": False, "done": False, "error": None}
+        extract_pool = ThreadPoolExecutor(self.extract_workers)
+        cleanup_pool = ThreadPoolExecutor(1)
+
+        def produce():
+            try:
+                for scene in scenes:
+                    future = None
+                    try:
+                        size = self.get_size(scene) if self.get_size is not None else 0
+                    except Exception as e:
+                        # The scene is reported as failed without extracting it, the next ones go on
+                        size = 0
+                        future = Future()
+                        future.set_exception(e)
+                    with condition:
+                        while not state["stop"] and (
+                            len(queue) >= self.lookahead or not self.quota.fits(size)
+                        ):
+                            condition.wait()
+                        if state["stop"]:
+                            return
+                        self.quota.used += size
+                        if future is None:
+                            future = extract_pool.submit(self.extract, scene)
+                        queue.append((scene, size, future))
+                        condition.notify_all()
+            except Exception as e:
+                # Listing the scenes failed, the consumer raises it
+                state["error"] = e
+            finally:
+                with condition:
+                    state["done"] = True
+                    condition.notify_all()
+
+        def remove(scene, size):
+            try:
+                self.cleanup(scene)
+            finally:
+                self.quota.release(size)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        cleanups = []
+        try:
+            while True:
+                with condition:
+                    while not queue and not state["done"]:
+                        condition.wait()
+                    if not queue:
+                        break
+                    scene, size, future = queue.popleft()
+                    # A slot is free, the producer starts extracting the next scene
+                    condition.notify_all()
+                result = None
+                error = future.exception()
+                if error is None:
+                    try:
+                        result = self.process(scene)
+                    except Exception as e:
+                        error = e
+                cleanups.append(cleanup_pool.submit(remove, scene, size))
+                yield scene, result, error
+            if state["error"] is not None:
+                raise state["error"]
+        finally:
+            with condition:
+                state["stop"] = True
+                condition.notify_all()
+            producer.join()
+            # Scenes extracted ahead that were not processed are removed too
+            for scene, size, future in queue:
+                future.exception()
+                cleanups.append(cleanup_pool.submit(remove, scene, size))
+            queue.clear()
+            extract_pool.shutdown()
+            cleanup_pool.shutdown()
+            for cleanup in cleanups:
+                cleanup.result()
+
+
+class HeapScheduler:
+    """Run tasks in a process pool so that the JVM heaps of the running tasks fit in a memory budget.
+
+    Each task is submitted when its heap fits next to the heaps of the running ones, so tasks of different sizes
+    share the pool without oversubscribing the RAM of the node. A map can also run fewer tasks at a time than the
+    processes of the pool, e.g. the number of subsets that a tile plan was costed for.
+    """
+
+    def __init__(self, pool, memory_budget=None):
+        """
+        Arguments
+        ---------
+        pool: a multiprocessing Pool, its number of processes caps the number of running tasks.
+        memory_budget: number of bytes of RAM for the heaps of the running tasks. None means no limit.
+        """
+        self.pool = pool
+        self.budget = ByteBudget(memory_budget)
+
+    def map(self, function, tasks, heaps, on_start=None, on_end=None, max_running=None):
+        """Apply function to every task, each needing the heap (in bytes) of the same position, and return the
+        results in order.
+
+        on_start(task) is called when a task is submitted, and on_end(task, result, error) when it ends, e.g. to
+        record the progress. on_end is called from a thread of the pool. With max_running, at most that many tasks
+        run at a time, otherwise the processes of the pool are the limit. An exception raised by on_end is raised
+        here once all the tasks have ended.
+        """
+        slots = ByteBudget(max_running)
+        results = []
+        hook_errors = []
+        try:
+            for task, heap in zip(tasks, heaps):
+                slots.reserve(1)
+                self.budget.reserve(heap)
+
+                def end(result, task=task, heap=heap, error=None):
+                    self.budget.release(heap)
+                    slots.release(1)
+                    if on_end is not None:
+                        # An exception would stop the thread of the pool that handles results, and every wait after it
+                        try:
+                            on_end(task, result, error)
+                        except Exception as e:
+                            hook_errors.append(e)
+
+                def fail(error, task=task, heap=heap):
+                    end(None, task, heap, error)
+
+                if on_start is not None:
+                    on_start(task)
+                results.append(
+                    self.pool.apply_async(
+                        function, (task,), callback=end, error_callback=fail
+                    )
+                )
+        finally:
+            # Wait for the submitted tasks even if a reservation was interrupted
+            for result in results:
+                result.wait()
+        if hook_errors:
+            raise hook_errors[0]
+        return [result.get() for result in results]
@@ -11,8 +11,8 @@ Written by Juan Carlos Cedeño.
 """
 
 import sys
-import glob
 import os
+import re
 import shutil
 import time
 import zipfile
@@ -33,11 +33,43 @@ from src.utils.definitions import (
     PROCESSED_DATA_DIR,
     TMP_DIR,
 )
-from src.utils.miscellaneous import extract_all_files
+from src.data.preprocessing.ledger import (
+    DONE,
+    FAILED,
+    RUNNING,
+    JobLedger,
+    get_scene_id,
+    get_subset_key,
+)
+from src.data.preprocessing.scheduler import HeapScheduler, ScenePipeline
+from src.data.preprocessing.tiling import (
+    GB,
+    TilePlan,
+    covers_scene,
+    get_available_memory,
+    plan_tiles,
+)
+from src.utils.miscellaneous import (
+    extract_all_files,
+    extract_files,
+    get_extracted_size,
+)
 
 # By default, use these folders to run preprocessing
 IN_SENTINEL_1_DATA_DIR = os.path.join(UNPROCESSED_DATA_DIR, "sentinel_1")
 OUT_SENTINEL_1_DATA_DIR = os.path.join(PROCESSED_DATA_DIR, "sentinel_1")
+# Members of a .SAFE product read by the VV workflow: metadata, VV annotations (including calibration and noise
+# vectors) and the VV measurement. The other polarisations and the previews are never extracted.
+SAFE_VV_PATTERNS = [
+    "*.SAFE/manifest.safe",
+    "*.SAFE/support/*",
+    "*.SAFE/annotation/*-vv-*.xml",
+    "*.SAFE/measurement/*-vv-*.tiff",
+]
+# Output files of the subsets of a scene: <scene>_sigma0_VV_dB_<x>_<y>_<width>_<height>.<extension>
+OUTPUT_FILENAME_PATTERN = re.compile(
+    r"^(.+)_sigma0_VV_dB_(\d+)_(\d+)_(\d+)_(\d+)\.\w+$"
+)
 
 
 class Sentinel1GroundRangeDetectedPreprocessing:
@@ -53,29 +85,57 @@ class Sentinel1GroundRangeDetectedPreprocessing:
         self.tmp_dir = TMP_DIR  # All XML files will be in the temporary folder (it will remove later)
         self.xms = memory_allocation_min
         self.xmx = memory_allocation_max
+        self.set_java_options()
+
+    def set_java_options(self):
+        """Set the heap of the JVM of GPT in the environment of the current process."""
         os.environ["_JAVA_OPTIONS"] = "-Xms{} -Xmx{}".format(self.xms, self.xmx)
         os.environ["JAVA_TOOL_OPTIONS"] = "-Xms{} -Xmx{}".format(self.xms, self.xmx)
 
     def __call__(self, subset=None):
-        filename = self.get_filename(self.safe_file)
-        if subset is not None:
-            subset_index = "{}_{}_{}_{}".format(
-                subset[0], subset[1], subset[2], subset[3]
-            )
-            filename = filename + "_" + subset_index
-            self.tmp_dir = os.path.join(self.tmp_dir, subset_index)
-        if not os.path.exists(self.tpm_dir):
-            os.makedirs(self.tpm_dir)
-        xml_filepath = os.path.join(self.tpm_dir, "{}.xml".format(filename))
-        workflow = self.get_workflow(subset)
+        """Pre-process a subset (x, y, width, height) of the scene, or the whole scene.
+
+        Returns:
+            The path of the output file (without extension) and the seconds of the processing.
+        """
+        # The pool of calibrate is forked before any instance is created, so its workers never see the environment
+        # set by __init__ in the parent. The heap is set in the process that runs GPT.
+        self.set_java_options()
+        if subset is None:
+            scene = identify(self.safe_file)
+            subset = (0, 0, scene.samples, scene.lines)
+        subset_index = "{}_{}_{}_{}".format(subset[0], subset[1], subset[2], subset[3])
+        filename = self.get_filename(self.safe_file) + "_" + subset_index
+        tmp_dir = os.path.join(self.tmp_dir, filename)
+        if not os.path.exists(tmp_dir):
+            os.makedirs(tmp_dir)
+        xml_filepath = os.path.join(tmp_dir, "{}.xml".format(filename))
+        workflow = self.get_workflow(*subset)
         workflow.write(xml_filepath)
 
         start = time.time()
-        gpt(xml_filepath, self.tpm_dir, groupbyWorkers(xml_filepath, 6))
+        gpt(xml_filepath, tmp_dir, groupbyWorkers(xml_filepath, 6))
         end = time.time()
         # Remove XML folder and its files
-        shutil.rmtree(self.tpm_dir)
+        shutil.rmtree(tmp_dir)
         print("Preprocessing has completed successfully at {}s!".format(end - start))
+        return self.get_output_filepath(*subset), end - start
+
+    def plan_subsets(self, memory_budget=None, cores=None, **kwargs):
+        """Choose the subsets of the scene and their heap from its dimensions, the memory and the cores. See
+        `plan_tiles`, the heap of the subsets is set as the maximum allocation of this instance.
+
+        Returns:
+            plan (TilePlan): The subsets as (x, y, width, height) tuples, their heap and how many run at a time.
+        """
+        scene = identify(self.safe_file)
+        plan = plan_tiles(scene.lines, scene.samples, memory_budget, cores, **kwargs)
+        self.use_plan(plan)
+        return plan
+
+    def use_plan(self, plan):
+        """Set the heap of a plan of subsets, e.g. of a previous attempt, as the maximum allocation of this instance."""
+        self.xmx = "{}M".format(plan.heap >> 20)
 
     @staticmethod
     def parse_subset(safe_file: str):
@@ -100,6 +160,12 @@ class Sentinel1GroundRangeDetectedPreprocessing:
         """Returns the input filename without its extension."""
         return os.path.basename(safe_file).replace(".SAFE", "")
 
+    def get_output_filepath(self, x: int, y: int, w: int, h: int):
+        """Returns the path of the output file of a subset, without its extension."""
+        filename = self.get_filename(self.safe_file)
+        filepath = os.path.join(self.output_folder, "{}_sigma0_VV_dB".format(filename))
+        return filepath + "_{}_{}_{}_{}".format(x, y, w, h)
+
     def get_workflow(self, x: int, y: int, w: int, h: int):
         """Create a Direct Acyclic Graph (DAG) XML specification for use in GPT's SNAP.
 
@@ -119,9 +185,7 @@ class Sentinel1GroundRangeDetectedPreprocessing:
         -------
             A Workflow object with all XML representations parsed for the nodes.
         """
-        filename = self.get_filename(self.safe_file)
-        filepath = os.path.join(self.output_folder, "{}_sigma0_VV_dB".format(filename))
-        out_filepath = filepath + "_{}_{}_{}_{}".format(x, y, w, h)
+        out_filepath = self.get_output_filepath(x, y, w, h)
 
         g = parse_recipe("blank")
 
@@ -211,6 +275,31 @@ class Sentinel1GroundRangeDetectedPreprocessing:
         return g
 
 
+def get_output_subsets(results_dir):
+    """Return the subsets (x, y, width, height) and the paths of the output files in a folder, by scene ID."""
+    outputs = {}
+    if not os.path.isdir(results_dir):
+        return outputs
+    for filename in os.listdir(results_dir):
+        match = OUTPUT_FILENAME_PATTERN.match(filename)
+        if match is not None:
+            subset = tuple(int(value) for value in match.group(2, 3, 4, 5))
+            outputs.setdefault(match.group(1), []).append(
+                (subset, os.path.join(results_dir, os.path.splitext(filename)[0]))
+            )
+    return outputs
+
+
+def is_scene_complete(zip_filepath, subsets):
+    """Return whether the subsets (x, y, width, height) cover the whole scene of a zip file."""
+    try:
+        scene = identify(zip_filepath)
+    except Exception:
+        # An unreadable scene is processed again, and the processing reports it
+        return False
+    return covers_scene(subsets, scene.lines, scene.samples)
+
+
 cli = typer.Typer()
 
 
@@ -231,66 +320,260 @@ def calibrate(
         help="Path of output folder to " "save results.",
     ),
     limit: int = typer.Option(None, help="Limit"),
+    full_extraction: bool = typer.Option(
+        False,
+        "--full-extraction",
+        help="Extract all files of the scenes instead of the VV members only.",
+    ),
+    workers: int = typer.Option(
+        None,
+        "--workers",
+        "-w",
+        help="Largest number of subsets processed at a time, the plan of a scene may run fewer. Default: cores // 2.",
+    ),
+    memory: float = typer.Option(
+        None,
+        "--memory",
+        help="Memory budget in GB for the heaps of the subsets processed at a time. Default: the available RAM.",
+    ),
+    cores: int = typer.Option(
+        None, "--cores", help="Number of cores to use. Default: all of them."
+    ),
+    lookahead: int = typer.Option(
+        1,
+        "--lookahead",
+        help="Number of scenes extracted ahead of the one being processed.",
+    ),
+    scratch_quota: float = typer.Option(
+        None,
+        "--scratch-quota",
+        help="Largest size in GB of the extracted scenes on disk at a time. Default: no limit.",
+    ),
+    ledger_filepath: str = typer.Option(
+        None,
+        "--ledger",
+        metavar="/path/to/ledger.sqlite",
+        help="Path of the job ledger of the run. Default: ledger.sqlite in the output folder.",
+    ),
+    retries: int = typer.Option(
+        3, "--retries", help="Largest number of attempts of a scene."
+    ),
+    backoff: float = typer.Option(
+        60.0,
+        "--backoff",
+        help="Seconds before retrying a failed scene, doubled with every attempt.",
+    ),
+    status: bool = typer.Option(
+        False, "--status", help="Show the status of the ledger and exit."
+    ),
 ):
-    """Preprocessing Sentinel-1 Ground Range Detected SAR images."""
+    """Preprocessing Sentinel-1 Ground Range Detected SAR images.
+
+    The next scenes are extracted and the processed ones are removed while a scene is being processed. Each scene is
+    split into subsets that fit in the memory budget and use the cores, see `plan_tiles`. The state of every scene and
+    subset is kept in a job ledger, so a run resumes where the previous one stopped and retries the failed scenes.
+    """
+    if ledger_filepath is None:
+        os.makedirs(results_dir, exist_ok=True)
+        ledger_filepath = os.path.join(results_dir, "ledger.sqlite")
+    if status:
+        # The ledger may be in use by a live run, so it is only read
+        try:
+            ledger = JobLedger(ledger_filepath, read_only=True)
+        except FileNotFoundError as e:
+            raise typer.BadParameter(str(e))
+        typer.echo(ledger.report())
+        ledger.close()
+        return
+    ledger = JobLedger(ledger_filepath, max_attempts=retries, backoff=backoff)
     # Walk files
     zip_filepaths = []
     for root, _, filenames in os.walk(dataset):
         for filename in filenames:
             if filename.endswith(".zip"):
-                # Verify is file already exists using regex pattern based on scene ID
-                pattern = os.path.join(results_dir, filename.replace(".zip", "*"))
-                if glob.glob(pattern):
-                    # Skip if the file already exists in the output folder
-                    continue
-                zip_filepath = os.path.join(root, filename)
-                zip_filepaths.append(zip_filepath)
-    # Limit files
-    zip_filepaths = zip_filepaths[:limit]
+                zip_filepaths.append(os.path.join(root, filename))
+    # Scenes that are not in the ledger but have outputs, from runs without a ledger, are done only if their outputs
+    # cover the whole scene. The others are processed again.
+    known = set(ledger.get_scene_ids())
+    zip_filepaths = [z for z in zip_filepaths if get_scene_id(z) not in known]
+    outputs = get_output_subsets(results_dir) if zip_filepaths else {}
+    done = set()
+    incomplete = 0
+    for zip_filepath in zip_filepaths:
+        scene = get_scene_id(zip_filepath)
+        if scene not in outputs:
+            continue
+        if is_scene_complete(zip_filepath, [subset for subset, _ in outputs[scene]]):
+            done.add(scene)
+        else:
+            incomplete += 1
+    added = ledger.add_scenes(zip_filepaths, done)
+    for scene in done:
+        for subset, output_filepath in outputs[scene]:
+            ledger.set_subset(scene, subset, DONE, output_path=output_filepath)
+    typer.echo("{} new scenes in the ledger: {}".format(added, ledger_filepath))
+    if incomplete:
+        typer.echo(
+            "{} scenes with partial outputs of a run without a ledger are processed again.".format(
+                incomplete
+            )
+        )
 
     typer.echo("\nSentinel-1 SAR GRD Preprocessing\n")
-    # List of tuples: Output dataset dir, zip filepath, safe filepath
-    args = [
-        (dataset, zip_filepath, zip_filepath.replace(".zip", ".SAFE"))
-        for zip_filepath in zip_filepaths
-    ]
+    patterns = None if full_extraction else SAFE_VV_PATTERNS
+
+    def get_safe_filepath(zip_filepath):
+        return zip_filepath.replace(".zip", ".SAFE")
+
+    extract_seconds = {}
+
+    def extract(zip_filepath):
+        scene = get_scene_id(zip_filepath)
+        ledger.start_extracting(scene)
+        start = time.time()
+        if full_extraction:
+            extract_all_files(zip_filepath, dataset)
+        else:
+            extract_files(zip_filepath, patterns, dataset)
+        extract_seconds[scene] = time.time() - start
+
+    def get_size(zip_filepath):
+        try:
+            return get_extracted_size(zip_filepath, patterns)
+        except zipfile.BadZipfile:
+            # The extraction fails and reports it
+            return 0
+        except Exception:
+            # The scene fails without being extracted, and the attempt counts so it does not block the next runs
+            ledger.start_extracting(get_scene_id(zip_filepath))
+            raise
+
+    def cleanup(zip_filepath):
+        # Remove .SAFE file because it's larger than .zip file
+        shutil.rmtree(get_safe_filepath(zip_filepath), ignore_errors=True)
+
+    memory_budget = get_available_memory() if memory is None else int(memory * GB)
+    cores = cores or os.cpu_count() or 1
+    # Size of the pool, the largest number of workers that a plan of subsets can get
+    workers = workers or max(1, cores // 2)
+    # Scenes attempted and scenes processed by this run
     count = 0
-    with typer.progressbar(args, label="Preprocessing") as progress:
-        for arg in progress:
-            dataset, zip_filepath, safe_filepath = arg
-            typer.echo(
-                "\nInput file: {}".format(
-                    os.path.basename(zip_filepath).replace(".zip", "")
-                )
-            )
-            try:
-                # Try to extract files from zip
-                extract_all_files(zip_filepath, dataset)
-            except zipfile.BadZipfile:
-                # But, if this is corrupted, then skip it.
-                typer.echo(
-                    "Skipping this BadZipFile: {}".format(
-                        os.path.basename(zip_filepath)
-                    )
-                )
-                continue
+    processed = 0
+    # The pool is started before the threads of the pipeline, so its processes are not forked from them
+    with Pool(workers) as pool:
+        scheduler = HeapScheduler(pool, memory_budget)
+
+        def process(zip_filepath):
+            scene = get_scene_id(zip_filepath)
+            ledger.start_running(scene, extract_seconds.pop(scene, None))
+            safe_filepath = get_safe_filepath(zip_filepath)
             # Instance graph
             preprocessing = Sentinel1GroundRangeDetectedPreprocessing(
                 input_safe_file=safe_filepath, output_dir=results_dir
             )
-            subsets = preprocessing.parse_subset(safe_filepath)
+            # The plan depends on the available memory, so the one of the first attempt is kept. Subsets of the plan
+            # that a previous attempt finished are not processed again.
+            saved_plan = ledger.get_plan(scene)
+            if saved_plan is None:
+                plan = preprocessing.plan_subsets(memory_budget, cores)
+                ledger.set_plan(scene, plan.to_dict())
+            else:
+                plan = TilePlan.from_dict(saved_plan)
+                preprocessing.use_plan(plan)
+            done_subsets = ledger.get_done_subsets(scene)
+            subsets = [
+                subset
+                for subset in plan.tiles
+                if get_subset_key(subset) not in done_subsets
+            ]
+            typer.echo("Subsets: {}, {} to process".format(plan, len(subsets)))
+
+            def on_start(subset):
+                ledger.set_subset(scene, subset, RUNNING)
+
+            def on_end(subset, result, error):
+                if error is None:
+                    output_filepath, seconds = result
+                    ledger.set_subset(
+                        scene, subset, DONE, seconds, output_path=output_filepath
+                    )
+                else:
+                    ledger.set_subset(scene, subset, FAILED, error=error)
+
             start = time.time()
-            with Pool(4) as pool:
-                pool.map(preprocessing, subsets)
-                pool.close()
-                pool.join()
+            scheduler.map(
+                preprocessing,
+                subsets,
+                [plan.heap] * len(subsets),
+                on_start=on_start,
+                on_end=on_end,
+                max_running=min(plan.workers, workers),
+            )
             end = time.time()
-            typer.echo("Batch preprocessing time: {}s!".format(end - start))
-            count += 1
-            typer.echo("\n{} images have already preprocessed.".format(count))
-            # Remove .SAFE file because it's larger than .zip file
-            shutil.rmtree(safe_filepath)
-    typer.echo("\nIn total, {} SAR images have been preprocessed.".format(count))
+            return end - start
+
+        pipeline = ScenePipeline(
+            extract,
+            process,
+            cleanup,
+            get_size=get_size,
+            scratch_quota=None if scratch_quota is None else int(scratch_quota * 1e9),
+            lookahead=lookahead,
+        )
+        while limit is None or count < limit:
+            zip_filepaths = ledger.get_runnable(
+                limit=None if limit is None else limit - count
+            )
+            if not zip_filepaths:
+                # Wait for the next retry of a failed scene, if any
+                next_retry = ledger.get_next_retry()
+                if next_retry is None:
+                    break
+                typer.echo(
+                    "\nRetrying failed scenes in {:.0f}s...".format(
+                        max(next_retry - time.time(), 0)
+                    )
+                )
+                time.sleep(max(next_retry - time.time(), 0))
+                continue
+            with typer.progressbar(
+                pipeline.run(zip_filepaths),
+                length=len(zip_filepaths),
+                label="Preprocessing",
+            ) as progress:
+                for zip_filepath, seconds, error in progress:
+                    scene = get_scene_id(zip_filepath)
+                    typer.echo("\nInput file: {}".format(scene))
+                    count += 1
+                    if isinstance(error, zipfile.BadZipfile):
+                        # But, if this is corrupted, then skip it.
+                        typer.echo(
+                            "Skipping this BadZipFile: {}".format(
+                                os.path.basename(zip_filepath)
+                            )
+                        )
+                        ledger.fail(scene, error, retry=False)
+                        continue
+                    if isinstance(error, FileNotFoundError):
+                        # The zip file of a scene in the ledger was removed
+                        typer.echo(
+                            "Skipping this missing zip file: {}".format(zip_filepath)
+                        )
+                        ledger.fail(scene, error, retry=False)
+                        continue
+                    if error is not None:
+                        typer.echo("Failed: {!r}".format(error))
+                        ledger.fail(scene, error)
+                        continue
+                    ledger.finish(scene, seconds)
+                    typer.echo("Batch preprocessing time: {}s!".format(seconds))
+                    processed += 1
+                    typer.echo(
+                        "\n{} images have already preprocessed.".format(processed)
+                    )
+    typer.echo("\nIn total, {} SAR images have been preprocessed.\n".format(processed))
+    typer.echo(ledger.report())
+    ledger.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,191 @@
+"""
+Tiling
+Memory-aware tiling of Sentinel-1 scenes into subsets that are pre-processed in parallel with SNAP.
+
+Copyright (c) 2022 Juan Carlos Cedeño Noblecilla
+
+This software is released under the MIT License.
+https://opensource.org/licenses/MIT
+Written by Juan Carlos Cedeño Noblecilla.
+"""
+
+import math
+import os
+
+GB = 1 << 30
+# Rough bytes of JVM heap that the GPT graph of the VV workflow needs per pixel of a subset, and per GPT process
+HEAP_BYTES_PER_PIXEL = 96
+HEAP_OVERHEAD = 1 * GB
+# Smallest heap of a GPT process, and largest one (the previous fixed allocation)
+MIN_HEAP = 2 * GB
+MAX_HEAP = 32 * GB
+# Cost of starting GPT on a subset (JVM, orbit file...), in pixels processed in the same time
+STARTUP_PIXELS = 2 * 10**7
+
+
+def get_available_memory():
+    """Return the RAM available for new processes in bytes, or the total RAM if it is unknown."""
+    try:
+        with open("/proc/meminfo") as file:
+            for line in file:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def get_heap(pixels):
+    """Return the JVM heap in bytes that a subset with a number of pixels needs, at least MIN_HEAP."""
+    return int(max(HEAP_OVERHEAD + HEAP_BYTES_PER_PIXEL * pixels, MIN_HEAP))
+
+
+def get_grid_tiles(height, width, rows, cols, overlap):
+    """Split a scene into a grid of rows x cols tiles, neighbouring tiles overlap by overlap pixels.
+
+    Returns:
+        A list of (x, y, width, height) tuples in raster order, the region of each subset in SNAP.
+    """
+
+    def split(size, parts):
+        edges = [round(i * size / parts) for i in range(parts + 1)]
+        return [
+            (
+                max(0, edges[i] - overlap // 2),
+                min(size, edges[i + 1] + overlap - overlap // 2),
+            )
+            for i in range(parts)
+        ]
+
+    return [
+        (x0, y0, x1 - x0, y1 - y0)
+        for y0, y1 in split(height, rows)
+        for x0, x1 in split(width, cols)
+    ]
+
+
+def covers_scene(tiles, height, width):
+    """Return whether the union of some (x, y, width, height) tiles covers a scene of height x width pixels."""
+
+    def get_edges(values, size):
+        return sorted(set([0, size] + [min(max(value, 0), size) for value in values]))
+
+    xs = get_edges([v for x, _, w, _ in tiles for v in (x, x + w)], width)
+    ys = get_edges([v for _, y, _, h in tiles for v in (y, y + h)], height)
+    # Every cell between consecutive edges of the tiles must be inside one of them
+    for y0, y1 in zip(ys[:-1], ys[1:]):
+        for x0, x1 in zip(xs[:-1], xs[1:]):
+            if not any(
+                x <= x0 and x1 <= x + w and y <= y0 and y1 <= y + h
+                for x, y, w, h in tiles
+            ):
+                return False
+    return True
+
+
+class TilePlan:
+    """Grid of subsets of a scene, with the heap of each GPT process and the number of them that run at a time."""
+
+    def __init__(self, rows, cols, overlap, tiles, heap, workers):
+        self.rows = rows
+        self.cols = cols
+        self.overlap = overlap
+        self.tiles = tiles
+        self.heap = heap
+        self.workers = workers
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def to_dict(self):
+        return {
+            "rows": self.rows,
+            "cols": self.cols,
+            "overlap": self.overlap,
+            "tiles": [list(tile) for tile in self.tiles],
+            "heap": self.heap,
+            "workers": self.workers,
+        }
+
+    @classmethod
+    def from_dict(cls, plan):
+        return cls(
+            plan["rows"],
+            plan["cols"],
+            plan["overlap"],
+            [tuple(tile) for tile in plan["tiles"]],
+            plan["heap"],
+            plan["workers"],
+        )
+
+    def __repr__(self):
+        return "TilePlan({}x{} tiles, {} px overlap, {:.1f}G heap, {} workers)".format(
+            self.rows, self.cols, self.overlap, self.heap / GB, self.workers
+        )
+
+
+def plan_tiles(
+    height,
+    width,
+    memory_budget=None,
+    cores=None,
+    cores_per_tile=2,
+    overlap_ratio=0.08,
+    min_overlap=64,
+    max_grid=8,
+):
+    """Choose the grid of subsets of a scene that is pre-processed in the least time within a memory budget.
+
+    Every grid up to max_grid x max_grid is tried. Its tiles run cores // cores_per_tile at a time, or fewer if their
+    heaps do not fit in the budget, and its time is estimated as the number of rounds times the pixels of the largest
+    tile, plus a startup cost per tile. More tiles use more cores, but each one has an overlap and a startup cost and
+    the scene is read again. Ties go to the grid with fewer tiles. Nothing here calls SNAP, a scene is given by its
+    dimensions.
+
+    Args:
+        height (int): Number of lines of the scene.
+        width (int): Number of samples of the scene.
+        memory_budget (int): Bytes of RAM for the heaps of the GPT processes. Default: the available RAM.
+        cores (int): Number of cores. Default: the number of cores of the node.
+        cores_per_tile (int): Cores used by each GPT process.
+        overlap_ratio (float): Overlap between neighbouring tiles, as a fraction of the size of a tile. The default
+            gives the same overlap as the previous 52% quadrants in a 2x2 grid.
+        min_overlap (int): Smallest overlap in pixels, so the filter windows at the borders see the same pixels.
+        max_grid (int): Largest number of rows and columns of the grid.
+
+    Returns:
+        plan (TilePlan): The grid, its tiles, the heap of each GPT process and the number of them at a time.
+    """
+    if memory_budget is None:
+        memory_budget = get_available_memory()
+    if cores is None:
+        cores = os.cpu_count() or 1
+    max_workers = max(1, cores // cores_per_tile)
+    best = None
+    for rows in range(1, max_grid + 1):
+        for cols in range(1, max_grid + 1):
+            overlap = max(
+                min_overlap,
+                int(math.ceil(overlap_ratio * max(height / rows, width / cols))),
+            )
+            tiles = get_grid_tiles(height, width, rows, cols, overlap)
+            pixels = max(w * h for _, _, w, h in tiles)
+            heap = get_heap(pixels)
+            if heap > min(memory_budget, MAX_HEAP):
+                continue
+            workers = min(max_workers, len(tiles), memory_budget // heap)
+            cost = (
+                math.ceil(len(tiles) / workers) * pixels + len(tiles) * STARTUP_PIXELS
+            )
+            if best is None or (cost, len(tiles)) < best[0]:
+                best = (
+                    (cost, len(tiles)),
+                    TilePlan(rows, cols, overlap, tiles, heap, workers),
+                )
+    if best is None:
+        raise ValueError(
+            "A scene of {}x{} pixels does not fit in {:.1f}G of memory with up to {}x{} tiles.".format(
+                height, width, memory_budget / GB, max_grid, max_grid
+            )
+        )
+    return best[1]
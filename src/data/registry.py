@@ -0,0 +1,345 @@
+"""
+Registry
+Compact, columnar registry of the images of a Dataset.
+
+Copyright (c) 2022 Juan Carlos Cedeño Noblecilla
+
+This software is released under the MIT License.
+https://opensource.org/licenses/MIT
+Written by Juan Carlos Cedeño Noblecilla.
+"""
+
+import os
+from array import array
+from collections.abc import Mapping, MutableMapping, Sequence
+
+import numpy as np
+
+
+class _Missing:
+    """Placeholder of a field that an image does not have. It is unpickled as the same object."""
+
+    __slots__ = ()
+
+    def __reduce__(self):
+        return "_MISSING"
+
+    def __repr__(self):
+        return "<missing>"
+
+
+_MISSING = _Missing()
+
+# Largest range of IDs, relative to the number of images of a source, looked up with a dense table
+_MAX_TABLE_SPARSITY = 4
+
+
+def _to_numpy(values, dtype):
+    # Copy, a view would prevent the array from growing
+    return (
+        np.frombuffer(values, dtype=dtype).copy() if len(values) else np.zeros(0, dtype)
+    )
+
+
+def _is_int(value):
+    return isinstance(value, (int, np.integer)) and not isinstance(value, bool)
+
+
+class _Column:
+    """Values of a field of every image. Integers are packed into a 64-bit array, until any other value is stored."""
+
+    __slots__ = ("values",)
+
+    def __init__(self, length=0):
+        self.values = array("q") if length == 0 else [_MISSING] * length
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        return self.values[i]
+
+    def _unpack(self):
+        if isinstance(self.values, array):
+            self.values = self.values.tolist()
+
+    def append(self, value):
+        if self.values.__class__ is array and (type(value) is int or _is_int(value)):
+            try:
+                self.values.append(value)
+                return
+            except OverflowError:
+                pass
+        self._unpack()
+        self.values.append(value)
+
+    def __setitem__(self, i, value):
+        if isinstance(self.values, array) and _is_int(value):
+            try:
+                self.values[i] = value
+                return
+            except OverflowError:
+                pass
+        self._unpack()
+        self.values[i] = value
+
+    def to_numpy(self):
+        if isinstance(self.values, array):
+            return _to_numpy(self.values, np.int64)
+        return np.array(
+            [None if value is _MISSING else value for value in self.values],
+            dtype=object,
+        )
+
+
+class ImageInfo(MutableMapping):
+    """Dictionary-like view of the fields of an image in an ImageRegistry."""
+
+    __slots__ = ("registry", "index")
+
+    def __init__(self, registry, index):
+        self.registry = registry
+        self.index = index
+
+    def __getitem__(self, key):
+        return self.registry.get_field(self.index, key)
+
+    def __setitem__(self, key, value):
+        self.registry.set_field(self.index, key, value)
+
+    def __delitem__(self, key):
+        raise TypeError("Fields of a registered image cannot be deleted.")
+
+    def __iter__(self):
+        for key in self.registry.fields:
+            if self.registry.has_field(self.index, key):
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class ImageRegistry(Sequence):
+    """Columnar registry of images, read and written like the list of image_info dictionaries it replaces.
+
+    Every field is stored in a column: sources as small integer codes, paths as an interned directory plus a file
+    name, and integer fields (IDs, sizes, offsets...) packed in 64-bit arrays. registry[i] returns an ImageInfo view
+    of the i-th image instead of a dictionary. Source image IDs are looked up in O(1) with a dense table per source
+    when they are integers in a compact range, or with a dictionary otherwise.
+    """
+
+    def __init__(self):
+        self._sources = []
+        self._source_codes = {}
+        self._codes = array("H")
+        self._directories = []
+        self._directory_codes = {}
+        self._path_directories = array("l")
+        self._path_names = []
+        self._ids = _Column()
+        self._extra = {}
+        self._lookups = None
+
+    @property
+    def fields(self):
+        return ["id", "source", "path"] + list(self._extra)
+
+    def __len__(self):
+        return len(self._codes)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [ImageInfo(self, k) for k in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("Image index out of range.")
+        return ImageInfo(self, i)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_lookups"] = None
+        return state
+
+    def _code(self, values, codes, value):
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(values)
+            values.append(value)
+        return code
+
+    def add(self, source, image_id, path, **kwargs):
+        """Register an image and return its index."""
+        index = len(self._codes)
+        code = self._source_codes.get(source)
+        if code is None:
+            code = self._code(self._sources, self._source_codes, source)
+        self._codes.append(code)
+        self._ids.append(image_id)
+        if isinstance(path, str):
+            directory, separator, name = path.rpartition(os.sep)
+            directory += separator
+            code = self._directory_codes.get(directory)
+            if code is None:
+                code = self._code(self._directories, self._directory_codes, directory)
+            self._path_directories.append(code)
+            self._path_names.append(name)
+        else:
+            self._path_directories.append(-1)
+            self._path_names.append(path)
+        if kwargs.keys() == self._extra.keys():
+            for key, value in kwargs.items():
+                self._extra[key].append(value)
+        else:
+            for key, column in self._extra.items():
+                column.append(kwargs.pop(key, _MISSING))
+            for key, value in kwargs.items():
+                self._extra[key] = _Column(index)
+                self._extra[key].append(value)
+        self._lookups = None
+        return index
+
+    def append(self, image_info):
+        """Register an image from an image_info dictionary."""
+        image_info = dict(image_info)
+        self.add(
+            image_info.pop("source"),
+            image_info.pop("id"),
+            image_info.pop("path"),
+            **image_info
+        )
+
+    def has_field(self, index, key):
+        if key in ["id", "source", "path"]:
+            return True
+        return key in self._extra and self._extra[key][index] is not _MISSING
+
+    def get_field(self, index, key):
+        """Return a field of the image at an index."""
+        if key == "id":
+            return self._ids[index]
+        if key == "source":
+            return self._sources[self._codes[index]]
+        if key == "path":
+            directory = self._path_directories[index]
+            if directory < 0:
+                return self._path_names[index]
+            return self._directories[directory] + self._path_names[index]
+        column = self._extra.get(key)
+        value = _MISSING if column is None else column[index]
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def set_field(self, index, key, value):
+        """Set a field of the image at an index."""
+        if key == "source":
+            self._codes[index] = self._code(self._sources, self._source_codes, value)
+        elif key == "path":
+            self._path_directories[index] = -1
+            self._path_names[index] = value
+        elif key == "id":
+            self._ids[index] = value
+        else:
+            if key not in self._extra:
+                self._extra[key] = _Column(len(self))
+            self._extra[key][index] = value
+            return
+        self._lookups = None
+
+    def get_column(self, key):
+        """Return a field of every image as a NumPy array, e.g. the widths."""
+        if key == "id":
+            return self._ids.to_numpy()
+        if key == "source":
+            return np.array(self._sources, dtype=object)[
+                _to_numpy(self._codes, np.uint16)
+            ]
+        if key == "path":
+            return np.array([self.get_field(i, "path") for i in range(len(self))])
+        if key not in self._extra:
+            raise KeyError(key)
+        return self._extra[key].to_numpy()
+
+    def build_lookups(self):
+        """Build the lookup tables from source image IDs to indices. Later registrations invalidate them."""
+        codes = _to_numpy(self._codes, np.uint16)
+        ids = self._ids.to_numpy()
+        lookups = []
+        for code in range(len(self._sources)):
+            indices = np.flatnonzero(codes == code)
+            source_ids = ids[indices]
+            if source_ids.dtype == np.int64 and len(source_ids):
+                low, high = source_ids.min(), source_ids.max()
+                if high - low < _MAX_TABLE_SPARSITY * len(source_ids) + 1024:
+                    table = np.full(high - low + 1, -1, dtype=np.int64)
+                    # As with a dictionary, the last image with a repeated ID wins
+                    table[source_ids - low] = indices
+                    lookups.append((int(low), table))
+                    continue
+            lookups.append(
+                (
+                    None,
+                    {str(i): index for i, index in zip(source_ids, indices.tolist())},
+                )
+            )
+        self._lookups = lookups
+        return lookups
+
+    def index_of(self, source, image_id):
+        """Return the index of an image given its source and its ID in the source, or raise KeyError."""
+        lookups = self._lookups or self.build_lookups()
+        code = self._source_codes.get(source)
+        if code is None:
+            raise KeyError("{}.{}".format(source, image_id))
+        low, table = lookups[code]
+        if low is None:
+            return table["{}".format(image_id)]
+        if _is_int(image_id) and 0 <= image_id - low < len(table):
+            index = table[image_id - low]
+            if index >= 0:
+                return int(index)
+        raise KeyError("{}.{}".format(source, image_id))
+
+
+class SourceImageMap(Mapping):
+    """Read-only mapping from "source.id" keys to image indices of a registry, without a string per image."""
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def __getitem__(self, key):
+        source, _, image_id = key.partition(".")
+        code = self.registry._source_codes.get(source)
+        if code is not None:
+            lookups = self.registry._lookups or self.registry.build_lookups()
+            if lookups[code][0] is not None:
+                # Only the canonical string of an integer ID matches, as it did with "{}.{}".format()
+                try:
+                    if str(int(image_id)) == image_id:
+                        return self.registry.index_of(source, int(image_id))
+                except ValueError:
+                    pass
+                raise KeyError(key)
+        return self.registry.index_of(source, image_id)
+
+    def __iter__(self):
+        lookups = self.registry._lookups or self.registry.build_lookups()
+        for source, (low, table) in zip(self.registry._sources, lookups):
+            if low is None:
+                for image_id in table:
+                    yield "{}.{}".format(source, image_id)
+            else:
+                for offset in np.flatnonzero(table >= 0).tolist():
+                    yield "{}.{}".format(source, low + offset)
+
+    def __len__(self):
+        lookups = self.registry._lookups or self.registry.build_lookups()
+        return sum(
+            len(table) if low is None else int(np.count_nonzero(table >= 0))
+            for low, table in lookups
+        )
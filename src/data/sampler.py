@@ -0,0 +1,138 @@
+"""
+Sampler
+Rank-aware sharding of the images of a Dataset for data-parallel training.
+
+Copyright (c) 2022 Juan Carlos Cedeño Noblecilla
+
+This software is released under the MIT License.
+https://opensource.org/licenses/MIT
+Written by Juan Carlos Cedeño Noblecilla.
+"""
+
+import os
+
+import numpy as np
+
+
+def get_rank_and_world_size(rank=None, world_size=None):
+    """Return the rank of this worker and the number of workers.
+
+    Missing values are read from the HOROVOD_RANK and HOROVOD_SIZE environment variables that horovodrun sets for each
+    worker, so Horovod (and TensorFlow) are not imported. Without them, there is a single worker.
+    """
+    if rank is None:
+        rank = int(os.environ.get("HOROVOD_RANK", 0))
+    if world_size is None:
+        world_size = int(os.environ.get("HOROVOD_SIZE", 1))
+    if world_size < 1 or not 0 <= rank < world_size:
+        raise ValueError(
+            "The rank must be in [0, {}), got {}.".format(world_size, rank)
+        )
+    return rank, world_size
+
+
+class ShardedSampler:
+    """Split the image IDs of every epoch into one shard per rank.
+
+    The shards of an epoch are disjoint and have the same length: a few samples are repeated to pad them, or left out
+    with drop_remainder. Every rank computes all the shards from the same seed and the epoch number, so they agree
+    without communicating and any rank can be simulated in a single process.
+
+    With locality > 0, each rank owns a fixed, contiguous run of image IDs (its home) and reads them in a new order
+    every epoch. A fraction 1 - locality of every shard is exchanged between ranks each epoch, the rest comes from its
+    home, so a rank mostly reads the same files and keeps them in its page cache. With locality=0, every epoch is a
+    global shuffle. Without shuffle, the shards do not change between epochs.
+    """
+
+    def __init__(
+        self,
+        image_ids,
+        rank=None,
+        world_size=None,
+        shuffle=True,
+        seed=0,
+        drop_remainder=False,
+        locality=0.0,
+    ):
+        """
+        Arguments
+        ---------
+        image_ids: image IDs of a prepared Dataset, usually dataset.image_ids.
+        rank: rank of this worker. Default: HOROVOD_RANK, or 0.
+        world_size: number of workers. Default: HOROVOD_SIZE, or 1.
+        shuffle: shuffle the samples every epoch. Otherwise, shards keep the order of image_ids.
+        seed: seed of the shuffling, the same on every rank.
+        drop_remainder: make every shard as long as the shortest one instead of padding the others.
+        locality: fraction of each shard read from the home of the rank, in [0, 1].
+        """
+        if not 0.0 <= locality <= 1.0:
+            raise ValueError("locality must be in [0, 1], got {}.".format(locality))
+        self.image_ids = np.asarray(image_ids)
+        self.rank, self.world_size = get_rank_and_world_size(rank, world_size)
+        if len(self.image_ids) < self.world_size:
+            raise ValueError(
+                "Cannot split {} images into {} shards.".format(
+                    len(self.image_ids), self.world_size
+                )
+            )
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_remainder = drop_remainder
+        self.locality = locality
+        self.epoch = 0
+        # Positions in image_ids of the home of each rank
+        self.homes = np.array_split(np.arange(len(self.image_ids)), self.world_size)
+
+    def __len__(self):
+        if self.drop_remainder:
+            return len(self.image_ids) // self.world_size
+        return -(-len(self.image_ids) // self.world_size)
+
+    def __iter__(self):
+        return iter(self.get_shard().tolist())
+
+    def set_epoch(self, epoch):
+        """Set the epoch of the next iteration. Call it with the same value on every rank."""
+        self.epoch = epoch
+
+    def get_shards(self, epoch=None):
+        """Return the image IDs of every rank for an epoch (default: the current one), as a [world_size, N] array."""
+        epoch = self.epoch if epoch is None else epoch
+        rng = np.random.default_rng([self.seed, epoch])
+        if self.locality > 0.0:
+            positions = self._get_local_positions(rng)
+        else:
+            positions = self._get_global_positions(rng)
+        return self.image_ids[positions]
+
+    def get_shard(self, epoch=None):
+        """Return the image IDs of this rank for an epoch (default: the current one)."""
+        return self.get_shards(epoch)[self.rank]
+
+    def _get_global_positions(self, rng):
+        n = len(self.image_ids)
+        positions = rng.permutation(n) if self.shuffle else np.arange(n)
+        total = len(self) * self.world_size
+        # Pad by wrapping around, the repeated samples are the first ones of the epoch
+        positions = np.resize(positions, total)
+        # Interleave, so every shard spans the whole epoch
+        return positions.reshape(len(self), self.world_size).T
+
+    def _get_local_positions(self, rng):
+        homes = [rng.permutation(home) if self.shuffle else home for home in self.homes]
+        # The same number of samples of every home is exchanged, so the lengths of the shards do not change
+        exchanged = int(round((1.0 - self.locality) * min(len(h) for h in homes)))
+        if exchanged and self.shuffle:
+            pool = rng.permutation(np.concatenate([home[:exchanged] for home in homes]))
+            homes = [
+                np.concatenate(
+                    [pool[r * exchanged : (r + 1) * exchanged], home[exchanged:]]
+                )
+                for r, home in enumerate(homes)
+            ]
+            homes = [rng.permutation(home) for home in homes]
+        shards = np.empty((self.world_size, len(self)), dtype=np.int64)
+        for r, home in enumerate(homes):
+            # Homes differ in one sample at most, pad the short ones with their own first sample
+            shards[r] = np.resize(home, len(self))
+        return shards
@@ -0,0 +1,248 @@
+"""
+Component Features
+Functions to extract geometric and radiometric features of connected components, to tell oil spills from look-alikes.
+
+Copyright (c) 2022 Juan Carlos Cedeño Noblecilla
+
+This software is released under the MIT License.
+https://opensource.org/licenses/MIT
+Written by Juan Carlos Cedeño Noblecilla.
+"""
+
+import cv2
+import numpy as np
+
+from src.features.connected_components import check_connectivity
+
+# Label images are dilated as float32, which holds every integer label up to 2**24 exactly
+MAX_LABELS = 2**24
+# Pixels of the row blocks that the features are accumulated over, so no full-frame temporary array is allocated
+BLOCK_PIXELS = 2**22
+
+
+def get_component_features(bitmask, image, connectivity=8, ring_width=5):
+    """Extract the connected components of a binary image and their features.
+
+    Args:
+        bitmask (np.array): Binary image.
+        image (np.array): Backscatter image of the same height and width, e.g. sigma0 in dB.
+        connectivity (int): Connectivity value. See OpenCV documentation.
+        ring_width (int): Width in pixels of the ring of sea around each component.
+
+    Returns:
+        features (dict): Arrays with a row per component, see `get_label_features`.
+    """
+    check_connectivity(connectivity)
+    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(
+        image=np.asarray(bitmask, dtype=np.uint8), connectivity=connectivity
+    )
+    return get_label_features(
+        labels,
+        image,
+        ring_width=ring_width,
+        num_labels=num_labels,
+        stats=stats,
+        centroids=centroids,
+    )
+
+
+def get_label_features(
+    labels, image, ring_width=5, num_labels=None, stats=None, centroids=None
+):
+    """Extract the features of every component of a label image in a single pass over its pixels.
+
+    Every feature is accumulated with np.bincount over the labels, block of rows by block of rows, so the cost grows
+    with the number of pixels and not with the number of components, and the memory with the size of a block:
+        - area, bbox and centroid, unless they are given by cv2.connectedComponentsWithStats.
+        - perimeter: number of pixel edges between the component and anything else, image borders included.
+        - elongation: ratio of the major to the minor axis of the ellipse with the same second moments.
+        - compactness: 4 * pi * area / perimeter ** 2.
+        - mean and std: backscatter of the component.
+        - ring_mean, ring_std and contrast (ring_mean - mean): backscatter of the sea (label 0) closer than
+          ring_width pixels to the component. Each ring pixel is counted for the components with the lowest and the
+          highest labels around it. The rings of components with a third component around some of their ring pixels
+          are computed again inside their bounding boxes, so the statistics of every ring are exact.
+
+    Args:
+        labels (np.array): Label image with 0 as background, e.g. from `get_connected_component_labels`.
+        image (np.array): Backscatter image of the same height and width.
+        ring_width (int): Width in pixels of the ring of sea around each component.
+        num_labels (int): Number of labels, background included. Default: computed from labels.
+        stats (np.array): Statistics of cv2.connectedComponentsWithStats of the labels, if available.
+        centroids (np.array): Centroids of cv2.connectedComponentsWithStats of the labels, if available.
+
+    Returns:
+        features (dict): Arrays with a row per component, indexed by label - 1: "id", "area", "bbox" as [x, y,
+            width, height], "centroid" as [x, y], "perimeter", "elongation", "compactness", "mean", "std", "ring_mean",
+            "ring_std" and "contrast". Rings without sea have NaN statistics.
+    """
+    labels = np.asarray(labels)
+    height, width = labels.shape[:2]
+    if image.shape[:2] != (height, width):
+        raise ValueError(
+            "The image and the labels must have the same height and width."
+        )
+    if num_labels is None:
+        num_labels = int(labels.max()) + 1 if labels.size else 1
+    if num_labels > MAX_LABELS:
+        raise ValueError(
+            "The label image has more than {} components.".format(MAX_LABELS - 1)
+        )
+    kernel = cv2.getStructuringElement(
+        cv2.MORPH_ELLIPSE, (2 * ring_width + 1, 2 * ring_width + 1)
+    )
+    # Sums of pixels, coordinates and their products, and backscatter of every label
+    area = np.zeros(num_labels)
+    sum_x = np.zeros(num_labels)
+    sum_y = np.zeros(num_labels)
+    sum_xx = np.zeros(num_labels)
+    sum_yy = np.zeros(num_labels)
+    sum_xy = np.zeros(num_labels)
+    value_sum = np.zeros(num_labels)
+    value_squares = np.zeros(num_labels)
+    perimeter = np.zeros(num_labels)
+    ring_count = np.zeros(num_labels)
+    ring_sum = np.zeros(num_labels)
+    ring_squares = np.zeros(num_labels)
+    # Components with a ring pixel that may be close to three components or more
+    crowded = np.zeros(num_labels, dtype=bool)
+    if stats is None:
+        x_min = np.full(num_labels, width, dtype=np.int64)
+        y_min = np.full(num_labels, height, dtype=np.int64)
+        x_max = np.full(num_labels, -1, dtype=np.int64)
+        y_max = np.full(num_labels, -1, dtype=np.int64)
+    columns = np.arange(width, dtype=np.float64)
+    block_rows = max(1, BLOCK_PIXELS // max(width, 1))
+    for top in range(0, height, block_rows):
+        bottom = min(top + block_rows, height)
+        block = labels[top:bottom]
+        flat_labels = block.ravel()
+
+        def accumulate(weights=None):
+            return np.bincount(flat_labels, weights=weights, minlength=num_labels)
+
+        # Geometry
+        xs = np.tile(columns, bottom - top)
+        ys = np.repeat(np.arange(top, bottom, dtype=np.float64), width)
+        area += accumulate()
+        sum_x += accumulate(xs)
+        sum_y += accumulate(ys)
+        sum_xx += accumulate(xs * xs)
+        sum_yy += accumulate(ys * ys)
+        sum_xy += accumulate(xs * ys)
+        if stats is None:
+            np.minimum.at(x_min, flat_labels, xs.astype(np.int64))
+            np.minimum.at(y_min, flat_labels, ys.astype(np.int64))
+            np.maximum.at(x_max, flat_labels, xs.astype(np.int64))
+            np.maximum.at(y_max, flat_labels, ys.astype(np.int64))
+
+        # Perimeter, as the edges between a pixel of a component and a pixel with another label or out of the image
+        padded = np.pad(
+            labels[max(top - 1, 0) : min(bottom + 1, height)],
+            ((int(top == 0), int(bottom == height)), (1, 1)),
+            mode="constant",
+            constant_values=0,
+        )
+        center = padded[1:-1, 1:-1]
+        for neighbour in [
+            padded[:-2, 1:-1],
+            padded[2:, 1:-1],
+            padded[1:-1, :-2],
+            padded[1:-1, 2:],
+        ]:
+            edges = center[center != neighbour]
+            perimeter += np.bincount(edges, minlength=num_labels)
+
+        # Backscatter of the components
+        values = np.asarray(image[top:bottom], dtype=np.float64).ravel()
+        value_sum += accumulate(values)
+        value_squares += accumulate(values * values)
+
+        # Backscatter of the rings of sea: the highest and the lowest labels within ring_width of each sea pixel. The
+        # rows around the block are needed to dilate it, and the ones around those to find the crowded components.
+        window_top = max(top - 2 * ring_width, 0)
+        window_bottom = min(bottom + 2 * ring_width, height)
+        window = labels[window_top:window_bottom]
+        float_window = window.astype(np.float32)
+        highest = cv2.dilate(float_window, kernel)
+        float_window[window == 0] = MAX_LABELS
+        lowest = cv2.erode(float_window, kernel)
+        shared = (window == 0) & (highest > 0) & (lowest != highest)
+        rows = slice(top - window_top, bottom - window_top)
+        near_shared = cv2.dilate(shared.astype(np.uint8), kernel)[rows]
+        crowded[np.unique(block[near_shared > 0])] = True
+        highest = highest[rows].ravel().astype(np.int64)
+        lowest = lowest[rows].ravel().astype(np.int64)
+        sea = flat_labels == 0
+        for ring_labels, selection in [
+            (highest, sea & (highest > 0)),
+            (lowest, sea & (lowest < MAX_LABELS) & (lowest != highest)),
+        ]:
+            bins = ring_labels[selection]
+            ring_values = values[selection]
+            ring_count += np.bincount(bins, minlength=num_labels)
+            ring_sum += np.bincount(bins, weights=ring_values, minlength=num_labels)
+            ring_squares += np.bincount(
+                bins, weights=ring_values * ring_values, minlength=num_labels
+            )
+
+    area = area[1:]
+    if stats is None:
+        bbox = np.stack([x_min, y_min, x_max - x_min + 1, y_max - y_min + 1], axis=1)[
+            1:
+        ]
+    else:
+        bbox = stats[1:, :4].astype(np.int64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if centroids is None:
+            centroid = np.stack([sum_x[1:], sum_y[1:]], axis=1) / area[:, np.newaxis]
+        else:
+            centroid = centroids[1:]
+        # Second moments about the centroid, each pixel is a unit square with a variance of 1/12 along each axis
+        cx = centroid[:, 0]
+        cy = centroid[:, 1]
+        xx = sum_xx[1:] / area - 2 * cx * sum_x[1:] / area + cx * cx + 1 / 12
+        yy = sum_yy[1:] / area - 2 * cy * sum_y[1:] / area + cy * cy + 1 / 12
+        xy = (sum_xy[1:] - cx * sum_y[1:] - cy * sum_x[1:]) / area + cx * cy
+        root = np.sqrt(((xx - yy) / 2) ** 2 + xy**2)
+        major = (xx + yy) / 2 + root
+        minor = (xx + yy) / 2 - root
+        elongation = np.sqrt(major / minor)
+        perimeter = perimeter[1:]
+        compactness = 4 * np.pi * area / perimeter**2
+        mean = value_sum[1:] / area
+        std = np.sqrt(np.maximum(value_squares[1:] / area - mean**2, 0))
+
+    # Rings of the crowded components, inside their bounding box grown by ring_width
+    for label in np.flatnonzero(crowded[1:]) + 1:
+        x, y, w, h = bbox[label - 1]
+        x0, y0 = max(x - ring_width, 0), max(y - ring_width, 0)
+        x1, y1 = min(x + w + ring_width, width), min(y + h + ring_width, height)
+        crop = labels[y0:y1, x0:x1]
+        ring = cv2.dilate((crop == label).astype(np.uint8), kernel) > 0
+        ring_values = np.asarray(image[y0:y1, x0:x1], dtype=np.float64)[
+            ring & (crop == 0)
+        ]
+        ring_count[label] = ring_values.size
+        ring_sum[label] = ring_values.sum()
+        ring_squares[label] = (ring_values * ring_values).sum()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ring_mean = ring_sum[1:] / ring_count[1:]
+        ring_std = np.sqrt(
+            np.maximum(ring_squares[1:] / ring_count[1:] - ring_mean**2, 0)
+        )
+
+    return {
+        "id": np.arange(1, num_labels, dtype=np.int64),
+        "area": area.astype(np.int64),
+        "bbox": bbox,
+        "centroid": centroid,
+        "perimeter": perimeter.astype(np.int64),
+        "elongation": elongation,
+        "compactness": compactness,
+        "mean": mean,
+        "std": std,
+        "ring_mean": ring_mean,
+        "ring_std": ring_std,
+        "contrast": ring_mean - mean,
+    }
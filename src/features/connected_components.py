@@ -8,9 +8,12 @@ This software is released under the MIT License.
 https://opensource.org/licenses/MIT
 Written by Juan Carlos Cedeño Noblecilla.
 """
+
 import cv2
 import numpy as np
 
+from src.coco.utils import encode_mask_crop
+
 
 def get_bitmask(mask, label_class, dtype=np.uint8):
     """Extract a binary image from a segmentation mask.
@@ -38,6 +41,247 @@ def get_connected_component_labels(bitmask, connectivity=8):
         num_labels (list[np.array]): Connected components.
         labels (list[np.array]): Label images.
     """
+    check_connectivity(connectivity)
+    num_labels, labels = cv2.connectedComponents(
+        image=bitmask, connectivity=connectivity
+    )
+    return num_labels, labels
+
+
+def get_instances(mask, connectivity=8, background=0):
+    """Extract every instance (connected component of each class) of a segmentation mask.
+
+    The classes are found with a single histogram of the mask, and each of them is labeled once. Area and bounding
+    box come from the component statistics, and each RLE is encoded from the bounding box crop of its component,
+    so no full-frame mask is allocated per component. The instances are sorted by class and then by component label,
+    the same order as labeling `get_bitmask(mask, c)` with `get_connected_component_labels` class by class.
+
+    Args:
+        mask (np.array): Segmentation mask of integer class values.
+        connectivity (int): Connectivity value. See OpenCV documentation.
+        background (int): Class to skip. Default is 0.
+
+    Returns:
+        instances (list[tuple]): A (class_id, encoded_mask, area, bbox) tuple per instance, where bbox is a
+            [x_min, y_min, width, height] list.
+    """
+    check_connectivity(connectivity)
+    height, width = mask.shape[:2]
+    instances = []
+    classes = np.flatnonzero(np.bincount(mask.ravel()))
+    for c in classes:
+        if c == background:
+            continue
+        num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(
+            image=get_bitmask(mask, c), connectivity=connectivity
+        )
+        # The label k=0 is the background.
+        for k in range(1, num_labels):
+            x, y, w, h, area = stats[k].tolist()
+            crop = labels[y : y + h, x : x + w] == k
+            encoded_mask = encode_mask_crop(crop, x, y, height, width)
+            instances.append((int(c), encoded_mask, area, [x, y, w, h]))
+    return instances
+
+
+def get_component_table(bitmask, connectivity=8):
+    """Extract the table of connected components of a binary image held in memory.
+
+    Components are numbered in raster order of their first pixel. The default algorithm of OpenCV for 8-connectivity
+    scans blocks of 2x2 pixels and numbers them in a slightly different order, so the scan-line algorithm is used.
+
+    Args:
+        bitmask (np.array): Binary image.
+        connectivity (int): Connectivity value. See OpenCV documentation.
+
+    Returns:
+        table (dict): Arrays with a row per component, see `get_tiled_component_table`.
+    """
+    check_connectivity(connectivity)
+    num_labels, _, stats, centroids = cv2.connectedComponentsWithStatsWithAlgorithm(
+        np.asarray(bitmask, dtype=np.uint8), connectivity, cv2.CV_32S, cv2.CCL_SAUF
+    )
+    # The label k=0 is the background.
+    return {
+        "id": np.arange(1, num_labels, dtype=np.int64),
+        "area": stats[1:, cv2.CC_STAT_AREA].astype(np.int64),
+        "bbox": stats[1:, :4].astype(np.int64),
+        "centroid": centroids[1:],
+    }
+
+
+def get_tiled_component_table(
+    source, tile_size=4096, connectivity=8, label_class=None, band=1
+):
+    """Extract the table of connected components of a large mask, reading it tile by tile.
+
+    Each tile is labeled on its own, and the components that touch across the borders of the tiles are merged with a
+    union-find over the labels of the border pixels, so only a tile and a row of border labels are in memory at a time
+    and the full label image is never built. Components are numbered in raster order of their first pixel, so the table
+    matches `get_component_table` of the whole mask.
+
+    Args:
+        source: Mask as a 2D array (e.g. a np.memmap) or an open rasterio dataset.
+        tile_size (int): Height and width of the tiles.
+        connectivity (int): Connectivity value. See OpenCV documentation.
+        label_class (int): Class of the components. Default: None, every non-zero pixel.
+        band (int): Band of a rasterio dataset.
+
+    Returns:
+        table (dict): Arrays with a row per component: "id" (1 to N), "area" in pixels, "bbox" as [x, y, width,
+            height] and "centroid" as [x, y].
+    """
+    check_connectivity(connectivity)
+    if hasattr(source, "read"):
+        from rasterio.windows import Window
+
+        height, width = source.height, source.width
+
+        def read(x, y, w, h):
+            return source.read(band, window=Window(x, y, w, h))
+
+    else:
+        height, width = source.shape[:2]
+
+        def read(x, y, w, h):
+            return np.asarray(source[y : y + h, x : x + w])
+
+    offsets = [0] if connectivity == 4 else [-1, 0, 1]
+    parent = []
+    stats = []
+    sums = []
+    first_pixels = []
+    previous_bottom = np.full(width, -1, dtype=np.int64)
+    for y in range(0, height, tile_size):
+        h = min(tile_size, height - y)
+        bottom = np.full(width, -1, dtype=np.int64)
+        previous_right = None
+        for x in range(0, width, tile_size):
+            w = min(tile_size, width - x)
+            window = read(x, y, w, h)
+            if label_class is None:
+                bitmask = (window != 0).astype(np.uint8)
+            else:
+                bitmask = (window == label_class).astype(np.uint8)
+            num_labels, labels, tile_stats, centroids = (
+                cv2.connectedComponentsWithStats(
+                    image=bitmask, connectivity=connectivity
+                )
+            )
+            # Global label of the local label k is offset + k, and -1 is the background
+            offset = len(parent) - 1
+            parent.extend(range(len(parent), len(parent) + num_labels - 1))
+            tile_stats = tile_stats[1:].astype(np.int64)
+            tile_stats[:, 0] += x
+            tile_stats[:, 1] += y
+            stats.append(tile_stats)
+            areas = tile_stats[:, cv2.CC_STAT_AREA, np.newaxis]
+            sums.append((centroids[1:] + [x, y]) * areas)
+            # Raster index of the first pixel of each component, which is in its top row
+            top_rows = np.concatenate([[-1], tile_stats[:, 1] - y]).astype(np.int32)
+            on_top_row = np.flatnonzero(
+                top_rows[labels] == np.arange(h, dtype=np.int32)[:, np.newaxis]
+            )
+            _, first = np.unique(labels.ravel()[on_top_row], return_index=True)
+            first_y, first_x = np.divmod(on_top_row[first], w)
+            first_pixels.append((first_y + y) * width + first_x + x)
+
+            def to_global(local):
+                return np.where(local > 0, local.astype(np.int64) + offset, -1)
+
+            top = to_global(labels[0])
+            left = to_global(labels[:, 0])
+            bottom[x : x + w] = to_global(labels[-1])
+            # Neighbours across the top border, the row above spans one more pixel at each side
+            above = np.full(w + 2, -1, dtype=np.int64)
+            above[max(0, 1 - x) : 1 + min(w + 1, width - x)] = previous_bottom[
+                max(0, x - 1) : min(width, x + w + 1)
+            ]
+            pairs = [(top, above[1 + d : 1 + d + w]) for d in offsets if y > 0]
+            # Neighbours across the left border, within the rows of this tile
+            if previous_right is not None:
+                beside = np.concatenate([[-1], previous_right, [-1]])
+                pairs.extend((left, beside[1 + d : 1 + d + h]) for d in offsets)
+            previous_right = to_global(labels[:, -1])
+            for a, b in pairs:
+                touching = (a >= 0) & (b >= 0)
+                if not touching.any():
+                    continue
+                for i, j in np.unique(
+                    np.stack([a[touching], b[touching]], axis=1), axis=0
+                ).tolist():
+                    _union(parent, i, j)
+        previous_bottom = bottom
+
+    if not parent:
+        return {
+            "id": np.zeros(0, dtype=np.int64),
+            "area": np.zeros(0, dtype=np.int64),
+            "bbox": np.zeros((0, 4), dtype=np.int64),
+            "centroid": np.zeros((0, 2)),
+        }
+    # Point every label to its root
+    parent = np.array(parent, dtype=np.int64)
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            break
+        parent = grandparent
+    roots, components = np.unique(parent, return_inverse=True)
+    stats = np.concatenate(stats)
+    sums = np.concatenate(sums)
+    first_pixels = np.concatenate(first_pixels)
+    num_components = len(roots)
+    area = np.bincount(
+        components, weights=stats[:, cv2.CC_STAT_AREA], minlength=num_components
+    ).astype(np.int64)
+    x_min = np.full(num_components, width, dtype=np.int64)
+    y_min = np.full(num_components, height, dtype=np.int64)
+    x_max = np.zeros(num_components, dtype=np.int64)
+    y_max = np.zeros(num_components, dtype=np.int64)
+    np.minimum.at(x_min, components, stats[:, 0])
+    np.minimum.at(y_min, components, stats[:, 1])
+    np.maximum.at(x_max, components, stats[:, 0] + stats[:, 2])
+    np.maximum.at(y_max, components, stats[:, 1] + stats[:, 3])
+    first = np.full(num_components, height * width, dtype=np.int64)
+    np.minimum.at(first, components, first_pixels)
+    centroid = (
+        np.stack(
+            [
+                np.bincount(components, weights=sums[:, 0], minlength=num_components),
+                np.bincount(components, weights=sums[:, 1], minlength=num_components),
+            ],
+            axis=1,
+        )
+        / area[:, np.newaxis]
+    )
+    order = np.argsort(first)
+    return {
+        "id": np.arange(1, num_components + 1, dtype=np.int64),
+        "area": area[order],
+        "bbox": np.stack([x_min, y_min, x_max - x_min, y_max - y_min], axis=1)[order],
+        "centroid": centroid[order],
+    }
+
+
+def _union(parent, i, j):
+    """Merge the sets of the labels i and j of a union-find forest."""
+    i = _find(parent, i)
+    j = _find(parent, j)
+    if i != j:
+        # The lower root is kept, so a root is the first label of its component
+        parent[max(i, j)] = min(i, j)
+
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def check_connectivity(connectivity):
+    """Raise a ValueError if the connectivity is not supported by OpenCV."""
     supported_connectivity = [4, 8]
     if connectivity not in supported_connectivity:
         raise ValueError(
@@ -45,7 +289,3 @@ def get_connected_component_labels(bitmask, connectivity=8):
                 supported_connectivity
             )
         )
-    num_labels, labels = cv2.connectedComponents(
-        image=bitmask, connectivity=connectivity
-    )
-    return num_labels, labels
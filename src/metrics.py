@@ -0,0 +1,217 @@
+"""
+Metrics
+Streaming pixel-level metrics of semantic segmentation, computed from a confusion matrix.
+
+Copyright (c) 2022 Juan Carlos Cedeño Noblecilla
+
+This software is released under the MIT License.
+https://opensource.org/licenses/MIT
+Written by Juan Carlos Cedeño Noblecilla.
+"""
+
+from multiprocessing import Pool
+
+import numpy as np
+from tabulate import tabulate
+
+# Loader of (prediction, ground truth) pairs of a worker process, set once by the initializer of the pool
+_worker_load_pair = None
+
+
+class ConfusionMatrix:
+    """Confusion matrix of pixel labels, accumulated one label map at a time.
+
+    Rows are ground truth classes and columns are predicted classes. The memory does not depend on the number or the
+    size of the label maps, and partial matrices (e.g. from several processes) are merged by adding them up.
+    """
+
+    def __init__(self, num_classes=5, class_names=None, ignore_index=None):
+        """
+        Arguments
+        ---------
+        num_classes: number of classes. Ground truth pixels out of [0, num_classes) are ignored.
+        class_names: a name per class, in the order of their values in the label maps. Default: the values. See
+            from_dataset to take them from a dataset.
+        ignore_index: a ground truth value to ignore, e.g. 255 for unlabelled pixels.
+        """
+        self.num_classes = num_classes
+        if class_names is None:
+            class_names = [str(c) for c in range(num_classes)]
+        if len(class_names) != num_classes:
+            raise ValueError("There must be a name per class.")
+        self.class_names = list(class_names)
+        self.ignore_index = ignore_index
+        self.matrix = np.zeros((num_classes, num_classes), dtype=np.int64)
+
+    @classmethod
+    def from_dataset(cls, dataset, ignore_index=None):
+        """Create an empty matrix with the classes of the label maps of a prepared dataset (see
+        src.data.factory.Dataset.label_names)."""
+        return cls(len(dataset.label_names), dataset.label_names, ignore_index)
+
+    def update(self, prediction, ground_truth):
+        """Add a pair of predicted and ground truth label maps of the same shape."""
+        self.matrix += get_confusion_matrix(
+            prediction, ground_truth, self.num_classes, self.ignore_index
+        )
+        return self
+
+    def update_from(self, pairs):
+        """Add every (prediction, ground truth) pair of an iterable, e.g. a generator."""
+        for prediction, ground_truth in pairs:
+            self.update(prediction, ground_truth)
+        return self
+
+    def merge(self, other):
+        """Add the counts of another confusion matrix, or of an array of the same shape."""
+        matrix = other.matrix if isinstance(other, ConfusionMatrix) else other
+        self.matrix += np.asarray(matrix, dtype=np.int64)
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def iou(self):
+        """Intersection over union of every class. Classes absent from both the ground truth and the predictions are
+        NaN."""
+        true_positives = np.diag(self.matrix).astype(np.float64)
+        union = self.matrix.sum(axis=0) + self.matrix.sum(axis=1) - true_positives
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return true_positives / union
+
+    def mean_iou(self):
+        """Mean IoU over the classes that are present in the ground truth or the predictions."""
+        return float(np.nanmean(self.iou())) if self.matrix.any() else float("nan")
+
+    def precision(self):
+        """Precision of every class, NaN if it was never predicted."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.diag(self.matrix) / self.matrix.sum(axis=0)
+
+    def recall(self):
+        """Recall of every class, NaN if it is absent from the ground truth."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.diag(self.matrix) / self.matrix.sum(axis=1)
+
+    def pixel_accuracy(self):
+        """Fraction of pixels with the right class."""
+        total = self.matrix.sum()
+        return float(np.trace(self.matrix) / total) if total else float("nan")
+
+    def summary(self):
+        """Return the metrics of every class and their means as a dictionary."""
+        return {
+            "iou": dict(zip(self.class_names, self.iou().tolist())),
+            "precision": dict(zip(self.class_names, self.precision().tolist())),
+            "recall": dict(zip(self.class_names, self.recall().tolist())),
+            "mean_iou": self.mean_iou(),
+            "pixel_accuracy": self.pixel_accuracy(),
+        }
+
+    def report(self):
+        """Return a table with IoU, precision and recall of every class, and the mean IoU."""
+        rows = [
+            [name, iou, precision, recall]
+            for name, iou, precision, recall in zip(
+                self.class_names, self.iou(), self.precision(), self.recall()
+            )
+        ]
+        rows.append(["mean", self.mean_iou(), None, None])
+        return tabulate(
+            rows,
+            headers=["Class", "IoU", "Precision", "Recall"],
+            floatfmt=".4f",
+            missingval="-",
+        )
+
+
+def get_confusion_matrix(prediction, ground_truth, num_classes=5, ignore_index=None):
+    """Count the pixels of every (ground truth, predicted) pair of classes with a single bincount.
+
+    Args:
+        prediction (np.array): Predicted label map.
+        ground_truth (np.array): Ground truth label map of the same shape.
+        num_classes (int): Number of classes.
+        ignore_index (int): A ground truth value to ignore.
+
+    Returns:
+        matrix (np.array): A [num_classes, num_classes] int64 array, rows are ground truth classes.
+    """
+    prediction = np.asarray(prediction).ravel()
+    ground_truth = np.asarray(ground_truth).ravel()
+    if prediction.shape != ground_truth.shape:
+        raise ValueError(
+            "The prediction and the ground truth must have the same shape."
+        )
+    valid = (ground_truth >= 0) & (ground_truth < num_classes)
+    if ignore_index is not None:
+        valid &= ground_truth != ignore_index
+    # Predictions out of range are counted as errors in a spare column that is dropped
+    prediction = np.where(
+        (prediction >= 0) & (prediction < num_classes), prediction, num_classes
+    )
+    pairs = ground_truth[valid].astype(np.int64) * (num_classes + 1) + prediction[valid]
+    counts = np.bincount(pairs, minlength=num_classes * (num_classes + 1))
+    return counts.reshape(num_classes, num_classes + 1)[:, :num_classes]
+
+
+def evaluate_label_maps(pairs, num_classes=5, class_names=None, ignore_index=None):
+    """Accumulate the confusion matrix of (prediction, ground truth) pairs.
+
+    The pairs are consumed as they are needed, so a generator that loads them lazily keeps the memory constant.
+
+    Returns:
+        A ConfusionMatrix.
+    """
+    confusion_matrix = ConfusionMatrix(num_classes, class_names, ignore_index)
+    return confusion_matrix.update_from(pairs)
+
+
+def _init_worker(load_pair):
+    global _worker_load_pair
+    _worker_load_pair = load_pair
+
+
+def _get_confusion_matrix_of_ids(args):
+    image_ids, num_classes, ignore_index = args
+    matrix = np.zeros((num_classes, num_classes), dtype=np.int64)
+    for image_id in image_ids:
+        prediction, ground_truth = _worker_load_pair(image_id)
+        matrix += get_confusion_matrix(
+            prediction, ground_truth, num_classes, ignore_index
+        )
+    return matrix
+
+
+def evaluate_image_ids(
+    load_pair,
+    image_ids,
+    num_classes=5,
+    class_names=None,
+    ignore_index=None,
+    workers=1,
+    chunksize=8,
+):
+    """Accumulate the confusion matrix of the (prediction, ground truth) pairs of some images, optionally in a process
+    pool.
+
+    load_pair(image_id) returns the pair of an image, e.g. a functools.partial of a module-level function that reads
+    the prediction and calls dataset.load_label_map. With workers > 1 it is sent once to every process, which loads
+    the label maps itself: only the IDs and one matrix per chunk of chunksize images travel between processes, and
+    no batch waits for the others.
+
+    Returns:
+        A ConfusionMatrix.
+    """
+    confusion_matrix = ConfusionMatrix(num_classes, class_names, ignore_index)
+    if workers <= 1:
+        return confusion_matrix.update_from(load_pair(i) for i in image_ids)
+    image_ids = list(image_ids)
+    jobs = [
+        (image_ids[start : start + chunksize], num_classes, ignore_index)
+        for start in range(0, len(image_ids), chunksize)
+    ]
+    with Pool(workers, initializer=_init_worker, initargs=(load_pair,)) as pool:
+        for matrix in pool.imap_unordered(_get_confusion_matrix_of_ids, jobs):
+            confusion_matrix.merge(matrix)
+    return confusion_matrix
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import tempfile
+import time
+
+import click
+from pycocotools.coco import COCO
+from tabulate import tabulate
+
+from src.coco.streaming import COCOStreamWriter, iter_coco_records, load_coco
+
+
+def write_legacy(dataset, filepath):
+    """Write the annotations as from_mklab_to_coco_format did before the streaming writer."""
+    with open(filepath, "w") as f:
+        json.dump(dataset, f, indent=4, sort_keys=True)
+
+
+def write_streaming(dataset, filepath, indent=None):
+    """Write the annotations with the streaming writer."""
+    with COCOStreamWriter(
+        filepath,
+        info=dataset.get("info"),
+        licenses=dataset.get("licenses"),
+        categories=dataset.get("categories"),
+        indent=indent,
+    ) as writer:
+        for image in dataset["images"]:
+            writer.add_image(image)
+        for annotation in dataset["annotations"]:
+            writer.add_annotation(annotation)
+
+
+def timeit(function, *args, repeat=3):
+    """Return the best wall-clock time of a few runs of a function."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+@click.command()
+@click.argument("annotations_filepath", type=click.Path(exists=True))
+@click.option("--repeat", default=3, show_default=True, type=click.IntRange(min=1))
+def main(annotations_filepath, repeat):
+    """Compares file size, write time and load time of the legacy (indented) annotations file against the streaming
+    writer in compact mode."""
+    dataset = {}
+    for key, record in iter_coco_records(annotations_filepath):
+        if key in ["images", "annotations"]:
+            dataset.setdefault(key, []).append(record)
+        else:
+            dataset[key] = record
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        legacy_filepath = os.path.join(tmp_dir, "legacy.json")
+        compact_filepath = os.path.join(tmp_dir, "compact.json")
+        write_time = timeit(write_legacy, dataset, legacy_filepath, repeat=repeat)
+        load_time = timeit(COCO, legacy_filepath, repeat=repeat)
+        rows.append(
+            [
+                "json.dump(indent=4)",
+                os.path.getsize(legacy_filepath) / 1e6,
+                write_time,
+                load_time,
+                None,
+            ]
+        )
+        write_time = timeit(write_streaming, dataset, compact_filepath, repeat=repeat)
+        load_time = timeit(COCO, compact_filepath, repeat=repeat)
+        fast_load_time = timeit(load_coco, compact_filepath, repeat=repeat)
+        rows.append(
+            [
+                "COCOStreamWriter",
+                os.path.getsize(compact_filepath) / 1e6,
+                write_time,
+                load_time,
+                fast_load_time,
+            ]
+        )
+    print(
+        "\n{} images, {} annotations\n".format(
+            len(dataset.get("images", [])), len(dataset.get("annotations", []))
+        )
+    )
+    print(
+        tabulate(
+            rows,
+            headers=["Writer", "Size (MB)", "Write (s)", "COCO() (s)", "load_coco (s)"],
+            floatfmt=".3f",
+            missingval="-",
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import itertools
+
+import click
+from tabulate import tabulate
+
+from src.augmentation import Augmentation
+from src.data.mklab import OilSpillDetectionDataset
+from src.data.packed import PackedDataset
+
+
+@click.command()
+@click.argument("dataset_dir", type=click.Path(exists=True))
+@click.option(
+    "--subset",
+    default="train",
+    show_default=True,
+    type=click.Choice(["train", "test"]),
+)
+@click.option(
+    "--packed",
+    is_flag=True,
+    help="DATASET_DIR is a store written by pack_dataset.",
+)
+@click.option("--batch-size", default=16, show_default=True, type=int)
+@click.option(
+    "--workers",
+    "-w",
+    default=[1, 4],
+    multiple=True,
+    show_default=True,
+    type=int,
+    help="Number of workers to benchmark. Can be repeated.",
+)
+@click.option("--batches", default=20, show_default=True, type=int)
+@click.option("--augment", is_flag=True, help="Apply flips and rotation.")
+@click.option("--processes", is_flag=True, help="Use a process pool.")
+def main(dataset_dir, subset, packed, batch_size, workers, batches, augment, processes):
+    """Measures the throughput in samples/s of Dataset.iter_batches."""
+    if packed:
+        dataset = PackedDataset()
+        dataset.load_packed(dataset_dir)
+    else:
+        dataset = OilSpillDetectionDataset()
+        dataset.load_oil_spills(dataset_dir, subset)
+    dataset.prepare()
+    augmentation = None
+    if augment:
+        augmentation = Augmentation()
+        augmentation.add(Augmentation.horizontal_flip())
+        augmentation.add(Augmentation.vertical_flip())
+        augmentation.add(Augmentation.rotation())
+    rows = []
+    for n in workers:
+        loader = dataset.iter_batches(
+            batch_size,
+            workers=n,
+            shuffle=True,
+            seed=0,
+            augmentation=augmentation,
+            use_processes=processes,
+        )
+        for _ in itertools.islice(loader, batches):
+            pass
+        rows.append([n, loader.samples, loader.seconds, loader.samples_per_second])
+    print(
+        tabulate(
+            rows,
+            headers=["Workers", "Samples", "Seconds", "Samples/s"],
+            floatfmt=".2f",
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
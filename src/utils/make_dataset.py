@@ -3,21 +3,60 @@ import click
 import logging
 from pathlib import Path
 from dotenv import find_dotenv, load_dotenv
-from src.data.mklab import from_mklab_to_coco_format
+from src.data.mklab import check_label_maps, from_mklab_to_coco_format
 
 
 @click.command()
 @click.argument("input_filepath", type=click.Path(exists=True))
 @click.argument("output_filepath", type=click.Path())
-def main(input_filepath, output_filepath):
+@click.option(
+    "--workers",
+    "-w",
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of processes used to convert the masks to COCO annotations.",
+)
+@click.option(
+    "--indent",
+    default=None,
+    type=click.IntRange(min=0),
+    help="Indentation level of annotations.json. By default, it is written in compact form.",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Reprocess only the images added or changed since the last run.",
+)
+@click.option(
+    "--check",
+    is_flag=True,
+    help="Compare the label maps of the converted dataset with the source masks.",
+)
+def main(input_filepath, output_filepath, workers, indent, incremental, check):
     """Runs data processing scripts to turn raw data from (../unprocessed) into
     cleaned data ready to be analyzed (saved in ../processed).
     """
     print("Making dataset...")
     print("(1/2) Oil Spill Dataset (train)...")
-    from_mklab_to_coco_format(input_filepath, output_filepath, "train")
+    from_mklab_to_coco_format(
+        input_filepath, output_filepath, "train", workers, indent, incremental
+    )
     print("(2/2) Oil Spill Dataset (test)...")
-    from_mklab_to_coco_format(input_filepath, output_filepath, "test")
+    from_mklab_to_coco_format(
+        input_filepath, output_filepath, "test", workers, indent, incremental
+    )
+    if check:
+        print("Checking label maps against the source masks...")
+        for subset in ["train", "test"]:
+            mismatches = check_label_maps(output_filepath, input_filepath, subset)
+            if mismatches:
+                raise click.ClickException(
+                    "{} label maps of the {} subset differ from their source masks, e.g. {}".format(
+                        len(mismatches), subset, mismatches[0]
+                    )
+                )
+        print("All label maps match their source masks.")
     logger = logging.getLogger(__name__)
     logger.info("making final data set from raw data")
 
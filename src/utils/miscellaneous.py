@@ -1,5 +1,10 @@
+import fnmatch
+import hashlib
 import os
+import shutil
+import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 import typer
@@ -45,6 +50,155 @@ def extract_all_files(filepath, output_dir=None):
         raise Exception("This file is not a zip file.")
 
 
+def hash_file(filepath, chunk_size=1 << 20):
+    """Return the SHA-1 hex digest of the content of a file."""
+    sha1 = hashlib.sha1()
+    with open(filepath, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def extract_files(filepath, patterns, output_dir=None):
+    """Extract only the members of a zipfile whose name matches any of the glob patterns (see fnmatch).
+
+    Returns:
+        A list with the names of the extracted members.
+    """
+    if not is_zip(filepath):
+        raise Exception("This file is not a zip file.")
+    with zipfile.ZipFile(filepath) as file:
+        members = [
+            name
+            for name in file.namelist()
+            if any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+        ]
+        print(
+            "Extracting {} of {} files from {}...".format(
+                len(members), len(file.namelist()), os.path.basename(filepath)
+            )
+        )
+        file.extractall(path=output_dir, members=members)
+        print("Extraction has been completed successfully!")
+    return members
+
+
+def get_extracted_size(filepath, patterns=None):
+    """Return the size in bytes of the members of a zipfile once extracted, only of those that match any of the glob
+    patterns if given. It reads the central directory of the zipfile, not the members.
+    """
+    if not is_zip(filepath):
+        raise Exception("This file is not a zip file.")
+    with zipfile.ZipFile(filepath) as file:
+        return sum(
+            info.file_size
+            for info in file.infolist()
+            if patterns is None
+            or any(fnmatch.fnmatch(info.filename, pattern) for pattern in patterns)
+        )
+
+
+class ZipReader:
+    """Read the members of a zipfile as if it was an extracted folder.
+
+    Paths are relative to the root of the archive, or to its top-level folder if all the members are inside a single
+    one. The zipfile is opened once per process and only when it is needed, so a reader can be sent to worker
+    processes.
+    """
+
+    _zipfiles = {}
+
+    def __init__(self, filepath):
+        if not is_zip(filepath):
+            raise Exception("This file is not a zip file.")
+        self.filepath = os.path.abspath(filepath)
+        names = self.zipfile.namelist()
+        roots = set(name.split("/", 1)[0] for name in names)
+        if len(roots) == 1 and all("/" in name for name in names):
+            self.root = roots.pop() + "/"
+        else:
+            self.root = ""
+
+    @property
+    def zipfile(self):
+        key = (os.getpid(), self.filepath)
+        if key not in ZipReader._zipfiles:
+            ZipReader._zipfiles[key] = zipfile.ZipFile(self.filepath)
+        return ZipReader._zipfiles[key]
+
+    def close(self):
+        file = ZipReader._zipfiles.pop((os.getpid(), self.filepath), None)
+        if file is not None:
+            file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _name(self, path):
+        return self.root + path.replace(os.sep, "/").strip("/")
+
+    def listdir(self, path=""):
+        """Return the sorted names of the entries of a folder of the archive."""
+        prefix = self._name(path) + "/" if path else self.root
+        names = set()
+        for name in self.zipfile.namelist():
+            if name.startswith(prefix) and len(name) > len(prefix):
+                names.add(name[len(prefix) :].split("/", 1)[0])
+        return sorted(names)
+
+    def isdir(self, path):
+        return len(self.listdir(path)) > 0
+
+    def getinfo(self, path):
+        return self.zipfile.getinfo(self._name(path))
+
+    def read(self, path):
+        """Return the decompressed bytes of a member."""
+        return self.zipfile.read(self._name(path))
+
+    def extract(self, paths, output_dir):
+        """Extract a batch of members to a directory, keeping their basenames.
+
+        Files whose destination already has the same size and modification time are skipped.
+
+        Returns:
+            A dictionary with the number of extracted and skipped files, the extracted bytes and the elapsed seconds.
+        """
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        start = time.time()
+        stats = {"extracted": 0, "skipped": 0, "bytes": 0}
+        for path in paths:
+            info = self.getinfo(path)
+            mtime = time.mktime(info.date_time + (0, 0, -1))
+            dst_filepath = os.path.join(output_dir, os.path.basename(info.filename))
+            if (
+                os.path.exists(dst_filepath)
+                and os.path.getsize(dst_filepath) == info.file_size
+                and int(os.path.getmtime(dst_filepath)) == int(mtime)
+            ):
+                stats["skipped"] += 1
+                continue
+            with self.zipfile.open(info) as src, open(dst_filepath, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.utime(dst_filepath, (mtime, mtime))
+            stats["extracted"] += 1
+            stats["bytes"] += info.file_size
+        stats["seconds"] = time.time() - start
+        print(
+            "Extracted {} files ({} skipped) in {:.2f}s: {:.1f} MB/s".format(
+                stats["extracted"],
+                stats["skipped"],
+                stats["seconds"],
+                stats["bytes"] / 1e6 / max(stats["seconds"], 1e-9),
+            )
+        )
+        return stats
+
+
 def is_zip(filepath):
     """Test if is a ZIP file."""
     ext = os.path.splitext(filepath)[-1][1:]
@@ -52,3 +206,66 @@ def is_zip(filepath):
         return True
     else:
         return False
+
+
+def export_files(filepaths, output_dir, workers=8, hardlink=True):
+    """Export a batch of files to a directory, keeping their basenames.
+
+    Files are hard-linked when source and destination share a filesystem, and copied with a pool of threads
+    otherwise. Files whose destination already has the same size and modification time are skipped, so an export can
+    be repeated cheaply.
+
+    Args:
+        filepaths (list[str]): Paths of the files to export.
+        output_dir (str): Destination directory. It is created if it does not exist.
+        workers (int): Number of threads used to copy files.
+        hardlink (bool): Try to hard-link the files before copying them.
+
+    Returns:
+        A dictionary with the number of linked, copied and skipped files, the exported bytes and the elapsed seconds.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    start = time.time()
+
+    def export(filepath):
+        dst_filepath = os.path.join(output_dir, os.path.basename(filepath))
+        src_stat = os.stat(filepath)
+        try:
+            dst_stat = os.stat(dst_filepath)
+        except FileNotFoundError:
+            dst_stat = None
+        if dst_stat is not None:
+            if src_stat.st_size == dst_stat.st_size and int(src_stat.st_mtime) == int(
+                dst_stat.st_mtime
+            ):
+                return "skipped", 0
+            os.remove(dst_filepath)
+        if hardlink:
+            try:
+                os.link(filepath, dst_filepath)
+                return "linked", src_stat.st_size
+            except OSError:
+                # Different filesystems or links not supported, then copy it
+                pass
+        shutil.copy2(filepath, dst_filepath)
+        return "copied", src_stat.st_size
+
+    stats = {"linked": 0, "copied": 0, "skipped": 0, "bytes": 0}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for status, size in executor.map(export, filepaths):
+            stats[status] += 1
+            stats["bytes"] += size
+    stats["seconds"] = time.time() - start
+    print(
+        "Exported {} files ({} linked, {} copied, {} skipped) in {:.2f}s: {:.1f} files/s, {:.1f} MB/s".format(
+            len(filepaths),
+            stats["linked"],
+            stats["copied"],
+            stats["skipped"],
+            stats["seconds"],
+            len(filepaths) / max(stats["seconds"], 1e-9),
+            stats["bytes"] / 1e6 / max(stats["seconds"], 1e-9),
+        )
+    )
+    return stats
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import click
+from src.data.mklab import OilSpillDetectionDataset
+from src.data.packed import pack_dataset
+
+
+@click.command()
+@click.argument("dataset_dir", type=click.Path(exists=True))
+@click.argument("store_dir", type=click.Path())
+@click.option(
+    "--subset",
+    default="train",
+    show_default=True,
+    type=click.Choice(["train", "test"]),
+)
+def main(dataset_dir, store_dir, subset):
+    """Packs a processed Oil Spill Detection dataset (COCO format) into a memory-mapped store to load with
+    PackedDataset.
+    """
+    dataset = OilSpillDetectionDataset()
+    dataset.load_oil_spills(dataset_dir, subset)
+    dataset.prepare()
+    print("Packing {} images to: {}".format(len(dataset.image_ids), store_dir))
+    pack_dataset(dataset, store_dir)
+    print("Done!")
+
+
+if __name__ == "__main__":
+    main()
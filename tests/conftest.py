@@ -0,0 +1,43 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+# The modules are imported from the src package at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_label_map(rng, height=650, width=1250, shapes=12):
+    """Return a MKLab-like label map with rectangles and ellipses of the classes 1 to 4 over the sea (0)."""
+    label_map = np.zeros((height, width), dtype=np.uint8)
+    for _ in range(shapes):
+        value = int(rng.integers(1, 5))
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        w, h = int(rng.integers(5, 200)), int(rng.integers(5, 120))
+        if rng.random() < 0.5:
+            label_map[y : y + h, x : x + w] = value
+        else:
+            cv2.ellipse(label_map, (x, y), (w // 2, h // 2), 0, 0, 360, value, -1)
+    return label_map
+
+
+@pytest.fixture
+def mklab_dir(tmp_path):
+    """A small MKLab dataset with three train images, laid out as the original one."""
+    rng = np.random.default_rng(0)
+    input_dir = tmp_path / "mklab"
+    for folder in ["images", "labels_1D"]:
+        (input_dir / "train" / folder).mkdir(parents=True)
+    for i in range(3):
+        label_map = make_label_map(rng)
+        image = rng.integers(0, 256, size=label_map.shape, dtype=np.uint8)
+        cv2.imwrite(
+            str(input_dir / "train" / "images" / "img_{}.jpg".format(i)),
+            cv2.cvtColor(image, cv2.COLOR_GRAY2BGR),
+        )
+        cv2.imwrite(
+            str(input_dir / "train" / "labels_1D" / "img_{}.png".format(i)), label_map
+        )
+    return str(input_dir)
@@ -0,0 +1,37 @@
+import cv2
+import numpy as np
+import pytest
+
+from src.coco.utils import (
+    area_from_encoded_mask,
+    bbox_from_encoded_mask,
+    encode_label_image,
+    encode_mask,
+)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_encode_label_image_matches_encode_mask(seed):
+    rng = np.random.default_rng(seed)
+    bitmask = (rng.random((37, 23)) < 0.4).astype(np.uint8)
+    num_labels, labels = cv2.connectedComponents(bitmask, connectivity=4)
+    encoded = encode_label_image(labels)
+    assert len(encoded) == num_labels - 1
+    for k, (encoded_mask, area, bbox) in enumerate(encoded, start=1):
+        expected = encode_mask(labels == k)
+        assert encoded_mask == expected
+        assert area == area_from_encoded_mask(expected)
+        assert bbox == bbox_from_encoded_mask(expected).astype(int).tolist()
+
+
+def test_encode_label_image_of_given_components():
+    labels = np.zeros((6, 5), dtype=np.int32)
+    labels[0:2, 2:4] = 1
+    labels[4:6, 1:5] = 2
+    # A run that ends at the last row of a column and continues at the first row of the next one
+    labels[5, 0] = labels[0, 1] = 3
+    encoded = encode_label_image(labels, component_ids=[3, 1, 4])
+    assert [area for _, area, _ in encoded] == [2, 4, 0]
+    assert encoded[0][0] == encode_mask(labels == 3)
+    assert encoded[0][2] == [0, 0, 2, 6]
+    assert encoded[2][0] == encode_mask(labels == 4)
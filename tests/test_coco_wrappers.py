@@ -0,0 +1,100 @@
+import contextlib
+import copy
+import io
+
+import numpy as np
+import pytest
+from pycocotools.cocoeval import COCOeval
+
+from src.coco.utils import bbox_from_encoded_mask, encode_mask
+from src.coco.wrappers import COCOEvalWrapper, COCOWrapper
+
+HEIGHT, WIDTH = 40, 50
+
+
+def random_mask(rng):
+    mask = np.zeros((HEIGHT, WIDTH), dtype=np.uint8)
+    x, y = int(rng.integers(0, WIDTH - 5)), int(rng.integers(0, HEIGHT - 5))
+    mask[y : y + int(rng.integers(3, 20)), x : x + int(rng.integers(3, 20))] = 1
+    return mask
+
+
+def make_ground_truth_and_detections(seed, num_images=6):
+    """Ground truth with crowd instances, and detections with tied scores, wrong categories and jittered masks."""
+    rng = np.random.default_rng(seed)
+    dataset = {
+        "images": [
+            {"id": i, "height": HEIGHT, "width": WIDTH}
+            for i in range(1, num_images + 1)
+        ],
+        "categories": [{"id": 1, "name": "oil_spill"}, {"id": 2, "name": "look_alike"}],
+        "annotations": [],
+    }
+    detections = []
+    for image_id in range(1, num_images + 1):
+        for _ in range(int(rng.integers(0, 6))):
+            mask = random_mask(rng)
+            encoded_mask = encode_mask(mask)
+            dataset["annotations"].append(
+                {
+                    "id": len(dataset["annotations"]) + 1,
+                    "image_id": image_id,
+                    "category_id": int(rng.integers(1, 3)),
+                    "segmentation": encoded_mask,
+                    "area": float(mask.sum()),
+                    "bbox": bbox_from_encoded_mask(encoded_mask).tolist(),
+                    "iscrowd": int(rng.random() < 0.15),
+                }
+            )
+            if rng.random() < 0.8:
+                # A detection of the instance, shifted by a few pixels
+                detected = np.roll(mask, tuple(rng.integers(-2, 3, size=2)), (0, 1))
+                detections.append((image_id, detected))
+        for _ in range(int(rng.integers(0, 3))):
+            detections.append((image_id, random_mask(rng)))
+    results = [
+        {
+            "image_id": image_id,
+            "category_id": int(rng.integers(1, 3)),
+            "segmentation": encode_mask(mask),
+            # Few distinct scores, so some of them are tied
+            "score": float(rng.integers(1, 5)) / 4,
+        }
+        for image_id, mask in detections
+    ]
+    return dataset, results
+
+
+def run_evaluation(evaluator_class, dataset, results, iou_type, **kwargs):
+    ground_truth = COCOWrapper(copy.deepcopy(dataset), detection_type=iou_type)
+    with contextlib.redirect_stdout(io.StringIO()):
+        detections = ground_truth.loadRes(copy.deepcopy(results))
+        evaluator = evaluator_class(ground_truth, detections, iou_type, **kwargs)
+        evaluator.evaluate()
+        evaluator.accumulate()
+        evaluator.summarize()
+    return evaluator
+
+
+@pytest.mark.parametrize("iou_type", ["segm", "bbox"])
+@pytest.mark.parametrize("seed", range(3))
+def test_evaluation_matches_pycocotools(seed, iou_type):
+    dataset, results = make_ground_truth_and_detections(seed)
+    expected = run_evaluation(COCOeval, dataset, results, iou_type)
+    assert expected.stats[0] > 0
+    for workers in [1, 2]:
+        evaluator = run_evaluation(
+            COCOEvalWrapper, dataset, results, iou_type, workers=workers
+        )
+        np.testing.assert_array_equal(evaluator.stats, expected.stats)
+        np.testing.assert_array_equal(
+            evaluator.eval["precision"], expected.eval["precision"]
+        )
+        np.testing.assert_array_equal(evaluator.eval["recall"], expected.eval["recall"])
+        assert len(evaluator.evalImgs) == len(expected.evalImgs)
+        for result, expected_result in zip(evaluator.evalImgs, expected.evalImgs):
+            if expected_result is None:
+                assert result is None
+                continue
+            for key, value in expected_result.items():
+                np.testing.assert_array_equal(result[key], value)
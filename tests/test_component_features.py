@@ -0,0 +1,87 @@
+import cv2
+import numpy as np
+import pytest
+
+from src.features import component_features
+from src.features.component_features import get_component_features
+
+
+def get_reference_features(labels, image, ring_width):
+    """Features of every component computed one by one from its full-frame mask."""
+    kernel = cv2.getStructuringElement(
+        cv2.MORPH_ELLIPSE, (2 * ring_width + 1, 2 * ring_width + 1)
+    )
+    image = image.astype(np.float64)
+    features = []
+    for label in range(1, int(labels.max()) + 1):
+        mask = labels == label
+        ys, xs = np.nonzero(mask)
+        padded = np.pad(mask, 1)
+        edges = sum(
+            np.count_nonzero(mask & ~neighbour)
+            for neighbour in [
+                padded[:-2, 1:-1],
+                padded[2:, 1:-1],
+                padded[1:-1, :-2],
+                padded[1:-1, 2:],
+            ]
+        )
+        covariance = np.cov(np.stack([xs, ys]), bias=True) + np.eye(2) / 12
+        minor, major = np.linalg.eigvalsh(covariance)
+        ring = (cv2.dilate(mask.astype(np.uint8), kernel) > 0) & (labels == 0)
+        features.append(
+            {
+                "area": mask.sum(),
+                "bbox": [xs.min(), ys.min(), np.ptp(xs) + 1, np.ptp(ys) + 1],
+                "centroid": [xs.mean(), ys.mean()],
+                "perimeter": edges,
+                "elongation": np.sqrt(major / minor),
+                "mean": image[mask].mean(),
+                "std": image[mask].std(),
+                "ring_mean": image[ring].mean() if ring.any() else np.nan,
+                "ring_std": image[ring].std() if ring.any() else np.nan,
+            }
+        )
+    return features
+
+
+@pytest.mark.parametrize("block_pixels", [2**22, 50])
+@pytest.mark.parametrize("seed", range(4))
+def test_features_match_the_components_one_by_one(seed, block_pixels, monkeypatch):
+    monkeypatch.setattr(component_features, "BLOCK_PIXELS", block_pixels)
+    rng = np.random.default_rng(seed)
+    # Dense components, so many rings are shared by three components or more
+    bitmask = cv2.dilate(
+        (rng.random((60, 80)) < 0.02).astype(np.uint8), np.ones((3, 3), np.uint8)
+    )
+    image = rng.normal(size=bitmask.shape).astype(np.float32)
+    ring_width = int(rng.integers(1, 6))
+    features = get_component_features(bitmask, image, ring_width=ring_width)
+    _, labels = cv2.connectedComponents(bitmask, connectivity=8)
+    expected = get_reference_features(labels, image, ring_width)
+    assert len(features["id"]) == len(expected)
+    for key in expected[0]:
+        np.testing.assert_allclose(
+            features[key], [row[key] for row in expected], rtol=1e-6, atol=1e-9
+        )
+    np.testing.assert_allclose(
+        features["contrast"], features["ring_mean"] - features["mean"]
+    )
+
+
+def test_rings_shared_by_three_components_are_exact():
+    labels = np.zeros((9, 9), dtype=np.int32)
+    labels[0, 4] = 1
+    labels[4, 0] = 2
+    labels[4, 8] = 3
+    image = np.arange(81, dtype=np.float32).reshape(9, 9)
+    features = get_component_features(labels > 0, image, ring_width=4)
+    expected = get_reference_features(
+        cv2.connectedComponents((labels > 0).astype(np.uint8))[1], image, 4
+    )
+    np.testing.assert_allclose(
+        features["ring_mean"], [row["ring_mean"] for row in expected]
+    )
+    np.testing.assert_allclose(
+        features["ring_std"], [row["ring_std"] for row in expected]
+    )
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+from src.coco.utils import (
+    area_from_encoded_mask,
+    bbox_from_encoded_mask,
+    encode_mask,
+    encode_mask_crop,
+)
+from src.features.connected_components import (
+    get_bitmask,
+    get_connected_component_labels,
+    get_component_table,
+    get_instances,
+    get_tiled_component_table,
+)
+
+
+def get_baseline_instances(mask, connectivity=8):
+    """Instances of a mask as the original conversion extracted them, one full-frame bitmask per component."""
+    instances = []
+    for c in range(1, int(mask.max()) + 1):
+        num_labels, labels = get_connected_component_labels(
+            get_bitmask(mask, c), connectivity
+        )
+        for k in range(1, num_labels):
+            encoded_mask = encode_mask(get_bitmask(labels, k))
+            instances.append(
+                (
+                    c,
+                    encoded_mask,
+                    int(area_from_encoded_mask(encoded_mask)),
+                    bbox_from_encoded_mask(encoded_mask).astype(int).tolist(),
+                )
+            )
+    return instances
+
+
+@pytest.mark.parametrize("connectivity", [4, 8])
+@pytest.mark.parametrize("seed", range(5))
+def test_get_instances_matches_the_baseline(seed, connectivity):
+    rng = np.random.default_rng(seed)
+    # Noise gives many small components, touching the borders and each other diagonally
+    mask = rng.choice(5, size=(40, 60), p=[0.6, 0.1, 0.1, 0.1, 0.1]).astype(np.uint8)
+    assert get_instances(mask, connectivity) == get_baseline_instances(
+        mask, connectivity
+    )
+
+
+def test_get_instances_of_an_empty_mask():
+    assert get_instances(np.zeros((10, 10), dtype=np.uint8)) == []
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_encode_mask_crop_matches_encode_mask(seed):
+    rng = np.random.default_rng(seed)
+    height, width = 30, 20
+    crop = rng.random((int(rng.integers(1, height)), int(rng.integers(1, width)))) < 0.5
+    # Crops that start at the first row or end at the last one have runs that continue in the next column
+    x = int(rng.integers(0, width - crop.shape[1] + 1))
+    y = int(rng.choice([0, height - crop.shape[0]]))
+    mask = np.zeros((height, width), dtype=np.uint8)
+    mask[y : y + crop.shape[0], x : x + crop.shape[1]] = crop
+    assert encode_mask_crop(crop, x, y, height, width) == encode_mask(mask)
+
+
+@pytest.mark.parametrize("connectivity", [4, 8])
+@pytest.mark.parametrize("tile_size", [7, 16, 100])
+def test_tiled_component_table_matches_the_whole_mask(tile_size, connectivity):
+    rng = np.random.default_rng(tile_size)
+    # Components that cross several tiles and merge through a U turn, plus noise along the borders of the tiles
+    bitmask = (rng.random((45, 70)) < 0.45).astype(np.uint8)
+    bitmask[5:40, 3] = bitmask[5:40, 60] = bitmask[39, 3:61] = 1
+    expected = get_component_table(bitmask, connectivity)
+    table = get_tiled_component_table(bitmask, tile_size, connectivity)
+    for key in ["id", "area", "bbox"]:
+        np.testing.assert_array_equal(table[key], expected[key])
+    np.testing.assert_allclose(table["centroid"], expected["centroid"])
+
+
+def test_tiled_component_table_of_a_class():
+    mask = np.zeros((20, 20), dtype=np.uint8)
+    mask[2:8, 2:18] = 1
+    mask[10:18, 5:9] = 2
+    table = get_tiled_component_table(mask, tile_size=6, label_class=2)
+    np.testing.assert_array_equal(table["bbox"], [[5, 10, 4, 8]])
+    np.testing.assert_array_equal(table["area"], [32])
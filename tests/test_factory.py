@@ -0,0 +1,103 @@
+import pickle
+
+import cv2
+import numpy as np
+import pytest
+
+from src.data.factory import Dataset
+
+
+class SquaresDataset(Dataset):
+    """Color images with a square instance each, saved as PNG files."""
+
+    def load_squares(self, directory, count=3, size=32):
+        self.add_class("squares", 1, "square")
+        for i in range(count):
+            image = np.zeros((size, size, 3), dtype=np.uint8)
+            image[..., 0] = 10 * i
+            image[..., 1] = 50
+            image[..., 2] = 200
+            path = str(directory / "{}.png".format(i))
+            cv2.imwrite(path, image)
+            self.add_image("squares", image_id=i, path=path, width=size, height=size)
+
+    def load_mask(self, image_id):
+        size = self.image_info[image_id]["width"]
+        masks = np.zeros((size, size, 1), dtype=bool)
+        masks[4 : 8 + image_id, 4 : 8 + image_id] = True
+        return masks, np.array([1], dtype=np.int32)
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    dataset = SquaresDataset()
+    dataset.load_squares(tmp_path)
+    dataset.prepare()
+    return dataset
+
+
+def test_cached_loaders_return_copies(dataset):
+    expected_image = dataset.load_image(0)
+    expected_masks, _ = dataset.load_mask(0)
+    dataset.enable_cache()
+    for _ in range(2):
+        image = dataset.load_image(0)
+        masks, class_ids = dataset.load_mask(0)
+        np.testing.assert_array_equal(image, expected_image)
+        np.testing.assert_array_equal(masks, expected_masks)
+        # Callers may modify the arrays in place without changing the cache
+        image[:] = 0
+        masks[:] = False
+    info = dataset.cache_info()
+    assert (info["hits"], info["misses"], info["items"]) == (2, 2, 2)
+
+
+def test_read_only_cache_shares_the_arrays(dataset):
+    dataset.enable_cache(read_only=True)
+    image = dataset.load_image(1)
+    assert dataset.load_image(1) is image
+    assert not image.flags.writeable
+
+
+def test_cache_evicts_the_least_recently_used_images(dataset):
+    image_bytes = dataset.load_image(0).nbytes
+    dataset.enable_cache(max_bytes=2 * image_bytes)
+    for image_id in [0, 1, 0, 2]:
+        dataset.load_image(image_id)
+    dataset.load_image(0)
+    dataset.load_image(1)
+    info = dataset.cache_info()
+    assert info["bytes"] <= 2 * image_bytes
+    # Image 1 was evicted by image 2, image 0 was used again before
+    assert (info["hits"], info["misses"]) == (2, 4)
+
+
+def test_pickled_dataset_keeps_the_size_of_the_cache_but_not_its_contents(dataset):
+    dataset.enable_cache(max_bytes=10**6)
+    dataset.load_image(0)
+    copy = pickle.loads(pickle.dumps(dataset))
+    assert copy.cache_info()["max_bytes"] == 10**6
+    assert copy.cache_info()["items"] == 0
+    np.testing.assert_array_equal(copy.load_image(0), dataset.load_image(0))
+
+
+@pytest.mark.parametrize(
+    "channel_mode,shape",
+    [("rgb", (32, 32, 3)), ("gray", (32, 32, 1)), ("native", (32, 32, 3))],
+)
+def test_channel_modes(dataset, channel_mode, shape):
+    image = dataset.load_image(0, channel_mode=channel_mode)
+    assert image.shape == shape
+    assert image.dtype == np.uint8
+    if channel_mode == "gray":
+        # The same gray levels as decoding the file straight to grayscale
+        expected = cv2.imread(dataset.image_info[0]["path"], cv2.IMREAD_GRAYSCALE)
+        np.testing.assert_array_equal(image[..., 0], expected)
+
+
+def test_cache_follows_the_channel_mode_of_the_dataset(dataset):
+    dataset.enable_cache()
+    assert dataset.load_image(0).shape == (32, 32, 3)
+    dataset.channel_mode = "gray"
+    assert dataset.load_image(0).shape == (32, 32, 1)
+    assert dataset.load_image(0, channel_mode="rgb").shape == (32, 32, 3)
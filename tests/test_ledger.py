@@ -0,0 +1,117 @@
+import time
+
+import pytest
+
+from src.data.preprocessing.ledger import (
+    DONE,
+    FAILED,
+    PENDING,
+    RUNNING,
+    JobLedger,
+    get_subset_key,
+)
+
+
+@pytest.fixture
+def ledger_filepath(tmp_path):
+    return str(tmp_path / "ledger.sqlite")
+
+
+def get_state(ledger, scene):
+    return ledger._execute(
+        "SELECT state, attempts FROM scenes WHERE scene = ?", (scene,)
+    )[0]
+
+
+def run_scene(ledger, scene, error=None):
+    ledger.start_extracting(scene)
+    ledger.start_running(scene, 1.0)
+    if error is None:
+        ledger.finish(scene, 2.0)
+    else:
+        ledger.fail(scene, error)
+
+
+def test_scenes_are_added_once_and_done_ones_are_not_runnable(ledger_filepath):
+    with JobLedger(ledger_filepath) as ledger:
+        assert ledger.add_scenes(["/data/a.zip", "/data/b.zip"], done=["b"]) == 2
+        assert ledger.add_scenes(["/data/a.zip", "/data/c.zip"]) == 1
+        assert sorted(ledger.get_scene_ids()) == ["a", "b", "c"]
+        assert ledger.get_runnable() == ["/data/a.zip", "/data/c.zip"]
+        run_scene(ledger, "a")
+        assert get_state(ledger, "a") == (DONE, 1)
+        assert ledger.get_runnable() == ["/data/c.zip"]
+
+
+def test_failed_scenes_are_retried_after_a_backoff_until_max_attempts(
+    ledger_filepath,
+):
+    with JobLedger(ledger_filepath, max_attempts=3, backoff=10.0) as ledger:
+        ledger.add_scenes(["/data/a.zip"])
+        run_scene(ledger, "a", RuntimeError("first"))
+        assert get_state(ledger, "a") == (FAILED, 1)
+        next_retry = ledger.get_next_retry()
+        assert ledger.get_runnable(now=next_retry - 1) == []
+        assert ledger.get_runnable(now=next_retry) == ["/data/a.zip"]
+        start = time.time()
+        run_scene(ledger, "a", RuntimeError("second"))
+        # The backoff doubles with every attempt
+        assert ledger.get_next_retry() >= start + 2 * 10.0
+        run_scene(ledger, "a", RuntimeError("third"))
+        assert get_state(ledger, "a") == (FAILED, 3)
+        assert ledger.get_runnable(now=float("inf")) == []
+        assert ledger.get_next_retry() is None
+        assert "third" in ledger.report()
+
+
+def test_scenes_failed_without_retry_are_not_runnable(ledger_filepath):
+    with JobLedger(ledger_filepath) as ledger:
+        ledger.add_scenes(["/data/a.zip"])
+        ledger.start_extracting("a")
+        ledger.fail("a", ValueError("corrupted"), retry=False)
+        assert ledger.get_runnable(now=float("inf")) == []
+        assert ledger.get_next_retry() is None
+
+
+def test_a_run_resumes_the_interrupted_scenes_and_subsets(ledger_filepath):
+    subsets = [(0, 0, 10, 10), (5, 0, 10, 10)]
+    ledger = JobLedger(ledger_filepath, max_attempts=2, backoff=0.0)
+    ledger.add_scenes(["/data/a.zip", "/data/b.zip"])
+    ledger.start_extracting("a")
+    ledger.start_running("a", 1.0)
+    ledger.set_plan("a", {"rows": 1, "cols": 2})
+    ledger.set_subset("a", subsets[0], RUNNING)
+    ledger.set_subset("a", subsets[0], DONE, 3.0, output_path="/out/a_0")
+    ledger.set_subset("a", subsets[1], RUNNING)
+    # The run crashes without closing the ledger
+    ledger._connection.close()
+    ledger._lock_file.close()
+    with JobLedger(ledger_filepath, max_attempts=2, backoff=0.0) as ledger:
+        # The interrupted attempt counts, and the scene is retried at once
+        assert get_state(ledger, "a") == (FAILED, 1)
+        assert get_state(ledger, "b") == (PENDING, 0)
+        assert sorted(ledger.get_runnable()) == ["/data/a.zip", "/data/b.zip"]
+        assert ledger.get_plan("a") == {"rows": 1, "cols": 2}
+        assert ledger.get_done_subsets("a") == {get_subset_key(subsets[0])}
+        assert ledger._execute(
+            "SELECT state FROM subsets WHERE subset = ?", (get_subset_key(subsets[1]),)
+        ) == [(PENDING,)]
+
+
+def test_a_ledger_has_a_single_owner(ledger_filepath):
+    with JobLedger(ledger_filepath) as ledger:
+        ledger.add_scenes(["/data/a.zip"])
+        ledger.start_extracting("a")
+        with pytest.raises(RuntimeError, match="used by another run"):
+            JobLedger(ledger_filepath)
+        # Reading the status of a live run does not recover its scenes
+        with JobLedger(ledger_filepath, read_only=True) as reader:
+            assert reader.summary()["extracting"]["scenes"] == 1
+        assert get_state(ledger, "a") == ("extracting", 1)
+    # The lock is released when the ledger is closed
+    JobLedger(ledger_filepath).close()
+
+
+def test_a_missing_ledger_cannot_be_read(ledger_filepath):
+    with pytest.raises(FileNotFoundError):
+        JobLedger(ledger_filepath, read_only=True)
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from src.metrics import (
+    ConfusionMatrix,
+    evaluate_image_ids,
+    evaluate_label_maps,
+    get_confusion_matrix,
+)
+
+NUM_CLASSES = 5
+
+
+def load_random_pair(image_id):
+    """A (prediction, ground truth) pair of an image, with ignored and out-of-range values."""
+    rng = np.random.default_rng(image_id)
+    prediction = rng.integers(0, NUM_CLASSES + 2, size=(37, 53))
+    ground_truth = rng.integers(0, NUM_CLASSES, size=(37, 53))
+    ground_truth[rng.random(ground_truth.shape) < 0.1] = 255
+    return prediction, ground_truth
+
+
+def count_pixels(pairs, ignore_index=255):
+    """The confusion matrix counted pixel by pixel."""
+    matrix = np.zeros((NUM_CLASSES, NUM_CLASSES), dtype=np.int64)
+    for prediction, ground_truth in pairs:
+        for predicted, true in zip(prediction.ravel(), ground_truth.ravel()):
+            if true != ignore_index and predicted < NUM_CLASSES:
+                matrix[true, predicted] += 1
+    return matrix
+
+
+def test_confusion_matrix_counts_every_pixel():
+    pairs = [load_random_pair(i) for i in range(4)]
+    expected = count_pixels(pairs)
+    np.testing.assert_array_equal(
+        sum(get_confusion_matrix(*pair, NUM_CLASSES, 255) for pair in pairs), expected
+    )
+    np.testing.assert_array_equal(
+        evaluate_label_maps(iter(pairs), NUM_CLASSES, ignore_index=255).matrix,
+        expected,
+    )
+    merged = ConfusionMatrix(NUM_CLASSES, ignore_index=255).update_from(pairs[:2])
+    merged += ConfusionMatrix(NUM_CLASSES, ignore_index=255).update_from(pairs[2:])
+    np.testing.assert_array_equal(merged.matrix, expected)
+
+
+def test_pooled_evaluation_matches_serial_evaluation():
+    serial = evaluate_image_ids(load_random_pair, range(20), ignore_index=255)
+    pooled = evaluate_image_ids(
+        load_random_pair, range(20), ignore_index=255, workers=2, chunksize=3
+    )
+    np.testing.assert_array_equal(pooled.matrix, serial.matrix)
+    assert pooled.report() == serial.report()
+
+
+def test_metrics_of_a_known_matrix():
+    confusion_matrix = ConfusionMatrix(2, ["sea", "oil_spill"])
+    confusion_matrix.merge(np.array([[6, 2], [1, 3]]))
+    np.testing.assert_allclose(confusion_matrix.iou(), [6 / 9, 3 / 6])
+    np.testing.assert_allclose(confusion_matrix.precision(), [6 / 7, 3 / 5])
+    np.testing.assert_allclose(confusion_matrix.recall(), [6 / 8, 3 / 4])
+    assert confusion_matrix.mean_iou() == pytest.approx((6 / 9 + 3 / 6) / 2)
+    assert confusion_matrix.pixel_accuracy() == pytest.approx(9 / 12)
+    assert confusion_matrix.summary()["iou"]["oil_spill"] == pytest.approx(0.5)
+    with pytest.raises(ValueError):
+        ConfusionMatrix(2, ["sea"])
@@ -0,0 +1,119 @@
+import json
+import os
+
+import cv2
+import numpy as np
+
+from src.coco.utils import area_from_encoded_mask, bbox_from_encoded_mask, encode_mask
+from src.data.mklab import from_mklab_to_coco_format
+from src.features.connected_components import (
+    get_bitmask,
+    get_connected_component_labels,
+)
+
+
+def load_annotations(output_dir, subset="train"):
+    with open(os.path.join(output_dir, subset, "annotations.json")) as f:
+        return json.load(f)
+
+
+def get_baseline_annotations(label_map):
+    """Annotations of a label map as the original conversion extracted them, one full-frame bitmask per component."""
+    annotations = []
+    for c in range(1, int(label_map.max()) + 1):
+        num_labels, labels = get_connected_component_labels(get_bitmask(label_map, c))
+        for k in range(1, num_labels):
+            encoded_mask = encode_mask(get_bitmask(labels, k))
+            annotations.append(
+                {
+                    "category_id": c,
+                    "segmentation": encoded_mask,
+                    "area": int(area_from_encoded_mask(encoded_mask)),
+                    "bbox": bbox_from_encoded_mask(encoded_mask).astype(int).tolist(),
+                    "iscrowd": 0,
+                }
+            )
+    return annotations
+
+
+def test_conversion_matches_the_baseline(mklab_dir, tmp_path):
+    output_dir = str(tmp_path / "coco")
+    from_mklab_to_coco_format(mklab_dir, output_dir)
+    dataset = load_annotations(output_dir)
+    images = sorted(dataset["images"], key=lambda image: image["id"])
+    assert [image["file_name"] for image in images] == [
+        "img_0.jpg",
+        "img_1.jpg",
+        "img_2.jpg",
+    ]
+    expected = []
+    for image in images:
+        label_map = cv2.imread(
+            os.path.join(
+                mklab_dir,
+                "train",
+                "labels_1D",
+                image["file_name"].replace(".jpg", ".png"),
+            ),
+            cv2.IMREAD_UNCHANGED,
+        )
+        for annotation in get_baseline_annotations(label_map):
+            annotation["image_id"] = image["id"]
+            expected.append(annotation)
+    annotations = sorted(
+        dataset["annotations"], key=lambda annotation: annotation["id"]
+    )
+    assert [annotation["id"] for annotation in annotations] == list(
+        range(annotations[0]["id"], annotations[0]["id"] + len(expected))
+    )
+    for annotation in annotations:
+        del annotation["id"]
+    assert annotations == expected
+
+
+def test_ids_do_not_depend_on_the_workers(mklab_dir, tmp_path):
+    from_mklab_to_coco_format(mklab_dir, str(tmp_path / "serial"), workers=1)
+    from_mklab_to_coco_format(mklab_dir, str(tmp_path / "parallel"), workers=2)
+    assert load_annotations(str(tmp_path / "serial")) == load_annotations(
+        str(tmp_path / "parallel")
+    )
+
+
+def test_incremental_rebuild_keeps_the_ids_of_unchanged_images(mklab_dir, tmp_path):
+    output_dir = str(tmp_path / "coco")
+    from_mklab_to_coco_format(mklab_dir, output_dir)
+    before = load_annotations(output_dir)
+    labels_dir = os.path.join(mklab_dir, "train", "labels_1D")
+    # img_0 is touched without changing it, and a shape is added to img_1
+    for filepath in [
+        os.path.join(mklab_dir, "train", "images", "img_0.jpg"),
+        os.path.join(labels_dir, "img_0.png"),
+    ]:
+        stat = os.stat(filepath)
+        os.utime(filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    label_map = cv2.imread(os.path.join(labels_dir, "img_1.png"), cv2.IMREAD_UNCHANGED)
+    label_map[10:30, 10:30] = 3
+    cv2.imwrite(os.path.join(labels_dir, "img_1.png"), label_map)
+    from_mklab_to_coco_format(mklab_dir, output_dir, incremental=True)
+    after = load_annotations(output_dir)
+    assert after["images"] == before["images"]
+    image_ids = {image["file_name"]: image["id"] for image in after["images"]}
+
+    def get_annotations(dataset, file_name):
+        return [
+            annotation
+            for annotation in dataset["annotations"]
+            if annotation["image_id"] == image_ids[file_name]
+        ]
+
+    for file_name in ["img_0.jpg", "img_2.jpg"]:
+        assert get_annotations(after, file_name) == get_annotations(before, file_name)
+    # The annotations of the changed image get new IDs, which follow the ones of the previous conversion
+    changed = get_annotations(after, "img_1.jpg")
+    assert min(annotation["id"] for annotation in changed) > max(
+        annotation["id"] for annotation in before["annotations"]
+    )
+    expected = get_baseline_annotations(label_map)
+    for annotation in changed:
+        del annotation["id"], annotation["image_id"]
+    assert changed == expected
@@ -0,0 +1,80 @@
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from src.data.mklab import (
+    OilSpillDetectionDataset,
+    check_label_maps,
+    from_mklab_to_coco_format,
+)
+from src.data.packed import PackedDataset, pack_dataset
+
+
+@pytest.fixture
+def datasets(mklab_dir, tmp_path):
+    """The converted MKLab dataset and its packed store."""
+    output_dir = str(tmp_path / "coco")
+    from_mklab_to_coco_format(mklab_dir, output_dir)
+    source = OilSpillDetectionDataset()
+    source.load_oil_spills(output_dir, "train")
+    source.prepare()
+    pack_dataset(source, str(tmp_path / "packed"))
+    packed = PackedDataset()
+    packed.load_packed(str(tmp_path / "packed"))
+    packed.prepare()
+    return source, packed
+
+
+def test_packed_dataset_loads_the_same_images_and_masks(datasets):
+    source, packed = datasets
+    assert packed.image_ids.tolist() == source.image_ids.tolist()
+    assert packed.class_names == source.class_names
+    for image_id in source.image_ids:
+        np.testing.assert_array_equal(
+            packed.load_image(image_id), source.load_image(image_id)
+        )
+        masks, class_ids = source.load_mask(image_id)
+        packed_masks, packed_class_ids = packed.load_mask(image_id)
+        np.testing.assert_array_equal(packed_masks, masks)
+        np.testing.assert_array_equal(packed_class_ids, class_ids)
+
+
+def test_packed_instances_are_read_lazily(datasets):
+    source, packed = datasets
+    for image_id in source.image_ids:
+        masks, class_ids = source.load_mask(image_id)
+        instances = packed.load_instances(image_id)
+        assert len(instances) == len(class_ids)
+        np.testing.assert_array_equal(instances.stack(), masks)
+        for k in range(len(instances)):
+            np.testing.assert_array_equal(instances[k], masks[..., k])
+            crop, (x, y, w, h) = instances.crop(k)
+            ys, xs = np.nonzero(masks[..., k])
+            assert [x, y, w, h] == [
+                xs.min(),
+                ys.min(),
+                xs.max() - xs.min() + 1,
+                ys.max() - ys.min() + 1,
+            ]
+            np.testing.assert_array_equal(crop, masks[y : y + h, x : x + w, k])
+
+
+def test_label_maps_hold_the_values_of_the_source_labels(datasets, mklab_dir, tmp_path):
+    source, packed = datasets
+    for image_id in source.image_ids:
+        file_name = os.path.basename(source.image_info[image_id]["path"])
+        expected = cv2.imread(
+            os.path.join(
+                mklab_dir, "train", "labels_1D", file_name.replace(".jpg", ".png")
+            ),
+            cv2.IMREAD_UNCHANGED,
+        )
+        np.testing.assert_array_equal(source.load_label_map(image_id), expected)
+        np.testing.assert_array_equal(packed.load_label_map(image_id), expected)
+        np.testing.assert_array_equal(
+            packed.load_instances(image_id).label_map(values=packed.label_values),
+            expected,
+        )
+    assert check_label_maps(str(tmp_path / "coco"), mklab_dir) == []
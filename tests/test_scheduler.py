@@ -0,0 +1,180 @@
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+from src.data.preprocessing.scheduler import ByteBudget, HeapScheduler, ScenePipeline
+
+# Number of tasks running in the pool at a time, and its peak, shared by the processes of the pool
+_running = None
+
+
+def test_byte_budget_waits_until_a_reservation_fits():
+    budget = ByteBudget(10)
+    budget.reserve(6)
+    reserved = threading.Event()
+
+    def reserve():
+        budget.reserve(6)
+        reserved.set()
+
+    thread = threading.Thread(target=reserve)
+    thread.start()
+    assert not reserved.wait(0.1)
+    budget.release(6)
+    assert reserved.wait(1)
+    thread.join()
+    assert budget.used == 6
+
+
+def test_byte_budget_lets_a_large_reservation_through_when_empty():
+    budget = ByteBudget(10)
+    budget.reserve(25)
+    assert budget.used == 25
+    assert not budget.fits(1)
+
+
+class Recorder:
+    """Steps of a pipeline run, and the largest extracted size on the scratch disk at a time."""
+
+    def __init__(self, sizes, fail=()):
+        self.sizes = sizes
+        self.fail = fail
+        self.lock = threading.Lock()
+        self.on_disk = 0
+        self.peak = 0
+        self.extracted = []
+        self.cleaned = []
+
+    def extract(self, scene):
+        if scene in self.fail:
+            raise RuntimeError("extract {}".format(scene))
+        with self.lock:
+            self.on_disk += self.sizes[scene]
+            self.peak = max(self.peak, self.on_disk)
+            self.extracted.append(scene)
+
+    def process(self, scene):
+        time.sleep(0.01)
+        return scene * 10
+
+    def cleanup(self, scene):
+        with self.lock:
+            if scene in self.extracted:
+                self.on_disk -= self.sizes[scene]
+            self.cleaned.append(scene)
+
+    def get_size(self, scene):
+        if self.sizes[scene] is None:
+            raise FileNotFoundError(scene)
+        return self.sizes[scene]
+
+
+@pytest.mark.parametrize("lookahead", [1, 3])
+def test_pipeline_keeps_the_order_and_the_scratch_quota(lookahead):
+    recorder = Recorder({scene: 4 for scene in range(8)})
+    pipeline = ScenePipeline(
+        recorder.extract,
+        recorder.process,
+        recorder.cleanup,
+        get_size=recorder.get_size,
+        scratch_quota=10,
+        lookahead=lookahead,
+    )
+    assert list(pipeline.run(range(8))) == [
+        (scene, scene * 10, None) for scene in range(8)
+    ]
+    assert recorder.peak <= 10
+    assert sorted(recorder.cleaned) == list(range(8))
+
+
+def test_pipeline_reports_the_errors_of_each_scene_and_goes_on():
+    # Scene 1 fails to extract and the size of scene 2 cannot be read
+    recorder = Recorder({0: 1, 1: 1, 2: None, 3: 1}, fail=[1])
+    pipeline = ScenePipeline(
+        recorder.extract,
+        recorder.process,
+        recorder.cleanup,
+        get_size=recorder.get_size,
+        scratch_quota=10,
+    )
+    results = list(pipeline.run(range(4)))
+    assert [(scene, result) for scene, result, _ in results] == [
+        (0, 0),
+        (1, None),
+        (2, None),
+        (3, 30),
+    ]
+    assert results[0][2] is None and results[3][2] is None
+    assert isinstance(results[1][2], RuntimeError)
+    assert isinstance(results[2][2], FileNotFoundError)
+    assert sorted(recorder.cleaned) == list(range(4))
+
+
+def test_pipeline_removes_the_scenes_extracted_ahead_when_stopped():
+    recorder = Recorder({scene: 1 for scene in range(5)})
+    pipeline = ScenePipeline(
+        recorder.extract, recorder.process, recorder.cleanup, lookahead=2
+    )
+    run = pipeline.run(range(5))
+    assert next(run) == (0, 0, None)
+    run.close()
+    assert recorder.on_disk == 0
+    assert sorted(recorder.cleaned) == sorted(recorder.extracted)
+
+
+def _init_counter(running):
+    global _running
+    _running = running
+
+
+def _count_running(task):
+    with _running.get_lock():
+        _running[0] += 1
+        _running[1] = max(_running[1], _running[0])
+    time.sleep(0.05)
+    with _running.get_lock():
+        _running[0] -= 1
+    return task * 2
+
+
+@pytest.mark.parametrize(
+    "memory_budget,max_running,peak", [(None, None, 4), (10, None, 2), (None, 1, 1)]
+)
+def test_heap_scheduler_runs_the_tasks_that_fit(memory_budget, max_running, peak):
+    running = multiprocessing.Array("i", 2)
+    with multiprocessing.Pool(
+        4, initializer=_init_counter, initargs=(running,)
+    ) as pool:
+        scheduler = HeapScheduler(pool, memory_budget)
+        started = []
+        ended = []
+        results = scheduler.map(
+            _count_running,
+            range(8),
+            [4] * 8,
+            on_start=started.append,
+            on_end=lambda task, result, error: ended.append((task, result, error)),
+            max_running=max_running,
+        )
+    assert results == [task * 2 for task in range(8)]
+    assert started == list(range(8))
+    assert sorted(ended) == [(task, task * 2, None) for task in range(8)]
+    assert 1 <= running[1] <= peak
+
+
+def test_heap_scheduler_raises_the_errors_of_on_end_once_every_task_ended():
+    def on_end(task, result, error):
+        ended.append(task)
+        if task == 1:
+            raise RuntimeError("on_end")
+
+    ended = []
+    running = multiprocessing.Array("i", 2)
+    with multiprocessing.Pool(
+        2, initializer=_init_counter, initargs=(running,)
+    ) as pool:
+        with pytest.raises(RuntimeError, match="on_end"):
+            HeapScheduler(pool).map(_count_running, range(4), [1] * 4, on_end=on_end)
+    assert sorted(ended) == list(range(4))
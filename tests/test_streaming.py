@@ -0,0 +1,109 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from src.coco.utils import encode_mask
+
+from src.coco.streaming import (
+    COCOResultsReader,
+    COCOResultsWriter,
+    COCOStreamWriter,
+    iter_coco_records,
+)
+
+HEADER = {
+    "info": {"description": "test"},
+    "licenses": [{"id": 1, "name": "Non-Commercial"}],
+    "categories": [{"id": 1, "name": "oil_spill"}, {"id": 2, "name": "look_alike"}],
+}
+
+
+def make_dataset(num_images=5):
+    images = [{"id": i, "file_name": "{}.jpg".format(i)} for i in range(num_images)]
+    annotations = [
+        {
+            "id": 10 * i + k,
+            "image_id": i,
+            "category_id": k % 2 + 1,
+            "bbox": [k, i, 1, 1],
+        }
+        for i in range(num_images)
+        for k in range(i)
+    ]
+    return dict(HEADER, images=images, annotations=annotations)
+
+
+@pytest.mark.parametrize("indent", [None, 4])
+def test_stream_writer_writes_the_same_dataset_as_json(tmp_path, indent):
+    dataset = make_dataset()
+    filepath = str(tmp_path / "annotations.json")
+    with COCOStreamWriter(filepath, indent=indent, **HEADER) as writer:
+        # Images and annotations may be added in any order
+        for image in dataset["images"]:
+            writer.add_image(image)
+            for annotation in dataset["annotations"]:
+                if annotation["image_id"] == image["id"]:
+                    writer.add_annotation(annotation)
+    with open(filepath) as f:
+        assert json.load(f) == dataset
+    assert sorted(os.listdir(str(tmp_path))) == ["annotations.json"]
+
+
+@pytest.mark.parametrize("indent", [None, 4])
+def test_records_are_read_one_by_one(tmp_path, indent):
+    dataset = make_dataset(20)
+    filepath = str(tmp_path / "annotations.json")
+    with COCOStreamWriter(filepath, indent=indent, **HEADER) as writer:
+        for image in dataset["images"]:
+            writer.add_image(image)
+        for annotation in dataset["annotations"]:
+            writer.add_annotation(annotation)
+    records = {"images": [], "annotations": []}
+    for key, record in iter_coco_records(filepath, chunk_size=3):
+        if key in records:
+            records[key].append(record)
+        else:
+            # The header values are yielded as a whole
+            records[key] = record
+    assert records == dataset
+
+
+def test_a_failed_writer_leaves_the_previous_file(tmp_path):
+    filepath = str(tmp_path / "annotations.json")
+    with open(filepath, "w") as f:
+        json.dump(make_dataset(1), f)
+    with pytest.raises(RuntimeError):
+        with COCOStreamWriter(filepath, **HEADER) as writer:
+            writer.add_image({"id": 7})
+            raise RuntimeError("conversion failed")
+    with open(filepath) as f:
+        assert json.load(f) == make_dataset(1)
+    assert sorted(os.listdir(str(tmp_path))) == ["annotations.json"]
+
+
+def test_results_are_read_back_per_image(tmp_path):
+    mask = np.zeros((4, 4), dtype=np.uint8)
+    mask[1:3, 1:3] = 1
+    # Results of an image are split into several chunks, and image 1 comes back after image 2
+    results = [
+        {"image_id": image_id, "category_id": 1, "score": k / 10, "bbox": [k, 0, 1, 1]}
+        for image_id, count in [(1, 5), (2, 2), (1, 1), (3, 0)]
+        for k in range(count)
+    ]
+    results[0]["segmentation"] = encode_mask(mask)
+    filepath = str(tmp_path / "results.json")
+    with COCOResultsWriter(filepath, chunk_size=2) as writer:
+        writer.add_results(results)
+    with COCOResultsReader(filepath) as reader:
+        assert len(reader) == len(results)
+        assert reader.image_ids == [1, 2]
+        for image_id in [1, 2]:
+            assert reader.load(image_id) == [
+                result for result in results if result["image_id"] == image_id
+            ]
+        assert reader.load(3) == []
+        reader.export(str(tmp_path / "exported.json"))
+    with open(str(tmp_path / "exported.json")) as f:
+        assert json.load(f) == sorted(results, key=lambda result: result["image_id"])
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from src.data.preprocessing.tiling import (
+    GB,
+    MAX_HEAP,
+    TilePlan,
+    covers_scene,
+    plan_tiles,
+)
+
+
+@pytest.mark.parametrize(
+    "memory_budget,cores", [(3 * GB, 4), (8 * GB, 16), (64 * GB, 64)]
+)
+def test_plan_covers_the_scene_within_the_memory_budget(memory_budget, cores):
+    height, width = 6000, 9000
+    plan = plan_tiles(height, width, memory_budget, cores)
+    assert plan.heap <= min(memory_budget, MAX_HEAP)
+    assert 1 <= plan.workers <= max(1, cores // 2)
+    assert plan.workers * plan.heap <= memory_budget
+    assert len(plan.tiles) == plan.rows * plan.cols
+    coverage = np.zeros((height, width), dtype=bool)
+    for x, y, w, h in plan.tiles:
+        assert 0 <= x and 0 <= y and x + w <= width and y + h <= height
+        coverage[y : y + h, x : x + w] = True
+    assert coverage.all()
+
+
+def test_small_scene_is_a_single_tile():
+    plan = plan_tiles(100, 100, 64 * GB, 16)
+    assert (plan.rows, plan.cols) == (1, 1)
+    assert plan.tiles == [(0, 0, 100, 100)]
+
+
+def test_scene_that_does_not_fit_raises():
+    with pytest.raises(ValueError):
+        plan_tiles(200000, 200000, 3 * GB, 4, max_grid=2)
+
+
+def test_plan_survives_a_round_trip_through_a_dictionary():
+    plan = plan_tiles(6000, 9000, 8 * GB, 16)
+    loaded = TilePlan.from_dict(plan.to_dict())
+    assert loaded.to_dict() == plan.to_dict()
+    assert loaded.tiles == plan.tiles
+    assert covers_scene(loaded.tiles, 6000, 9000)
+
+
+def test_covers_scene():
+    assert covers_scene([(0, 0, 60, 100), (50, 0, 50, 100)], 100, 100)
+    # A gap of a column between the tiles, and a missing corner
+    assert not covers_scene([(0, 0, 50, 100), (51, 0, 49, 100)], 100, 100)
+    assert not covers_scene([(0, 0, 100, 50), (0, 50, 50, 50)], 100, 100)